@@ -536,6 +536,9 @@ class CPAnalyst(wx.App):
 
 
 if __name__ == "__main__":    
+    # CSV import parses files in worker processes (see cpa.ingest)
+    import multiprocessing
+    multiprocessing.freeze_support()
     # Initialize the app early because the fancy exception handler
     # depends on it in order to show a 
     app = CPAnalyst(redirect=False)
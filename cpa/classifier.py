@@ -22,9 +22,11 @@ from time import time
 from . import icons
 from . import dbconnect
 from . import dirichletintegrate
+from . import imagepanel
 from . import imagetools
 from . import polyafit
 from . import sortbin
+from . import tilestore
 import logging
 import numpy as np
 import os
@@ -629,6 +631,7 @@ class Classifier(wx.Frame):
         paramsEditMenuItem = advancedMenu.Append(-1, item='Edit Parameters...', helpString='Lets you edit the hyperparameters')
         featureSelectMenuItem = advancedMenu.Append(-1, item='Check Features', helpString='Check the variance of your Training Data')
         saveMenuItem = advancedMenu.Append(-1, item='Save Thumbnails as PNG', helpString='Save TrainingSet thumbnails as PNG')
+        precropMenuItem = advancedMenu.Append(-1, item='Pre-crop Tiles...', helpString='Save the tiles of the training set or of random objects in the tile store')
         self.scalerMenuItem = advancedMenu.AppendCheckItem(-1, item='Use Scaler',
                                                              help='Perform scaling normalization on training data')
         self.scalerMenuItem.Check(False)
@@ -654,6 +657,7 @@ class Classifier(wx.Frame):
         self.Bind(wx.EVT_MENU, self.OnRulesEdit, rulesEditMenuItem)
         self.Bind(wx.EVT_MENU, self.OnFeatureSelect, featureSelectMenuItem)
         self.Bind(wx.EVT_MENU, self.OnSaveThumbnails ,saveMenuItem)
+        self.Bind(wx.EVT_MENU, self.OnPrecropTiles, precropMenuItem)
         self.Bind(wx.EVT_MENU, self.OnToggleScaling, self.scalerMenuItem)
         self.Bind(wx.EVT_MENU, self.OnToggleReplacement, sampleReplacementItem)
         self.Bind(wx.EVT_MENU, self.OnToggleRejectDuplicates, rejectDuplicatesItem)
@@ -960,6 +964,30 @@ class Classifier(wx.Frame):
                 for tile in bin.tiles:
                     imagetools.SaveBitmap(tile.bitmap, directory + '/training_set/' + str(label) + '/' + str(tile.obKey) + '.png')
 
+    def OnPrecropTiles(self, evt):
+        '''
+        Cuts tiles into the tile store in the background, for the objects in
+        the class bins or, if they are empty, for a random sample of objects.
+        '''
+        if not p.tile_store:
+            wx.MessageBox('Set "tile_store = yes" in your properties file to keep tiles between sessions.',
+                          'Tile store is off')
+            return
+        obKeys = [obKey for bin in self.classBins for obKey in bin.GetObjectKeys()]
+        if not obKeys:
+            n = wx.GetNumberFromUser('No objects have been classified yet. Pre-crop the tiles of\n'
+                                     'how many random objects?', 'Objects:', 'Pre-crop Tiles',
+                                     1000, 1, 1000000, self)
+            if n <= 0:
+                return
+            obKeys = dm.GetRandomObjects(n)
+
+        def progress(done, total):
+            wx.CallAfter(self.PostMessage, 'Pre-cropped tiles of %d of %d objects' % (done, total))
+
+        self.PostMessage('Pre-cropping tiles of %d objects' % (len(obKeys)))
+        tilestore.start_precrop(obKeys, progress)
+
     def OnToggleScaling(self, evt):
         self.algorithm.toggle_scaler(evt.IsChecked())
         self.UpdateClassChoices()
@@ -2312,17 +2340,17 @@ class Classifier(wx.Frame):
     def SetBrightness(self, brightness):
         ''' Updates the global image brightness across all tiles. '''
         self.brightness = brightness
-        [t.SetBrightness(brightness) for bin in self.all_sort_bins() for t in bin.tiles]
+        imagepanel.UpdateBitmaps([t for bin in self.all_sort_bins() for t in bin.tiles], brightness=brightness)
 
     def SetScale(self, scale):
         ''' Updates the global image scaling across all tiles. '''
         self.scale = scale
-        [t.SetScale(scale) for bin in self.all_sort_bins() for t in bin.tiles]
+        imagepanel.UpdateBitmaps([t for bin in self.all_sort_bins() for t in bin.tiles], scale=scale)
         [bin.UpdateSizer() for bin in self.all_sort_bins()]
 
     def SetContrastMode(self, mode):
         self.contrast = mode
-        [t.SetContrastMode(mode) for bin in self.all_sort_bins() for t in bin.tiles]
+        imagepanel.UpdateBitmaps([t for bin in self.all_sort_bins() for t in bin.tiles], contrast=mode)
 
     def PostMessage(self, message):
         ''' Updates the status bar text and logs to info. '''
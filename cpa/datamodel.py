@@ -3,34 +3,80 @@ from itertools import islice
 from .dbconnect import *
 from .singleton import *
 from .properties import Properties
+from .sampling import ObjectIDResolver, ObjectSampler
+from .util import cpa_data_dir
+from . import modelcache
 
 p = Properties()
 db = DBConnect()
 
+# group column types that can be stored in a DataModel snapshot
+SNAPSHOT_TYPES = dict((t.__name__, t) for t in (str, int, float, bool))
+
+class GroupIndex(object):
+    '''
+    Assignment of the DataModel's images to the keys of one group, stored
+    as an integer group code per image row (-1 for images in no group).
+    The rows of each group are kept contiguous in self.order so the images
+    in a group are found without scanning.
+    '''
+    def __init__(self, nrows, rows, groupkeys):
+        '''
+        nrows -- number of images in the DataModel
+        rows, groupkeys -- row of each image and the key of its group
+        '''
+        self.keys = list(dict.fromkeys(groupkeys))
+        self.index = dict((key, code) for code, key in enumerate(self.keys))
+        self.codes = np.full(nrows, -1, dtype=np.int32)
+        if len(rows):
+            self.codes[np.asarray(rows, dtype=np.int64)] = [self.index[key] for key in groupkeys]
+        self.order = np.argsort(self.codes, kind='stable')
+        self.starts = np.searchsorted(self.codes[self.order], np.arange(len(self.keys) + 1))
+
+    @classmethod
+    def from_arrays(cls, keys, codes, order, starts):
+        '''Rebuilds a GroupIndex from its keys and arrays, eg: from a snapshot.'''
+        index = cls.__new__(cls)
+        index.keys = keys
+        index.index = dict((key, code) for code, key in enumerate(keys))
+        index.codes, index.order, index.starts = codes, order, starts
+        return index
+
+    def rows_in(self, key):
+        '''Returns the image rows in the group with the given key.'''
+        code = self.index[key]
+        return self.order[self.starts[code]:self.starts[code + 1]]
+
+
 class DataModel(metaclass=Singleton):
     '''
-    DataModel is a dictionary of perImageObjectCounts indexed by (TableNumber,ImageNumber)
+    DataModel holds the per-image object counts of the experiment, indexed by
+    image key: (ImageNumber,) or (TableNumber, ImageNumber). Images are rows
+    of contiguous arrays in the order of self.keylist.
     '''
     
     def __init__(self):
-        self.data = {}           # {imKey:obCount, ... }
-        self.groupMaps = {}      # { groupName:{imKey:groupKey, }, ... }
-                                 # eg: groupMaps['Wells'][(0,4)]  ==>  (3,'A01')
-        self.revGroupMaps = {}   # { groupName:{groupKey:imKey, }, ... }
-                                 # eg: groupMaps['Wells'][(3,'A01')]  ==>  [(0,1),(0,2),(0,3),(0,4)]
+        self.keylist = []        # image keys, one per row
+        self.keys = np.zeros((0, 0), dtype=np.int64)  # image keys as an (images x key columns) array
+        self.rows = {}           # {imKey: row}
+        self.counts = np.zeros(0, dtype=np.int64)     # object count of each row
+        self.groups = {}         # {groupName: GroupIndex}
+                                 # eg: groups['Wells'].keys[groups['Wells'].codes[row]]  ==>  (3,'A01')
         self.groupColNames = {}  # {groupName:[col_names,...], ...}
                                  # eg: {'Plate+Well': ['plate','well'], ...}
         self.groupColTypes = {}  # {groupName:[col_types,...], ...}
         self.cumSums = []        # cumSum[i]: sum of objects in images 1..i (inclusive) 
         self.obCount = 0
-        self.keylist = []
+        self.resolver = None     # ObjectIDResolver: (image, index) -> object key
+        self.sampler = None      # ObjectSampler over the images in keylist
         self.filterkeys = {}     # sets of image keys keyed by filter name
         self.plate_map = {}      # maps well names to (x,y) plate locations
         self.rev_plate_map = {}  # maps (x,y) plate locations to well names
+        self._snapshot = None    # (path, identity, stamp) of the model's snapshot
         
     def __str__(self):
         return str(self.obCount)+" objects in "+ \
-               str(len(self.data))+" images"
+               str(len(self.keylist))+" images"
                
     def PopulateModel(self, delete_model=False):
         if delete_model:
@@ -45,37 +91,158 @@ class DataModel(metaclass=Singleton):
         
         if p.check_tables == 'yes':
             db.CheckTables()
+
+        snapshot = self._snapshot_key()
+        if snapshot is not None and self._load_snapshot(*snapshot):
+            logging.info('Loaded %s from the DataModel snapshot.'%(self))
+            return
         
-        # Initialize per-image object counts to zero
+        nkey = len(image_key_columns())
         imKeys = db.GetAllImageKeys()
-        for key in imKeys:
-            key = tuple([int(k) for k in key])    # convert keys to to int tuples
-            self.data[key] = 0
-                    
-        # Compute per-image object counts
-        res = db.GetPerImageObjectCounts()
-        for r in res:
-            key = tuple([int(k) for k in r[:-1]])
-            self.data[key] = r[-1]
-            self.obCount += r[-1]
-            
-        self.keylist = list(self.data.keys())
+        self.keys = rows_to_array(imKeys, 'i8').reshape(len(imKeys), nkey)
+        self.keylist = list(map(tuple, self.keys.tolist()))
+        self.rows = dict(zip(self.keylist, range(len(self.keylist))))
+
+        # Compute per-image object counts and object number ranges
+        nrows = len(self.keylist)
+        self.counts = np.zeros(nrows, dtype=np.int64)
+        first_ids = np.zeros(nrows, dtype=np.int64)
+        last_ids = np.full(nrows, -1, dtype=np.int64)
+        res = db.GetPerImageObjectRanges()
+        if res:
+            ranges = rows_to_array(res, 'i8')
+            rows = self._lookup_rows(ranges[:, :nkey])
+            ranges = ranges[rows >= 0]
+            rows = rows[rows >= 0]
+            self.counts[rows], first_ids[rows], last_ids[rows] = ranges[:, nkey:].T
+        self.obCount = int(self.counts.sum())
 
         # Build a cumulative sum array to use for generating random objects quickly
-        self.cumSums = np.zeros(len(self.data)+1, dtype='int')
-        for i, imKey in enumerate(self.keylist):
-            self.cumSums[i+1] = self.cumSums[i]+self.data[imKey]
+        self.cumSums = np.zeros(nrows + 1, dtype=np.int64)
+        np.cumsum(self.counts, out=self.cumSums[1:])
+        self.resolver = ObjectIDResolver(self.keylist, self.counts, first_ids, last_ids,
+                                         db.GetObjectIDArrays, rows=self.rows)
+        self.sampler = ObjectSampler(self.resolver, self.cumSums)
+
+        for group in p._groups:
+            groupMap, self.groupColNames[group] = db.group_map(group)
+            rows = self._lookup_rows(rows_to_array(list(groupMap.keys()), 'i8').reshape(len(groupMap), nkey))
+            groupkeys = [groupKey for groupKey, row in zip(groupMap.values(), rows) if row >= 0]
+            self.groups[group] = GroupIndex(nrows, rows[rows >= 0], groupkeys)
+            if groupkeys:
+                self.groupColTypes[group] = [type(col) for col in groupkeys[0]]
 
-        self.groupMaps, self.groupColNames = db.GetGroupMaps()
-        self.revGroupMaps, _ = db.GetGroupMaps(reverse=True)
-        for group in self.groupMaps:
-            self.groupColTypes[group] = [type(col) for col in list(self.groupMaps[group].items())[0][1]]
+        if snapshot is not None:
+            self._save_snapshot(*snapshot)
+            self._snapshot = snapshot
+
+    def _snapshot_key(self):
+        '''
+        Returns (path, identity, stamp) for the snapshot of this project's
+        model, or None if Properties.datamodel_cache is off or the database
+        can't tell when the object table was last modified. The identity
+        covers the properties file, the database and the properties the
+        model is built from; the stamp is the object table's modify date.
+        '''
+        if not p.datamodel_cache:
+            return None
+        try:
+            stamp = db.get_objects_modify_date()
+            db_type, host, user, passwd, name, db_file = db._pool_key()
+            directory = cpa_data_dir('datamodel')
+        except Exception as e:
+            logging.debug('Not using a DataModel snapshot: %s'%(e))
+            return None
+        if stamp is None:
+            return None
+        props_file = p.__dict__.get('_filename')
+        identity = repr((props_file and os.path.abspath(props_file),
+                         db_type, host, user, name, db_file and os.path.abspath(db_file),
+                         p.image_table, p.object_table, p.table_id, p.image_id, p.object_id,
+                         sorted(p._groups.items()), p.well_id, p.well_format, p.plate_shape))
+        return modelcache.snapshot_path(directory, identity), identity, repr(stamp)
+
+    def _save_snapshot(self, path, identity, stamp):
+        arrays = {'keys': self.keys, 'counts': self.counts,
+                  'first_ids': self.resolver.first_ids,
+                  'last_ids': self.resolver.last_ids,
+                  'cumsums': self.cumSums}
+        groups = {}
+        for name, index in self.groups.items():
+            arrays['group_codes_%d'%(len(groups))] = index.codes
+            arrays['group_order_%d'%(len(groups))] = index.order
+            arrays['group_starts_%d'%(len(groups))] = index.starts
+            groups[name] = {'keys': [list(key) for key in index.keys],
+                            'columns': self.groupColNames[name],
+                            'types': [t.__name__ for t in self.groupColTypes.get(name, [])]}
+        meta = {'groups': list(groups.items()),
+                'plate_map': [[well, row, col] for well, (row, col) in self.plate_map.items()]}
+        try:
+            if any(t not in SNAPSHOT_TYPES for g in groups.values() for t in g['types']):
+                raise TypeError('unsupported group column type')
+            modelcache.save_snapshot(path, identity, stamp, arrays, meta)
+        except (OSError, TypeError, ValueError) as e:
+            logging.warn('Could not save the DataModel snapshot: %s'%(e))
+
+    def _load_snapshot(self, path, identity, stamp):
+        snapshot = modelcache.load_snapshot(path, identity, stamp)
+        if snapshot is None:
+            return False
+        arrays, meta = snapshot
+        self.keys = arrays['keys']
+        self.keylist = list(map(tuple, self.keys.tolist()))
+        self.rows = dict(zip(self.keylist, range(len(self.keylist))))
+        self.counts = arrays['counts']
+        self.obCount = int(self.counts.sum())
+        self.cumSums = arrays['cumsums']
+        self.resolver = ObjectIDResolver(self.keylist, self.counts, arrays['first_ids'],
+                                         arrays['last_ids'], db.GetObjectIDArrays, rows=self.rows)
+        self.sampler = ObjectSampler(self.resolver, self.cumSums)
+        for i, (name, group) in enumerate(meta['groups']):
+            self.groups[name] = GroupIndex.from_arrays(
+                [tuple(key) for key in group['keys']], arrays['group_codes_%d'%(i)],
+                arrays['group_order_%d'%(i)], arrays['group_starts_%d'%(i)])
+            self.groupColNames[name] = group['columns']
+            if group['types']:
+                self.groupColTypes[name] = [SNAPSHOT_TYPES[t] for t in group['types']]
+        if meta['plate_map'] and not self.plate_map:
+            for well, row, col in meta['plate_map']:
+                self.plate_map[well] = (row, col)
+                self.rev_plate_map[(row, col)] = well
+        self._snapshot = (path, identity, stamp)
+        return True
+
+    def _lookup_rows(self, keys):
+        '''
+        Vectorized self.rows lookup: returns the row of each image key in an
+        (images x key columns) array, or -1 for keys that aren't in the model.
+        '''
+        keys = np.ascontiguousarray(keys, dtype=np.int64)
+        if keys.shape == self.keys.shape and np.array_equal(keys, self.keys):
+            # the usual case: results come back in the same order
+            return np.arange(len(keys))
+        if len(self.keys) == 0 or len(keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        # compare whole keys as records
+        record = [('k%d'%(i), np.int64) for i in range(keys.shape[1])]
+        mine = np.ascontiguousarray(self.keys).view(record).ravel()
+        theirs = keys.view(record).ravel()
+        order = np.argsort(mine)
+        rows = order[np.minimum(np.searchsorted(mine, theirs, sorter=order), len(order) - 1)]
+        rows[mine[rows] != theirs] = -1
+        return rows
 
     def DeleteModel(self):
-        self.data = {}
-        self.groupMaps = {}
+        self.keylist = []
+        self.keys = np.zeros((0, 0), dtype=np.int64)
+        self.rows = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.groups = {}
         self.cumSums = []
         self.obCount = 0
+        self.resolver = None
+        self.sampler = None
+        self._snapshot = None
         
     def _if_empty_populate(self):
         if self.IsEmpty:
@@ -87,26 +254,12 @@ class DataModel(metaclass=Singleton):
         
     def GetRandomObject(self, N):
         '''
-        Returns a random object key
-        We expect self.data.keys() to return the keys in the SAME ORDER
-        every time since we build cumSums from that same ordering.  This
-        need not necessarily be in sorted order.
+        Returns N random object keys, sampled without replacement.
+        Positions are drawn over cumSums, which follows the order of
+        self.keylist, and resolved to object keys in one batch.
         '''
         self._if_empty_populate()
-        obIdxs = random.sample(list(range(1, self.obCount + 1)), N)
-        obKeys = []
-        for obIdx in obIdxs:
-            imIdx = np.searchsorted(self.cumSums, obIdx, 'left')
-            # SUBTLETY: images which have zero objects will appear as repeated
-            #    sums in the cumulative array, so we must pick the first index
-            #    of any repeated sum, otherwise we are picking an image with no
-            #    objects
-            while self.cumSums[imIdx] == self.cumSums[imIdx-1]:
-                imIdx -= 1
-            imKey = list(self.data.keys())[imIdx-1]
-            obIdx = obIdx-self.cumSums[imIdx-1]  # object number relative to this image
-            obKeys.append(db.GetObjectIDAtIndex(imKey, obIdx))
-        return obKeys
+        return self.sampler.sample(N)
 
     def GetRandomObjects(self, N, imKeys=None, with_replacement=False):
         '''
@@ -119,38 +272,11 @@ class DataModel(metaclass=Singleton):
             logging.info(f"{N} is greater than the number of objects. Fetching {self.obCount} objects.")
             N = self.obCount
         if imKeys == None:
-            if p.use_legacy_fetcher:
-                return self.GetRandomObject(N)
-            else:
-                return db.GetRandomObjectsSQL(None, N)
+            return self.sampler.sample(N, with_replacement=with_replacement)
         elif imKeys == []:
             return []
         else:
-            if p.use_legacy_fetcher:
-                sums = np.cumsum([self.data[imKey] for imKey in imKeys])
-                if sums[-1] < 1:
-                    return []
-                obs = []
-                if with_replacement:
-                    obIdxs = random.choices(list(range(1, sums[-1] + 1)), k=N)
-                else:
-                    if N > sums[-1]:
-                        logging.info(f"Number of available objects is less than {N}. Fetching {sums[-1]} objects.")
-                        N = sums[-1]
-                    obIdxs = random.sample(list(range(1, sums[-1]+1)), k=N)
-                for obIdx in obIdxs:
-                    index = np.searchsorted(sums, obIdx, 'left')
-                    if index != 0:
-                        while sums[index] == sums[index-1]:
-                            index -= 1
-                        obIdx = obIdx-sums[index-1]
-                    obKey = db.GetObjectIDAtIndex(imKeys[index], obIdx)
-                    obs.append(obKey)
-            else:
-                obs = db.GetRandomObjectsSQL(imKeys, N)
-                if with_replacement and 0 < len(obs) < N:
-                    obs = random.choices(obs, k=N)
-            return obs
+            return self.sampler.sample(N, imKeys, with_replacement)
 
     def GetAllObjects(self, filter_name=None, gate_name=None, imkeys=[], N=None):
         self._if_empty_populate()
@@ -168,9 +294,7 @@ class DataModel(metaclass=Singleton):
     def GetObjectsFromImage(self, imKey):
         self._if_empty_populate()
         if p.use_legacy_fetcher:
-            obKeys=[]
-            for i in range(1,self.GetObjectCountFromImage(imKey)+1):
-                obKeys.append(db.GetObjectIDAtIndex(imKey, i))
+            obKeys = [tuple(imKey) + (int(obId),) for obId in self.resolver.image_object_ids(imKey)]
         else:
             obKeys = db.GetAllObjectsSQL([imKey])
         return obKeys
@@ -184,20 +308,20 @@ class DataModel(metaclass=Singleton):
         elif gate_name is not None:
             return db.GetGatedImages(gate_name)
         else:
-            return list(self.data.keys())
+            return list(self.keylist)
 
     def GetObjectCountFromImage(self, imKey):
         ''' Returns the number of objects in the specified image. '''
         self._if_empty_populate()
-        return self.data[imKey]
+        return int(self.counts[self.rows[imKey]])
     
     def GetImageKeysAndObjectCounts(self, filter_name=None):
         ''' Returns pairs of imageKeys and object counts. '''
         self._if_empty_populate()
         if filter_name is None:
-            return list(self.data.items())
+            return list(zip(self.keylist, self.counts.tolist()))
         else:
-            return [(imKey, self.data[imKey]) for imKey in db.GetFilteredImages(filter_name)]
+            return [(imKey, int(self.counts[self.rows[imKey]])) for imKey in db.GetFilteredImages(filter_name)]
     
     def GetGroupColumnNames(self, group, include_table_name=False):
         ''' Returns the key column names associated with the specified group. '''
@@ -221,17 +345,18 @@ class DataModel(metaclass=Singleton):
            groupdata = { groupKey : np.array(values), ... }
         '''
         self._if_empty_populate()
-        groupData = {}
-        nvals = len(list(imdata.values())[0])
-        for imKey in list(imdata.keys()):
-            # initialize each entry to [0,0,...]
-            groupData[self.groupMaps[group][imKey]] = np.zeros(nvals)
-            
-        for imKey, vals in list(imdata.items()):
-            # add values to running sum of this group
-            groupData[self.groupMaps[group][imKey]] += vals
-        
-        return groupData
+        if not imdata:
+            return {}
+        index = self.groups[group]
+        codes = index.codes[[self.rows[imKey] for imKey in imdata]]
+        if (codes < 0).any():
+            raise KeyError('Some images are not in any group of "%s".'%(group))
+        values = np.array(list(imdata.values()), dtype=float).reshape(len(codes), -1)
+        # sum each column of values into the groups present in imdata
+        present, codes = np.unique(codes, return_inverse=True)
+        sums = np.column_stack([np.bincount(codes, weights=values[:, i], minlength=len(present))
+                                for i in range(values.shape[1])])
+        return dict((index.keys[code], sums[i]) for i, code in enumerate(present))
     
     def GetImagesInGroupWithWildcards(self, group, groupKey, filter_name=None):
         '''
@@ -244,11 +369,9 @@ class DataModel(metaclass=Singleton):
             #   imkeys from all matching groupKeys
             def matches(key1, key2):
                 return all([(a==b or b=='__ANY__') for a,b in zip(key1,key2)])
-            imkeys = []
-            for gkey, ikeys in list(self.revGroupMaps[group].items()):
-                if matches(gkey,groupKey):
-                    imkeys += ikeys
-            return imkeys
+            index = self.groups[group]
+            rows = [index.rows_in(gkey) for gkey in index.keys if matches(gkey, groupKey)]
+            return [self.keylist[row] for row in np.concatenate(rows or [[]]).astype(np.int64)]
         else:
             # if there are no wildcards simply lookup the imkeys
             return self.GetImagesInGroup(group, groupKey, filter_name)
@@ -257,25 +380,25 @@ class DataModel(metaclass=Singleton):
         ''' Returns all imKeys in a particular group. '''
         self._if_empty_populate()
         try:
-            imkeys = self.revGroupMaps[group][groupKey]
+            imkeys = [self.keylist[row] for row in self.groups[group].rows_in(groupKey)]
         except KeyError:
             return []
             
         # apply filter if supplied
         if filter_name is not None:
             if filter_name not in list(self.filterkeys.keys()):
-                self.filterkeys[filter_name] = db.GetFilteredImages(filter_name)
-            imkeys = set(imkeys).intersection(self.filterkeys[filter_name])    
+                self.filterkeys[filter_name] = set(db.GetFilteredImages(filter_name))
+            imkeys = [imkey for imkey in imkeys if imkey in self.filterkeys[filter_name]]
         
         return imkeys
     
     def GetGroupKeysInGroup(self, group):
         ''' Returns all groupKeys in specified group '''
         self._if_empty_populate()
-        return list(set(self.groupMaps[group].values()))
+        return list(self.groups[group].keys)
         
     def IsEmpty(self):
-        return self.data == {}
+        return len(self.keylist) == 0
     
     def populate_plate_maps(self):
         '''Computes plate_maps which maps well names to their corresponding
@@ -332,6 +455,9 @@ class DataModel(metaclass=Singleton):
                 col = (int(well) - 1) % pshape[1]
                 self.plate_map[well] = (row, col)
                 self.rev_plate_map[(row, col)] = well
+        if self._snapshot is not None and not self.IsEmpty():
+            # keep the plate map with the rest of the model
+            self._save_snapshot(*self._snapshot)
     
     def get_well_position_from_name(self, well_name):
         '''returns the plate position tuple (row, col) corresponding to 
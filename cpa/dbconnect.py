@@ -1,9 +1,13 @@
 
 import decimal
+import hashlib
 from http.client import NO_CONTENT
 import random
 from .properties import Properties
 from .singleton import Singleton
+from .util import cpa_data_dir
+from .querycache import QueryCache
+from .sampling import draw
 import numpy as np
 import sys
 import threading
@@ -11,9 +15,40 @@ import re
 import os.path
 import logging
 import copy
+import time
+import itertools
+import functools
+import bisect
+import array
+import math
+import weakref
+from contextlib import contextmanager
 # This module should be usable on systems without wx.
 
 verbose = True
+# If True, the SQLite median() and percentile() aggregates sort all values
+# instead of using the streaming P-squared estimate. median_exact() and
+# percentile_exact() are always available.
+exact_sqlite_quantiles = False
+
+# Connection pool defaults, overridden by db_pool_size and
+# db_pool_idle_timeout in the properties file.
+DEFAULT_POOL_SIZE = 16
+DEFAULT_POOL_IDLE_TIMEOUT = 300
+# Seconds a thread will wait for a free connection before giving up.
+POOL_WAIT_TIMEOUT = 60
+# Number of rows per block yielded by DBConnect.execute_iter/fetch_blocks
+DEFAULT_BLOCK_ROWS = 10000
+# Key lists longer than this are joined through a temporary table rather
+# than written into the WHERE clause (see DBConnect.where_clause_for_images)
+DEFAULT_KEY_TABLE_THRESHOLD = 1000
+# Default bound (MB) on each tier of the query result cache
+DEFAULT_QUERY_CACHE_SIZE = 256
+# Table recording what each checked object table was built from, so it is
+# only rebuilt when its source changes (see CreateObjectCheckedTable)
+CHECKED_TABLES_RECORD = 'CPA_Checked_Tables'
+# Number of rows of a SQLite object table read to tell whether it changed
+CHECKED_TABLE_SAMPLE_ROWS = 256
 
 p = Properties()
 
@@ -34,6 +69,9 @@ def DBError():
     elif p.db_type.lower() == 'sqlite':
         import sqlite3
         return sqlite3.Error
+    elif p.db_type.lower() == 'duckdb':
+        import duckdb
+        return duckdb.Error
 
 def DBOperationalError():
     '''returns the Error type associated with the db library in use'''
@@ -43,6 +81,9 @@ def DBOperationalError():
     elif p.db_type.lower() == 'sqlite':
         import sqlite3
         return sqlite3.OperationalError
+    elif p.db_type.lower() == 'duckdb':
+        import duckdb
+        return duckdb.OperationalError
 
 
 class DBDisconnectedException(Exception):
@@ -60,6 +101,8 @@ class DBDisconnectedException(Exception):
                 return f(db, *args, **kwargs)
             except DBDisconnectedException:
                 logging.info('Lost connection to the MySQL database; reconnecting.')
+                # Don't hand the dead connection back to the pool.
+                db.CloseConnection(discard=True)
                 db.connect()
                 return f(db, *args, **kwargs)
         return fn
@@ -73,7 +116,8 @@ def sqltype_to_pythontype(t):
     t = t.upper()
     if (t.startswith('INT') or t.startswith('DECIMAL') or t.startswith('BIGINT') or
         t in ['TINYINT', 'SMALLINT', 'MEDIUMINT', 'UNSIGNED BIG INT',
-              'INT2', 'INT8', 'NUMERIC', 'BOOLEAN', 'DATE', 'DATETIME']):
+              'INT2', 'INT8', 'NUMERIC', 'BOOLEAN', 'DATE', 'DATETIME',
+              'HUGEINT', 'UTINYINT', 'USMALLINT', 'UINTEGER', 'UBIGINT']):
         return int
     elif t in ['REAL', 'DOUBLE', 'DOUBLE PRECISION', 'FLOAT']:
         return float
@@ -83,6 +127,25 @@ def sqltype_to_pythontype(t):
           t.startswith('NVARCHAR') or t in ['TEXT', 'CLOB']):
         return str
 
+def rows_to_array(rows, dtype='f8'):
+    '''
+    Packs a list of result rows into a contiguous 2-D numpy array.
+    For floating point dtypes, NULLs and values that can't be converted
+    become NaN. For integer dtypes every value must be convertible.
+    '''
+    dtype = np.dtype(dtype)
+    try:
+        return np.array(rows, dtype=dtype)
+    except (TypeError, ValueError):
+        if dtype.kind != 'f':
+            raise
+    def to_float(val):
+        try:
+            return float(val)
+        except (TypeError, ValueError):
+            return np.nan
+    return np.array([[to_float(val) for val in row] for row in rows], dtype=dtype)
+
 #TODO: this doesn't belong in this module
 def get_data_table_from_csv_reader(reader):
     '''reads a csv table into a 2d list'''
@@ -174,15 +237,19 @@ def GetWhereClauseForObjects(obkeys, table_name=None):
 
     return split(obkeys,table_name)
 
-def GetWhereClauseForImages(imkeys):
+def GetWhereClauseForImages(imkeys, table_name=None):
     '''
     Return a SQL WHERE clause that matches any of the given image keys.
     Example: GetWhereClauseForImages([(3,), (4,)]) =>
              "(ImageNumber IN (3, 4))"
     '''
+    if table_name is None:
+        table_name = ''
+    else:
+        table_name += '.'
     imkeys.sort()
     if not p.table_id:
-        return '%s IN (%s)'%(p.image_id, ','.join([str(k[0]) for k in imkeys]))
+        return '%s%s IN (%s)'%(table_name, p.image_id, ','.join([str(k[0]) for k in imkeys]))
     else:
         imkeys = np.array(imkeys)
         count = 0
@@ -192,8 +259,8 @@ def GetWhereClauseForImages(imkeys):
             imnums = imkeys[(imkeys[:,0]==tnum), 1]
             count += len(imnums)
             if len(imnums)>0:
-                wheres += ['(%s=%s AND %s IN (%s))'%(p.table_id, tnum,
-                            p.image_id, ','.join([str(k) for k in imnums]))]
+                wheres += ['(%s%s=%s AND %s%s IN (%s))'%(table_name, p.table_id, tnum,
+                            table_name, p.image_id, ','.join([str(k) for k in imnums]))]
             tnum += 1
         return ' OR '.join(wheres)
 
@@ -209,9 +276,9 @@ def GetWhereClauseForWells(keys, table_name=None):
         table_name += '.'
     keys.sort()
     if not p.plate_id:
-        return '%s%s IN (%s)'%(table_name, p.well_id, ','.join(['"%s"'%(k[0]) for k in keys]))
+        return '%s%s IN (%s)'%(table_name, p.well_id, ','.join(["'%s'"%(k[0]) for k in keys]))
     else:
-        wheres = ['%s%s="%s" AND %s%s="%s"'%(table_name, p.plate_id, plate, table_name, p.well_id, well) for plate, well in keys]
+        wheres = ["%s%s='%s' AND %s%s='%s'"%(table_name, p.plate_id, plate, table_name, p.well_id, well) for plate, well in keys]
         return ' OR '.join(wheres)
 
 def UniqueObjectClause(table_name=None):
@@ -253,6 +320,29 @@ def get_csv_filenames_from_sql_file():
             obcsvs += [file]
     return imcsvs, obcsvs
 
+def get_create_statements_from_sql_file():
+    '''
+    Get the CREATE TABLE statements in the .SQL file
+    '''
+    f = open(p.db_sql_file)
+    lines = f.readlines()
+    f.close()
+    create_stmts = []
+    i=0
+    in_create_stmt = False
+    for l in lines:
+        if l.upper().startswith('CREATE TABLE') or in_create_stmt:
+            if in_create_stmt:
+                create_stmts[i] += l
+            else:
+                create_stmts.append(l)
+            if l.strip().endswith(';'):
+                in_create_stmt = False
+                i+=1
+            else:
+                in_create_stmt = True
+    return create_stmts
+
 
 class SqliteClassifier():
     def __init__(self):
@@ -271,6 +361,415 @@ class SqliteClassifier():
         #          be found. This only appears to be a problem on Windows 64bit
         return int(class_num)
 
+class P2Quantile(object):
+    '''
+    Streaming estimate of the q-quantile (0 <= q <= 1) of a sequence of
+    values in O(1) memory, using the P-squared algorithm of Jain & Chlamtac
+    (1985). The estimate is exact for up to 5 values.
+    '''
+    def __init__(self, q):
+        self.q = q
+        self.n = 0
+        self.heights = []   # marker heights
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+        self.increments = [0, q / 2, q, (1 + q) / 2, 1]
+
+    def add(self, x):
+        self.n += 1
+        h = self.heights
+        if self.n <= 5:
+            bisect.insort(h, x)
+            return
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = bisect.bisect_right(h, x) - 1
+        pos = self.positions
+        for i in range(k + 1, 5):
+            pos[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - pos[i]
+            if (d >= 1 and pos[i + 1] - pos[i] > 1) or (d <= -1 and pos[i - 1] - pos[i] < -1):
+                d = 1 if d > 0 else -1
+                # piecewise-parabolic prediction, falling back to linear
+                hp = h[i] + d / (pos[i + 1] - pos[i - 1]) * (
+                    (pos[i] - pos[i - 1] + d) * (h[i + 1] - h[i]) / (pos[i + 1] - pos[i]) +
+                    (pos[i + 1] - pos[i] - d) * (h[i] - h[i - 1]) / (pos[i] - pos[i - 1]))
+                if not h[i - 1] < hp < h[i + 1]:
+                    hp = h[i] + d * (h[i + d] - h[i]) / (pos[i + d] - pos[i])
+                h[i] = hp
+                pos[i] += d
+
+    def result(self):
+        if self.n == 0:
+            return None
+        if self.n <= 5:
+            return float(np.percentile(self.heights, 100 * self.q))
+        return self.heights[2]
+
+
+def _sqlite_float(val):
+    '''Returns val as a float, or None for NULL and NaN.'''
+    if val is None:
+        return None
+    val = float(val)
+    if math.isnan(val):
+        return None
+    return val
+
+def _percentile_fraction(q):
+    # percentile(col, 90) and percentile(col, 0.9) are both accepted
+    q = float(q)
+    return q / 100.0 if q > 1 else q
+
+
+class SqliteStddev(object):
+    '''SQLite STDDEV aggregate (population standard deviation), computed
+    with Welford's streaming algorithm.'''
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, val):
+        val = _sqlite_float(val)
+        if val is not None:
+            self.n += 1
+            delta = val - self.mean
+            self.mean += delta / self.n
+            self.m2 += delta * (val - self.mean)
+
+    def finalize(self):
+        if self.n == 0:
+            return None
+        return math.sqrt(self.m2 / self.n)
+
+
+class SqlitePercentile(object):
+    '''SQLite PERCENTILE(col, q) aggregate estimated with P2Quantile. q is
+    a fraction, or a percentage if greater than 1.'''
+    def __init__(self):
+        self.estimator = None
+
+    def step(self, val, q):
+        val = _sqlite_float(val)
+        if val is not None:
+            if self.estimator is None:
+                self.estimator = P2Quantile(_percentile_fraction(q))
+            self.estimator.add(val)
+
+    def finalize(self):
+        return None if self.estimator is None else self.estimator.result()
+
+
+class SqliteMedian(SqlitePercentile):
+    '''SQLite MEDIAN aggregate estimated with P2Quantile.'''
+    def step(self, val):
+        SqlitePercentile.step(self, val, 0.5)
+
+
+class SqliteExactPercentile(object):
+    '''Exact version of SqlitePercentile, which keeps every value.'''
+    def __init__(self):
+        self.values = array.array('d')
+        self.q = None
+
+    def step(self, val, q):
+        val = _sqlite_float(val)
+        if val is not None:
+            if self.q is None:
+                self.q = _percentile_fraction(q)
+            self.values.append(val)
+
+    def finalize(self):
+        if len(self.values) == 0:
+            return None
+        return float(np.percentile(np.frombuffer(self.values, dtype='f8'), 100 * self.q))
+
+
+class SqliteExactMedian(SqliteExactPercentile):
+    '''Exact version of SqliteMedian, which keeps every value.'''
+    def step(self, val):
+        SqliteExactPercentile.step(self, val, 0.5)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_regexp(expr):
+    return re.compile(expr)
+
+def sqlite_regexp(expr, item):
+    '''SQLite REGEXP function; compiled patterns are cached.'''
+    if item is None:
+        return None
+    return _compile_regexp(expr).match(item) is not None
+
+def register_sqlite_functions(conn):
+    '''Registers CPA's user-defined functions and aggregates on an SQLite
+    connection.'''
+    conn.create_function('greatest', -1, max)
+    conn.create_aggregate('stddev', 1, SqliteStddev)
+    if exact_sqlite_quantiles:
+        conn.create_aggregate('median', 1, SqliteExactMedian)
+        conn.create_aggregate('percentile', 2, SqliteExactPercentile)
+    else:
+        conn.create_aggregate('median', 1, SqliteMedian)
+        conn.create_aggregate('percentile', 2, SqlitePercentile)
+    conn.create_aggregate('median_exact', 1, SqliteExactMedian)
+    conn.create_aggregate('percentile_exact', 2, SqliteExactPercentile)
+    conn.create_function('REGEXP', 2, sqlite_regexp)
+
+
+# DuckDB has greatest() and exact median() built in. Its stddev() is the
+# sample deviation, so it is replaced by the population one to agree with
+# MySQL and SQLite. Macros are private to each connection.
+DUCKDB_MACROS = [
+    'CREATE OR REPLACE TEMP MACRO stddev(x) AS stddev_pop(x)',
+    'CREATE OR REPLACE TEMP MACRO percentile(x, q) AS quantile_cont(x, CASE WHEN q > 1 THEN q / 100.0 ELSE q END)',
+    'CREATE OR REPLACE TEMP MACRO median_exact(x) AS median(x)',
+    'CREATE OR REPLACE TEMP MACRO percentile_exact(x, q) AS percentile(x, q)',
+]
+
+def register_duckdb_functions(conn):
+    '''Defines the functions of register_sqlite_functions on a DuckDB connection.'''
+    for statement in DUCKDB_MACROS:
+        conn.execute(statement)
+
+# DuckDB database file -> connection. The connections handed out to threads
+# are cursors (duplicate connections) of these, so that they share one
+# buffer pool and catalog; DuckDB only lets a single process open a file.
+_duckdb_databases = {}
+_duckdb_lock = threading.Lock()
+
+def duckdb_cursor(filename, on_open=None):
+    '''
+    Returns a new connection to the DuckDB database in filename. on_open is
+    called with the database's first connection when it is opened.
+    '''
+    import duckdb
+    with _duckdb_lock:
+        database = _duckdb_databases.get(filename, None)
+        if database is None:
+            database = duckdb.connect(filename)
+            if on_open is not None:
+                on_open(database)
+            _duckdb_databases[filename] = database
+        return database.cursor()
+
+def close_duckdb_databases():
+    '''Closes the DuckDB databases opened by duckdb_cursor.'''
+    with _duckdb_lock:
+        for database in _duckdb_databases.values():
+            try:
+                database.close()
+            except Exception:
+                pass
+        _duckdb_databases.clear()
+
+
+class _ThreadOwner(object):
+    '''Kept in a thread's local storage, so it is freed when the thread
+    exits. See DBConnect._release_on_exit.'''
+
+
+class ConnectionPool(object):
+    '''
+    A bounded pool of database connections shared by the threads that use
+    DBConnect. A thread checks a connection out when it first touches the
+    database and checks it back in with DBConnect.CloseConnection. Idle
+    connections are health checked before they are reused and are closed
+    once they have been idle for longer than idle_timeout seconds.
+    '''
+    def __init__(self, max_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.cv = threading.Condition()
+        self.idle = []          # [(pool_key, conn, cursor, checkin_time), ...] most recent last
+        self.n_open = 0         # connections currently open (idle + in use)
+        self.n_in_use = 0
+        self.n_created = 0
+        self.n_reused = 0
+        self.n_evicted = 0
+        self.n_waits = 0
+        self.wait_time = 0.0
+
+    def configure(self, max_size=None, idle_timeout=None):
+        with self.cv:
+            if max_size is not None:
+                self.max_size = max(1, int(max_size))
+            if idle_timeout is not None:
+                self.idle_timeout = float(idle_timeout)
+            self.cv.notify_all()
+
+    def checkout(self, pool_key, factory, is_alive, reclaim=None, timeout=POOL_WAIT_TIMEOUT):
+        '''
+        Returns a (connection, cursor) pair for pool_key.
+        factory -- function returning a new (connection, cursor) pair
+        is_alive -- function(connection, cursor) used to health check an idle
+                    connection before handing it out
+        reclaim -- optional function that returns connections held by dead
+                   threads to the pool. It is called before waiting.
+        Raises DBException if no connection becomes free within timeout.
+        '''
+        wait_start = None
+        while True:
+            candidate = None
+            with self.cv:
+                self._evict_idle()
+                for i in range(len(self.idle) - 1, -1, -1):
+                    if self.idle[i][0] == pool_key:
+                        candidate = self.idle.pop(i)
+                        break
+                if candidate is None and self.idle and self.n_open >= self.max_size:
+                    # Make room by closing an idle connection to another database.
+                    self._close(self.idle.pop(0)[1])
+                if candidate is None and self.n_open < self.max_size:
+                    self.n_open += 1
+                    self.n_in_use += 1
+                    self._stop_waiting(wait_start)
+                    break
+                if candidate is None:
+                    if reclaim is not None and reclaim():
+                        continue
+                    if wait_start is None:
+                        wait_start = time.time()
+                        self.n_waits += 1
+                    remaining = timeout - (time.time() - wait_start)
+                    if remaining <= 0:
+                        self._stop_waiting(wait_start)
+                        raise DBException('Timed out waiting for a database connection. '
+                                          'All %d pooled connections are in use. Increase '
+                                          'db_pool_size in your properties file.'%(self.max_size))
+                    # Wake periodically so connections left behind by
+                    # finished threads get reclaimed.
+                    self.cv.wait(min(remaining, 0.5))
+                    continue
+                self.n_in_use += 1
+            # Health check outside the lock, a dead server can block for a while.
+            key, conn, cursor, checkin_time = candidate
+            if is_alive(conn, cursor):
+                with self.cv:
+                    self.n_reused += 1
+                    self._stop_waiting(wait_start)
+                return conn, cursor
+            logging.info('Discarding stale pooled database connection.')
+            with self.cv:
+                self.n_in_use -= 1
+                self._close(conn)
+
+        try:
+            conn, cursor = factory()
+        except:
+            with self.cv:
+                self.n_open -= 1
+                self.n_in_use -= 1
+                self.cv.notify()
+            raise
+        with self.cv:
+            self.n_created += 1
+        return conn, cursor
+
+    def checkin(self, pool_key, conn, cursor, discard=False):
+        '''Returns a connection to the pool, or closes it if discard is set.'''
+        with self.cv:
+            self.n_in_use = max(0, self.n_in_use - 1)
+            if discard:
+                self._close(conn)
+            else:
+                self.idle.append((pool_key, conn, cursor, time.time()))
+            self._evict_idle()
+            self.cv.notify()
+
+    def close_all(self):
+        '''Closes every idle connection.'''
+        with self.cv:
+            while self.idle:
+                self._close(self.idle.pop()[1])
+
+    def stats(self):
+        '''Returns a dict of pool statistics for sizing the pool.'''
+        with self.cv:
+            return {'max_size': self.max_size,
+                    'open': self.n_open,
+                    'in_use': self.n_in_use,
+                    'idle': len(self.idle),
+                    'created': self.n_created,
+                    'reused': self.n_reused,
+                    'evicted': self.n_evicted,
+                    'waits': self.n_waits,
+                    'wait_time': self.wait_time}
+
+    def _stop_waiting(self, wait_start):
+        if wait_start is not None:
+            self.wait_time += time.time() - wait_start
+
+    def _evict_idle(self):
+        now = time.time()
+        keep = []
+        for entry in self.idle:
+            if now - entry[3] > self.idle_timeout:
+                self._close(entry[1])
+                self.n_evicted += 1
+            else:
+                keep.append(entry)
+        self.idle = keep
+
+    def _close(self, conn):
+        # Caller must hold self.cv
+        self.n_open = max(0, self.n_open - 1)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.cv.notify()
+
+
+class TableSchema(object):
+    '''
+    Column metadata for one table as cached by DBConnect.get_table_schema.
+    names -- column names in table order
+    sqltypes -- SQL type strings, one per column
+    pytypes -- python types (see sqltype_to_pythontype), one per column
+    index -- maps each column name to its position
+    '''
+    def __init__(self, names, sqltypes):
+        self.names = list(names)
+        self.sqltypes = list(sqltypes)
+        self.pytypes = [sqltype_to_pythontype(t or '') for t in self.sqltypes]
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+
+def _normalize_sql(query):
+    '''Collapses whitespace outside of quoted strings and drops a trailing
+    semicolon, so trivially different spellings of a query compare equal.'''
+    query = re.sub(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")|\s+",
+                   lambda m: m.group(1) or ' ', query)
+    return query.strip().rstrip(';').strip()
+
+
+# DDL statements that change the columns of the table they name
+_ddl_table_re = re.compile(r'^\s*(?:CREATE|DROP|ALTER)\s+(?:TEMPORARY\s+)?(?:TABLE|VIEW)\s+'
+                           r'(?:IF\s+(?:NOT\s+)?EXISTS\s+)?[`"]?([\w.]+)', re.IGNORECASE)
+_ddl_rename_re = re.compile(r'^\s*RENAME\s+TABLE\b', re.IGNORECASE)
+# statements that change data, which cached query results may depend on;
+# temporary tables (eg: key tables) are private to a connection
+_write_re = re.compile(r'^\s*(?:INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER|RENAME|TRUNCATE|COPY|LOAD)\b',
+                       re.IGNORECASE)
+_temporary_re = re.compile(r'\bTEMP(?:ORARY)?\b|\btemp\.', re.IGNORECASE)
+# the table a write changes, if it's one of these
+_written_table_re = re.compile(r'^\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?(?:\s+IGNORE)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|'
+                               r'DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?|COPY|'
+                               r'(?:CREATE|DROP|ALTER)(?:\s+OR\s+REPLACE)?\s+(?:TABLE|VIEW)(?:\s+IF\s+(?:NOT\s+)?EXISTS)?)'
+                               r'\s+[`"]?([\w.]+)', re.IGNORECASE)
+# indices don't change what queries return
+_index_re = re.compile(r'^\s*(?:CREATE|DROP)\s+(?:UNIQUE\s+)?INDEX\b', re.IGNORECASE)
+
 
 def _check_colname_user(properties, table, colname):
     if table in [properties.image_table, properties.object_table] and not colname.lower().startswith('user_'):
@@ -279,16 +778,30 @@ def _check_colname_user(properties, table, colname):
 
 class DBConnect(metaclass=Singleton):
     '''
-    DBConnect abstracts calls to MySQLdb/SQLite. It's a singleton that maintains
-    unique connections for each thread that uses it.  These connections are
-    automatically created on "execute", and results are automatically returned
-    as a list.
+    DBConnect abstracts calls to MySQLdb/SQLite. It's a singleton that hands
+    each thread that uses it a connection from a bounded ConnectionPool.
+    Connections are automatically checked out on "execute", and results are
+    automatically returned as a list.
     '''
     def __init__(self):
         self.classifierColNames = None
         self.connections = {}
         self.cursors = {}
         self.connectionInfo = {}
+        self.pool = ConnectionPool()
+        self.poolKeys = {}       # pool key each checked out connection belongs to
+        # guards connections, cursors, poolKeys, connectionInfo and streams,
+        # which every thread's queries update
+        self.connectionsLock = threading.RLock()
+        self.streams = {}        # connID -> its own MySQL connection, while execute_iter streams on it
+        self.threadLocal = threading.local()
+        self.keyTableIds = itertools.count()  # suffixes for temporary key tables
+        self.schemaCache = {}    # (pool key, table name) -> TableSchema
+        self.schemaLock = threading.Lock()
+        self.schemaModifyDate = None  # last value seen by get_objects_modify_date
+        self.queryCache = None   # QueryCache, created on first use of execute_cached
+        self.queryCacheLock = threading.Lock()
+        self.writeCount = 0      # writes run through execute, see execute_cached
         #self.link_cols = {}  # link_cols['table'] = columns that link 'table' to the per-image table
         self.sqlite_classifier = SqliteClassifier()
         self.gui_parent = None
@@ -299,8 +812,8 @@ class DBConnect(metaclass=Singleton):
 
     def connect(self, empty_sqlite_db=False):
         '''
-        Attempts to create a new connection to the specified database using
-          the current thread name as a connection ID.
+        Checks out a connection to the specified database from the connection
+        pool using the current thread name as a connection ID.
         If properties.db_type is 'sqlite', it will create a sqlite db in a
           temporary directory from the csv files specified by
           properties.image_csv_file and properties.object_csv_file
@@ -313,18 +826,17 @@ class DBConnect(metaclass=Singleton):
             if self.connectionInfo[connID] == (p.db_host, p.db_user,
                                                (p.db_passwd or None), p.db_name):
                 logging.warn('A connection already exists for this thread. %s as %s@%s (connID = "%s").'%(p.db_name, p.db_user, p.db_host, connID))
+                self.CloseConnection(connID)
             else:
                 raise DBException('A connection already exists for this thread (%s). Close this connection first.'%(connID,))
 
+        self.pool.configure(max_size=p.db_pool_size or DEFAULT_POOL_SIZE,
+                            idle_timeout=p.db_pool_idle_timeout or DEFAULT_POOL_IDLE_TIMEOUT)
+
         # MySQL database: connect normally
         if p.db_type.lower() == 'mysql':
-            import MySQLdb
-            from MySQLdb.cursors import SSCursor
             try:
-                conn = MySQLdb.connect(host=p.db_host, db=p.db_name,
-                                       user=p.db_user, passwd=(p.db_passwd or None))
-                self.connections[connID] = conn
-                self.cursors[connID] = SSCursor(conn)
+                self._checkout_connection(connID)
                 self.connectionInfo[connID] = (p.db_host, p.db_user,
                                                (p.db_passwd or None), p.db_name)
                 logging.debug('[%s] Connected to database: %s as %s@%s'%(connID, p.db_name, p.db_user, p.db_host))
@@ -338,86 +850,11 @@ class DBConnect(metaclass=Singleton):
 
         # SQLite database: create database from CSVs
         elif p.db_type.lower() == 'sqlite':
-            import sqlite3 as sqlite
-
             if not p.db_sqlite_file:
-                # Compute a UNIQUE database name for these files
-                import hashlib
-                dbpath = os.getenv('USERPROFILE') or os.getenv('HOMEPATH') or \
-                    os.path.expanduser('~')
-                dbpath = os.path.join(dbpath,'CPA')
-                try:
-                    os.listdir(dbpath)
-                except OSError:
-                    os.mkdir(dbpath)
-                if p.db_sql_file:
-                    csv_dir = os.path.split(p.db_sql_file)[0] or '.'
-                    imcsvs, obcsvs = get_csv_filenames_from_sql_file()
-                    files = imcsvs + obcsvs + [os.path.split(p.db_sql_file)[1]]
-                    hash = hashlib.new('md5')
-                    for fname in files:
-                        t = os.stat(csv_dir + os.path.sep + fname).st_mtime
-                        hash_me = f"{fname}{t}".encode()
-                        hash.update(hash_me)
-                    dbname = 'CPA_DB_%s.db'%(hash.hexdigest())
-                else:
-                    imtime = os.stat(p.image_csv_file).st_mtime
-                    obtime = os.stat(p.object_csv_file).st_mtime
-                    l = '%s%s%s%s'%(p.image_csv_file,p.object_csv_file,imtime,obtime)
-                    dbname = 'CPA_DB_%s.db'%(hashlib.md5(l.encode()).hexdigest())
-
-                p.db_sqlite_file = os.path.join(dbpath, dbname)
+                p.db_sqlite_file = self._csv_database_path('.db')
             logging.info('[%s] SQLite file: %s'%(connID, p.db_sqlite_file))
-            self.connections[connID] = sqlite.connect(p.db_sqlite_file)
-            self.connections[connID].text_factory = str
-            self.cursors[connID] = self.connections[connID].cursor()
+            self._checkout_connection(connID)
             self.connectionInfo[connID] = ('sqlite', 'cpa_user', '', 'CPA_DB')
-            self.connections[connID].create_function('greatest', -1, max)
-            # Create MEDIAN function
-            class median:
-                def __init__(self):
-                    self.reset()
-                def reset(self):
-                    self.values = []
-                def step(self, val):
-                    if val is not None:
-                        if not np.isnan(float(val)):
-                            self.values.append(float(val))
-                def finalize(self):
-                    n = len(self.values)
-                    if n == 0:
-                        return None
-                    self.values.sort()
-                    if n%2 == 1:
-                        return self.values[n//2]
-                    else:
-                        return (self.values[n//2-1] + self.values[n//2]) / 2
-            self.connections[connID].create_aggregate('median', 1, median)
-            # Create STDDEV function
-            class stddev:
-                def __init__(self):
-                    self.reset()
-                def reset(self):
-                    self.values = []
-                def step(self, val):
-                    if val is not None:
-                        if not np.isnan(float(val)):
-                            self.values.append(float(val))
-                def finalize(self):
-                    if len(self.values) == 0:
-                        return None
-                    avg = np.mean(self.values)
-                    b = np.sum([(x-avg)**2 for x in self.values])
-                    std = np.sqrt(b/len(self.values))
-                    return std
-            self.connections[connID].create_aggregate('stddev', 1, stddev)
-            # Create REGEXP function
-            def regexp(expr, item):
-                reg = re.compile(expr)
-                return reg.match(item) is not None
-            self.connections[connID].create_function("REGEXP", 2, regexp)
-            # Create classifier function
-            self.connections[connID].create_function('classifier', -1, self.sqlite_classifier.classify)
 
             try:
                 # Try the connection
@@ -453,32 +890,223 @@ class DBConnect(metaclass=Singleton):
                 self.CreateObjectCheckedTable()
             logging.debug('[%s] Connected to database: %s'%(connID, p.db_sqlite_file))
 
+        # DuckDB database: open the file, or build one from the CSV or
+        # Parquet files
+        elif p.db_type.lower() == 'duckdb':
+            if not p.db_duckdb_file:
+                p.db_duckdb_file = self._csv_database_path('.duckdb')
+            logging.info('[%s] DuckDB file: %s'%(connID, p.db_duckdb_file))
+            try:
+                self._checkout_connection(connID)
+            except DBError() as e:
+                raise DBException('Failed to open DuckDB database at %s (connID = "%s").\n  %s'%(p.db_duckdb_file, connID, e))
+            self.connectionInfo[connID] = ('duckdb', 'cpa_user', '', 'CPA_DB')
+
+            if not self.table_exists(p.image_table) and len(self.connections) == 1:
+                if p.db_sql_file or (p.image_csv_file and p.object_csv_file):
+                    logging.info('[%s] Creating DuckDB database at: %s.'%(connID, p.db_duckdb_file))
+                    try:
+                        self.CreateDuckDB()
+                    except Exception as e:
+                        self.Disconnect()
+                        close_duckdb_databases()
+                        for filename in [p.db_duckdb_file, p.db_duckdb_file + '.wal']:
+                            if os.path.isfile(filename):
+                                os.remove(filename)
+                        raise e
+                else:
+                    raise DBException('Database at %s appears to be missing specified tables.'%(p.db_duckdb_file))
+            if p.classification_type == 'image' and connID == "MainThread":
+                self.CreateObjectImageTable()
+            if p.check_tables == 'yes' and connID == "MainThread":
+                self.CreateObjectCheckedTable()
+            logging.debug('[%s] Connected to database: %s'%(connID, p.db_duckdb_file))
+
         # Unknown database type (this should never happen)
         else:
             raise DBException("Unknown db_type in properties: '%s'\n"%(p.db_type))
 
+    def _csv_database_path(self, extension):
+        '''
+        Returns the path in the CPA data directory of the database built from
+        the db_sql_file or image_csv_file/object_csv_file named in the
+        properties. The name is a hash of the input files and their
+        modification times, so the database is rebuilt when they change.
+        '''
+        import hashlib
+        dbpath = cpa_data_dir()
+        if p.db_sql_file:
+            csv_dir = os.path.split(p.db_sql_file)[0] or '.'
+            imcsvs, obcsvs = get_csv_filenames_from_sql_file()
+            files = imcsvs + obcsvs + [os.path.split(p.db_sql_file)[1]]
+            hash = hashlib.new('md5')
+            for fname in files:
+                t = os.stat(csv_dir + os.path.sep + fname).st_mtime
+                hash_me = f"{fname}{t}".encode()
+                hash.update(hash_me)
+            dbname = 'CPA_DB_%s%s'%(hash.hexdigest(), extension)
+        else:
+            imtime = os.stat(p.image_csv_file).st_mtime
+            obtime = os.stat(p.object_csv_file).st_mtime
+            l = '%s%s%s%s'%(p.image_csv_file,p.object_csv_file,imtime,obtime)
+            dbname = 'CPA_DB_%s%s'%(hashlib.md5(l.encode()).hexdigest(), extension)
+        return os.path.join(dbpath, dbname)
+
+    def _database_file(self):
+        '''The database file for SQLite and DuckDB, None for MySQL.'''
+        if p.db_type.lower() == 'duckdb':
+            return p.db_duckdb_file
+        elif p.db_type.lower() == 'sqlite':
+            return p.db_sqlite_file
+        return None
+
+    def _pool_key(self):
+        '''Identifies the database a pooled connection is attached to.'''
+        return (p.db_type.lower(), p.db_host, p.db_user, (p.db_passwd or None),
+                p.db_name, self._database_file())
+
+    def _checkout_connection(self, connID):
+        pool_key = self._pool_key()
+        conn, cursor = self.pool.checkout(pool_key, self._open_connection,
+                                          self._connection_is_alive,
+                                          reclaim=self._reclaim_dead_connections)
+        with self.connectionsLock:
+            self.connections[connID] = conn
+            self.cursors[connID] = cursor
+            self.poolKeys[connID] = pool_key
+        self._release_on_exit(connID, conn)
+
+    def _release_on_exit(self, connID, conn):
+        '''
+        Checks conn back in to the pool when the current thread exits, if it
+        is still the thread's connection then. Replacing the owner of an
+        earlier connection runs its check, which then finds nothing to do.
+        '''
+        if connID != threading.currentThread().getName():
+            return
+        owner = _ThreadOwner()
+        weakref.finalize(owner, self._thread_finished, connID, conn).atexit = False
+        self.threadLocal.owner = owner
+
+    def _thread_finished(self, connID, conn):
+        entry = self._pop_connection(connID, conn)
+        if entry is not None:
+            logging.debug('Checking in the database connection of finished thread "%s".'%(connID))
+            self._checkin(entry)
+
+    def _open_connection(self):
+        '''Opens a new raw connection and cursor for the configured database.'''
+        if p.db_type.lower() == 'mysql':
+            import MySQLdb
+            from MySQLdb.cursors import SSCursor
+            conn = MySQLdb.connect(host=p.db_host, db=p.db_name,
+                                   user=p.db_user, passwd=(p.db_passwd or None))
+            return conn, SSCursor(conn)
+        elif p.db_type.lower() == 'sqlite':
+            import sqlite3 as sqlite
+            # Pooled connections move between threads, but only ever serve
+            # one thread at a time.
+            conn = sqlite.connect(p.db_sqlite_file, check_same_thread=False)
+            conn.text_factory = str
+            register_sqlite_functions(conn)
+            # Create classifier function
+            conn.create_function('classifier', -1, self.sqlite_classifier.classify)
+            return conn, conn.cursor()
+        elif p.db_type.lower() == 'duckdb':
+            conn = duckdb_cursor(p.db_duckdb_file, self._setup_duckdb_database)
+            register_duckdb_functions(conn)
+            # DuckDB connections are also their own cursors
+            return conn, conn
+        else:
+            raise DBException("Unknown db_type in properties: '%s'\n"%(p.db_type))
+
+    def _connection_is_alive(self, conn, cursor):
+        '''Health check used by the pool before reusing an idle connection.'''
+        try:
+            if p.db_type.lower() == 'mysql':
+                conn.ping()
+            else:
+                conn.execute('SELECT 1').fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _reclaim_dead_connections(self):
+        '''
+        Checks in connections still held by threads that have exited without
+        calling CloseConnection. Returns True if any were reclaimed.
+        '''
+        alive = set(t.getName() for t in threading.enumerate())
+        with self.connectionsLock:
+            dead = [self._pop_connection(connID) for connID in list(self.connections.keys())
+                    if connID not in alive]
+        for entry in dead:
+            logging.debug('Reclaiming database connection from finished thread "%s".'%(entry[0]))
+            self._checkin(entry)
+        return len(dead) > 0
+
+    def pool_stats(self):
+        '''Returns connection pool statistics (see ConnectionPool.stats).'''
+        return self.pool.stats()
+
+    def _setup_duckdb_database(self, database):
+        '''Registers the Python functions shared by all connections to a DuckDB database.'''
+        # DuckDB functions have a fixed arity, so the features are passed
+        # to classifier() as a list, eg: classifier([f1, f2, f3])
+        database.create_function('classifier',
+                                 lambda features: self.sqlite_classifier.classify(*features),
+                                 ['DOUBLE[]'], 'BIGINT')
+
     def setup_sqlite_classifier(self, thresh, a, b):
         self.sqlite_classifier.setup_classifier(thresh, a, b)
 
     def Disconnect(self):
         for connID in list(self.connections.keys()):
             self.CloseConnection(connID)
-        self.connections = {}
-        self.cursors = {}
-        self.connectionInfo = {}
+        self.pool.close_all()
+        with self.connectionsLock:
+            self.connections = {}
+            self.cursors = {}
+            self.connectionInfo = {}
+            self.poolKeys = {}
+        self.invalidate_schema_cache()
         self.classifierColNames = None
+        close_duckdb_databases()
+
+    def _pop_connection(self, connID, conn=None):
+        '''
+        Removes the connection of connID, if it has one (and it is conn, if
+        given). Returns (connID, conn, cursor, pool key, connection info)
+        for _checkin, or None.
+        '''
+        with self.connectionsLock:
+            if connID not in self.connections or (conn is not None and self.connections[connID] is not conn):
+                return None
+            return (connID, self.connections.pop(connID), self.cursors.pop(connID, None),
+                    self.poolKeys.pop(connID, None), self.connectionInfo.pop(connID, (None,)*4))
 
-    def CloseConnection(self, connID=None):
+    def _checkin(self, entry, discard=False):
+        # Outside connectionsLock: the pool may call _reclaim_dead_connections
+        # with its own lock held.
+        connID, conn, cursor, pool_key, info = entry
+        try:
+            conn.commit()
+        except: pass
+        self.pool.checkin(pool_key, conn, cursor, discard=discard)
+        (db_host, db_user, db_passwd, db_name) = info
+        logging.info('Closed connection: %s as %s@%s (connID="%s").' % (db_name, db_user, db_host, connID))
+
+    def CloseConnection(self, connID=None, discard=False):
+        '''
+        Commits and checks the connection for connID (default: the current
+        thread) back into the pool. Set discard to close it outright, eg:
+        when the connection is known to be broken.
+        '''
         if not connID:
             connID = threading.currentThread().getName()
-        if connID in self.connections:
-            try:
-                self.connections[connID].commit()
-            except: pass
-            self.cursors.pop(connID)
-            self.connections.pop(connID).close()
-            (db_host, db_user, db_passwd, db_name) = self.connectionInfo.pop(connID)
-            logging.info('Closed connection: %s as %s@%s (connID="%s").' % (db_name, db_user, db_host, connID))
+        entry = self._pop_connection(connID)
+        if entry is not None:
+            self._checkin(entry, discard=discard)
         else:
             logging.warn('No database connection ID "%s" found!' %(connID))
 
@@ -489,14 +1117,13 @@ class DBConnect(metaclass=Singleton):
         the current thread.  Returns the results as a list of rows
         unless return_result is false.
         '''
-        if p.db_type.lower() == 'sqlite':
+        if p.db_type.lower() != 'mysql':
             if args:
-                raise TypeError('Can\'t pass args to sqlite execute!')
+                raise TypeError('Can\'t pass args to %s execute!'%(p.db_type.lower()))
 
         # Grab a new connection if this is a new thread
         connID = threading.currentThread().getName()
-        if not connID in self.connections:
-            self.connect()
+        self._ensure_connection(connID)
 
         try:
             cursor = self.cursors[connID]
@@ -507,11 +1134,13 @@ class DBConnect(metaclass=Singleton):
         try:
             if verbose and not silent:
                 logging.debug('[%s] %s'%(connID, query))
-            if p.db_type.lower() == 'sqlite':
+            if p.db_type.lower() != 'mysql':
                 assert args is None
                 cursor.execute(query)
             else:
                 cursor.execute(query, args=args)
+            self._invalidate_schema_for_ddl(query)
+            self._invalidate_query_cache_for_write(query)
             if return_result:
                 return self._get_results_as_list()
         except Exception as e:
@@ -528,6 +1157,323 @@ class DBConnect(metaclass=Singleton):
                                   '\nFirst exception was: %s'
                                   '\nSecond exception was: %s'%(connID, query, e, e2))
 
+    def _ensure_connection(self, connID):
+        '''Connects this thread, or while execute_iter is streaming on its
+        MySQL connection, checks out a spare one for other queries.'''
+        if connID in self.connections:
+            return
+        if connID in self.streams:
+            self._checkout_connection(connID)
+            with self.connectionsLock:
+                self.connectionInfo[connID] = self.streams[connID][3]
+        else:
+            self.connect()
+
+    def execute_iter(self, query, block_rows=DEFAULT_BLOCK_ROWS, silent=False):
+        '''
+        Executes the given query and yields the results as lists of at most
+        block_rows rows, streaming them from the database rather than
+        fetching the whole result first.
+        On MySQL the rows are read through an unbuffered SSCursor on the
+        current thread's connection. Until the iteration finishes, other
+        queries on the thread check out a spare connection from the pool,
+        which is checked back in afterwards. On SQLite and DuckDB a second
+        cursor on the thread's connection is used.
+        '''
+        connID = threading.currentThread().getName()
+        self._ensure_connection(connID)
+
+        stream = None
+        pooled = None
+        if p.db_type.lower() == 'mysql':
+            from MySQLdb.cursors import SSCursor
+            with self.connectionsLock:
+                if connID not in self.streams:
+                    stream = self._pop_connection(connID)
+                    self.streams[connID] = stream[1:]
+            if stream is None:
+                # nested in another execute_iter on this thread
+                pool_key = self._pool_key()
+                conn, cursor = self.pool.checkout(pool_key, self._open_connection,
+                                                  self._connection_is_alive,
+                                                  reclaim=self._reclaim_dead_connections)
+                pooled = (pool_key, conn, cursor)
+            else:
+                conn = stream[1]
+            cursor = SSCursor(conn)
+        else:
+            cursor = self.connections[connID].cursor()
+            if p.db_type.lower() == 'duckdb':
+                # a new DuckDB connection: needs the macros again
+                register_duckdb_functions(cursor)
+
+        try:
+            if verbose and not silent:
+                logging.debug('[%s] %s'%(connID, query))
+            try:
+                cursor.execute(query)
+            except Exception as e:
+                raise DBException('Database query failed for connection "%s"'
+                                  '\nQuery was: "%s"'
+                                  '\nException was: %s'%(connID, query, e))
+            while True:
+                rows = cursor.fetchmany(block_rows)
+                if not rows:
+                    break
+                yield list(rows)
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+            if pooled is not None:
+                self.pool.checkin(*pooled)
+            if stream is not None:
+                self._end_stream(stream)
+
+    def _end_stream(self, stream):
+        # Gives the thread its own connection back, and checks in the spare
+        # one it used meanwhile, if any.
+        connID, conn, cursor, pool_key, info = stream
+        with self.connectionsLock:
+            del self.streams[connID]
+            spare = self._pop_connection(connID)
+            self.connections[connID] = conn
+            self.cursors[connID] = cursor
+            self.poolKeys[connID] = pool_key
+            self.connectionInfo[connID] = info
+        if spare is not None:
+            self._checkin(spare)
+        self._release_on_exit(connID, conn)
+
+    def fetch_blocks(self, query, block_rows=DEFAULT_BLOCK_ROWS, dtype='f8', silent=False):
+        '''
+        Streams the result of query as contiguous 2-D numpy arrays of at most
+        block_rows rows each (see execute_iter). dtype is typically 'f8' or
+        'i8'; for floating point blocks NULLs and non-numeric values become
+        NaN. Use this to process tables that don't fit in memory.
+        '''
+        for rows in self.execute_iter(query, block_rows=block_rows, silent=silent):
+            yield rows_to_array(rows, dtype)
+
+    def fetch_array(self, query, block_rows=DEFAULT_BLOCK_ROWS, dtype='f8', silent=False):
+        '''
+        Returns the whole result of query as a single 2-D numpy array built
+        from fetch_blocks, without materializing a list of row tuples.
+        '''
+        blocks = list(self.fetch_blocks(query, block_rows=block_rows, dtype=dtype, silent=silent))
+        if len(blocks) == 0:
+            return np.empty((0, 0), dtype=dtype)
+        elif len(blocks) == 1:
+            return blocks[0]
+        return np.concatenate(blocks)
+
+    def execute_cached(self, query, silent=False, column_names=False):
+        '''
+        Executes a read-only query like execute, but if
+        Properties.db_query_cache is enabled the result is looked up in, and
+        saved to, a size-bounded LRU cache kept in memory and under ~/CPA.
+        Entries are keyed on the database, the normalized query text and
+        query_cache_stamp(), so they expire when the data changes, and
+        writes run through execute discard the results that mention the
+        table they change. Nothing is cached when the stamp is unknown.
+        column_names -- if True, return (rows, column names) since
+                        GetResultColumnNames is not valid after a cache hit
+        '''
+        cache = self._query_cache()
+        key = None
+        if cache is not None:
+            try:
+                stamp = self.query_cache_stamp()
+                db_type, host, user, passwd, name, db_file = self._pool_key()
+                if stamp is not None:
+                    key = repr((db_type, host, user, name, db_file,
+                                _normalize_sql(query), stamp))
+            except Exception as e:
+                logging.debug('Not caching query, modify date unavailable: %s'%(e))
+        if key is not None:
+            res = cache.get(key, group=self._query_cache_group())
+            if res is not None:
+                if verbose and not silent:
+                    logging.debug('[cached] %s'%(query))
+                # copy so callers can't modify the cached rows in place
+                rows, names = list(res[0]), list(res[1])
+                return (rows, names) if column_names else rows
+        writes = self.writeCount
+        rows = self.execute(query, silent=silent)
+        names = self.GetResultColumnNames()
+        # a write that ran meanwhile may have cleared the cache after the
+        # query read the old data
+        if key is not None and self.writeCount == writes:
+            cache.put(key, (list(rows), list(names)), group=self._query_cache_group())
+        return (rows, names) if column_names else rows
+
+    def query_cache_stamp(self):
+        '''
+        Returns what execute_cached results are valid for: the modify dates
+        of the image and object tables on MySQL, or the modify times of the
+        database file, its write-ahead log and the Parquet files its tables
+        may be views of on SQLite and DuckDB. Returns None if MySQL doesn't
+        report a table's modify date.
+        '''
+        stamp = [self.get_objects_modify_date()]
+        if p.db_type.lower() == 'mysql':
+            res = self.execute("select UPDATE_TIME from INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME='%s' and TABLE_SCHEMA='%s'"
+                               %(p.image_table, p.db_name), silent=True)
+            stamp.append(res[0][0] if res else None)
+            if None in stamp:
+                return None
+            return tuple(stamp)
+        db_file = self._database_file()
+        files = [db_file + '-wal', db_file + '.wal']
+        files += [f for f in [p.image_csv_file, p.object_csv_file]
+                  if f and f.lower().endswith('.parquet')]
+        for filename in files:
+            try:
+                stamp.append(os.path.getmtime(filename))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _query_cache_group(self):
+        '''Names the query cache group of the current database's results.'''
+        db_type, host, user, passwd, name, db_file = self._pool_key()
+        return hashlib.sha1(repr((db_type, host, user, name, db_file)).encode('utf-8')).hexdigest()[:16]
+
+    def _invalidate_query_cache_for_write(self, query):
+        '''
+        Discards the cached results of the current database that mention the
+        table a write changes, or all of them if the table can't be told.
+        Writes to temporary tables, indices and CPA's record of checked
+        tables don't affect cached results.
+        '''
+        if not _write_re.match(query) or _index_re.match(query) or \
+                _temporary_re.search(query.split('(')[0]):
+            return
+        match = _written_table_re.match(query)
+        table = match.group(1).split('.')[-1] if match else None
+        if table is not None and table.lower() == CHECKED_TABLES_RECORD.lower():
+            return
+        self.writeCount += 1
+        if self.queryCache is not None:
+            if table is None:
+                self.queryCache.discard(self._query_cache_group())
+            else:
+                # a prefix match also catches views named after the table,
+                # like the checked object table
+                mentions = re.compile(r'\b%s'%(re.escape(table)), re.IGNORECASE).search
+                self.queryCache.discard(self._query_cache_group(), mentions)
+
+    def _query_cache(self):
+        if not p.db_query_cache:
+            return None
+        with self.queryCacheLock:
+            if self.queryCache is None:
+                size = p.db_query_cache_size if p.field_defined('db_query_cache_size') else None
+                size = size or DEFAULT_QUERY_CACHE_SIZE
+                try:
+                    directory = cpa_data_dir('query_cache')
+                except OSError as e:
+                    logging.warn('Could not create the query cache directory, caching in memory only: %s'%(e))
+                    directory = None
+                self.queryCache = QueryCache(max_bytes=int(size * 2**20), directory=directory)
+            return self.queryCache
+
+    def query_cache_stats(self):
+        '''Returns the hit/miss counters and sizes of the query result cache.'''
+        if self.queryCache is None:
+            return {}
+        return self.queryCache.stats()
+
+    def clear_query_cache(self):
+        '''Empties the query result cache, including its files on disk.'''
+        if self.queryCache is not None:
+            self.queryCache.clear()
+
+    def key_table_threshold(self):
+        '''Number of keys above which key lists are joined through a
+        temporary table (Properties.db_key_table_threshold).'''
+        threshold = p.db_key_table_threshold if p.field_defined('db_key_table_threshold') else None
+        if threshold is None:
+            return DEFAULT_KEY_TABLE_THRESHOLD
+        return threshold
+
+    @contextmanager
+    def key_table(self, keys, key_columns):
+        '''
+        Context manager that bulk-loads keys into an indexed temporary table
+        on the current thread's connection and yields the table's name. The
+        table has one INT column per name in key_columns and is dropped on
+        exit. Temporary tables are private to the connection, so the table
+        must only be queried from the calling thread.
+        '''
+        connID = threading.currentThread().getName()
+        self._ensure_connection(connID)
+        table = '_cpa_keys_%d'%(next(self.keyTableIds))
+        rows = sorted(set(tuple(int(v) for v in key) for key in keys))
+        placeholder = '%s' if p.db_type.lower() == 'mysql' else '?'
+        self.execute('CREATE TEMPORARY TABLE %s (%s, PRIMARY KEY (%s))'
+                     %(table, ', '.join(['%s INT'%(col) for col in key_columns]),
+                       ', '.join(key_columns)), silent=True)
+        try:
+            try:
+                self.cursors[connID].executemany('INSERT INTO %s VALUES (%s)'
+                                                 %(table, ','.join([placeholder]*len(key_columns))), rows)
+            except Exception as e:
+                raise DBException('Failed to load keys into temporary table "%s"'
+                                  '\nException was: %s'%(table, e))
+            yield table
+        finally:
+            if p.db_type.lower() == 'mysql':
+                self.execute('DROP TEMPORARY TABLE IF EXISTS %s'%(table), silent=True)
+            else:
+                self.execute('DROP TABLE IF EXISTS temp.%s'%(table), silent=True)
+
+    @contextmanager
+    def _key_table_where_clause(self, keys, key_columns, table_name):
+        '''
+        Loads keys into a temporary key table and yields a WHERE clause that
+        semi-joins table_name against it on key_columns.
+        '''
+        with self.key_table(keys, key_columns) as table:
+            if len(key_columns) == 1:
+                yield '%s.%s IN (SELECT %s FROM %s)'%(table_name, key_columns[0], key_columns[0], table)
+            else:
+                yield ('EXISTS (SELECT 1 FROM %s WHERE %s)'
+                       %(table, ' AND '.join(['%s.%s=%s.%s'%(table, col, table_name, col)
+                                              for col in key_columns])))
+
+    @contextmanager
+    def where_clause_for_images(self, imkeys, table_name=None):
+        '''
+        Context manager version of GetWhereClauseForImages for key lists
+        that may be arbitrarily long. Lists longer than key_table_threshold()
+        are loaded into a temporary key table and matched with a semi-join
+        against it, which keeps the statement small and lets the database
+        use the table's index. Use the clause inside the with block.
+        table_name -- the table being filtered (default: the image table)
+        '''
+        table_name = table_name or p.image_table
+        if len(imkeys) <= self.key_table_threshold():
+            yield GetWhereClauseForImages(imkeys, table_name)
+            return
+        with self._key_table_where_clause(imkeys, image_key_columns(), table_name) as where:
+            yield where
+
+    @contextmanager
+    def where_clause_for_objects(self, obkeys, table_name=None):
+        '''
+        Context manager version of GetWhereClauseForObjects for key lists
+        that may be arbitrarily long (see where_clause_for_images).
+        table_name -- the table being filtered (default: the object table)
+        '''
+        table_name = table_name or p.object_table
+        if len(obkeys) <= self.key_table_threshold():
+            yield GetWhereClauseForObjects(obkeys, table_name)
+            return
+        with self._key_table_where_clause(obkeys, object_key_columns(), table_name) as where:
+            yield where
+
     def Commit(self):
         connID = threading.currentThread().getName()
         try:
@@ -558,13 +1504,21 @@ class DBConnect(metaclass=Singleton):
         connID = threading.currentThread().getName()
         return list(self.cursors[connID].fetchall())
 
-    def result_dtype(self):
+    def result_dtype(self, tables=None, rows=None):
         """
         Return an appropriate descriptor for a numpy array in which the
-        result can be stored.
+        result of the last query can be stored.
+        tables -- (SQLite only) tables whose declared column types should be
+                  used to type the result columns. Defaults to the image and
+                  object tables.
+        rows -- (SQLite only) sample rows used to type result columns that
+                have no declared type, eg: aggregates.
         """
-        #XXX: This doesn't work for SQLite... no cursor.description_flags
         cursor = self.cursors[threading.currentThread().getName()]
+        if p.db_type.lower() == 'sqlite':
+            return self._sqlite_result_dtype(cursor, tables, rows)
+        if p.db_type.lower() == 'duckdb':
+            return self._duckdb_result_dtype(cursor)
         descr = []
         for (name, type_code, display_size, internal_size, precision,
              scale, null_ok), flags in zip(cursor.description,
@@ -587,17 +1541,127 @@ class DBConnect(metaclass=Singleton):
             descr.append((name, dtype))
         return descr
 
-    def get_results_as_structured_array(self, n=None):
-        #XXX: this doesn't work for SQLite
-        col_names = self.GetResultColumnNames()
+    def _sqlite_result_dtype(self, cursor, tables=None, rows=None):
+        '''
+        SQLite cursors only describe column names, so result columns are
+        typed from the declared types of the source tables (PRAGMA
+        table_info), falling back to the python types of the sample rows.
+        '''
+        if tables is None:
+            tables = [t for t in [p.image_table, p.object_table] if t]
+        declared = {}
+        for table in tables:
+            for name, sqltype in zip(*self._sqlite_declared_types(table)):
+                declared.setdefault(name.lower(), sqltype)
+
+        descr = []
+        seen = set()
+        for i, col in enumerate(cursor.description):
+            name = col[0]
+            pytype = None
+            if name.lower() in declared:
+                pytype = sqltype_to_pythontype(declared[name.lower()] or '')
+            if pytype is None and rows:
+                values = [row[i] for row in rows if row[i] is not None]
+                if values and all(type(v) == int for v in values):
+                    pytype = int
+                elif values and all(type(v) in (int, float) for v in values):
+                    pytype = float
+                elif values:
+                    pytype = str
+            if pytype == int:
+                dtype = 'i8'
+            elif pytype == str:
+                dtype = 'O'
+            else:
+                dtype = 'f8'
+            # numpy won't accept repeated field names, eg: from a join
+            unique_name = name
+            while unique_name in seen:
+                unique_name += '_'
+            seen.add(unique_name)
+            descr.append((unique_name, dtype))
+        return descr
+
+    def _duckdb_result_dtype(self, cursor):
+        '''DuckDB cursors describe the SQL type of each result column.'''
+        descr = []
+        seen = set()
+        for col in cursor.description:
+            pytype = sqltype_to_pythontype(str(col[1]))
+            if pytype == int:
+                dtype = 'i8'
+            elif pytype == str:
+                dtype = 'O'
+            else:
+                dtype = 'f8'
+            unique_name = col[0]
+            while unique_name in seen:
+                unique_name += '_'
+            seen.add(unique_name)
+            descr.append((unique_name, dtype))
+        return descr
+
+    def _sqlite_declared_types(self, table):
+        '''
+        Returns (column names, declared types) for an SQLite table. The
+        schema is read on a separate cursor so the current result set is
+        left untouched.
+        '''
+        try:
+            schema = self.get_table_schema(table)
+        except DBException:
+            return [], []
+        return schema.names, schema.sqltypes
+
+    def get_results_as_structured_array(self, n=None, nrows=None, tables=None):
+        '''
+        Returns the rest of the last query's result as a numpy structured
+        array. Rows are read with fetchmany in batches of n and copied
+        column by column into a preallocated array.
+        nrows -- expected number of rows (a hint for preallocation)
+        tables -- see result_dtype
+        '''
+        descr, columns, count = self._fetch_result_columns(n, nrows, tables)
+        records = np.empty(count, dtype=descr)
+        for (name, dtype), col in zip(descr, columns):
+            records[name] = col[:count]
+        return records
+
+    def get_results_as_columns(self, n=None, nrows=None, tables=None):
+        '''
+        Columnar version of get_results_as_structured_array. Returns a list
+        of (column name, contiguous 1-D array) pairs.
+        '''
+        descr, columns, count = self._fetch_result_columns(n, nrows, tables)
+        return [(name, col[:count]) for (name, dtype), col in zip(descr, columns)]
+
+    def _fetch_result_columns(self, n=None, nrows=None, tables=None):
         connID = threading.currentThread().getName()
-        records = []
-        while True:
-            r = self.cursors[connID].fetchmany(n)
-            if len(r) == 0:
-                break
-            records.extend(list(r))
-        return np.array(records, dtype=self.result_dtype())
+        cursor = self.cursors[connID]
+        batch = n or DEFAULT_BLOCK_ROWS
+        rows = cursor.fetchmany(batch)
+        descr = self.result_dtype(tables=tables, rows=rows)
+        capacity = max(nrows or 0, len(rows))
+        columns = [np.empty(capacity, dtype=dtype) for name, dtype in descr]
+        count = 0
+        while len(rows) > 0:
+            if count + len(rows) > capacity:
+                capacity = max(2 * capacity, count + len(rows))
+                columns = [np.resize(col, capacity) for col in columns]
+            for i, values in enumerate(zip(*rows)):
+                try:
+                    columns[i][count:count + len(rows)] = values
+                except (TypeError, ValueError):
+                    # NULLs in an integer column or text in a numeric one:
+                    # fall back to float with NaN for unconvertible values.
+                    name, dtype = descr[i]
+                    descr[i] = (name, 'f8')
+                    columns[i] = columns[i].astype('f8')
+                    columns[i][count:count + len(rows)] = rows_to_array([values], 'f8')[0]
+            count += len(rows)
+            rows = cursor.fetchmany(batch)
+        return descr, columns, count
 
     def GetObjectIDAtIndex(self, imKey, index):
         '''
@@ -608,27 +1672,31 @@ class DBConnect(metaclass=Singleton):
         index: a POSITIVE integer (1,2,3...)
         '''
         where_clause = " AND ".join(['%s=%s'%(col, val) for col, val in zip(image_key_columns(), imKey)])
-        object_number = self.execute('SELECT %s FROM %s WHERE %s LIMIT %s,1'
+        object_number = self.execute('SELECT %s FROM %s WHERE %s LIMIT 1 OFFSET %s'
                                      %(p.object_id, p.object_table, where_clause, index - 1))
         object_number = object_number[0][0]
         return tuple(list(imKey)+[int(object_number)])
 
-    def GetRandomObjectsSQL(self, imKeys, N):
+    def GetObjectIDArrays(self, imKeys):
         '''
-        Returns a random sampling of object keys from the database.
-        Sampling occurs without replacement.
-        imKeys: a list of image keys to sample objects from.
-        N: number of keys to sample
+        Returns {imKey: sorted numpy array of object numbers} for the given
+        images, read with one query (see sampling.ObjectIDResolver).
         '''
-        rand = "RANDOM()" if p.db_type.lower() == 'sqlite' else "RAND()"
         if not imKeys:
-            statement = f"SELECT {p.image_id}, {p.object_id} FROM {p.object_table} ORDER BY {rand} LIMIT {N}"
-
-        else:
-            where_clause = GetWhereClauseForImages(imKeys)
-            statement = f"SELECT {p.image_id}, {p.object_id} FROM {p.object_table} WHERE  {where_clause} ORDER BY {rand} LIMIT {N}"
-        object_numbers = self.execute(statement)
-        return object_numbers
+            return {}
+        with self.where_clause_for_images(imKeys, p.object_table) as where_clause:
+            res = self.execute('SELECT %s, %s FROM %s WHERE %s ORDER BY %s, %s'
+                               %(UniqueImageClause(p.object_table), p.object_id, p.object_table,
+                                 where_clause, UniqueImageClause(p.object_table), p.object_id))
+        if not res:
+            return {}
+        data = rows_to_array(res, 'i8')
+        keys = data[:, :-1]
+        # split the rows where the image key changes
+        starts = np.concatenate([[0], np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1])
+        ends = np.concatenate([starts[1:], [len(data)]])
+        return dict((tuple(int(k) for k in keys[s]), data[s:e, -1].copy())
+                    for s, e in zip(starts, ends))
 
     def GetAllObjectsSQL(self, imKeys, N=None):
         '''
@@ -642,10 +1710,11 @@ class DBConnect(metaclass=Singleton):
             limit_clause = f" LIMIT {N}"
         if not imKeys:
             statement = f"SELECT {p.image_id}, {p.object_id} FROM {p.object_table} ORDER BY {p.image_id}{limit_clause}"
+            object_numbers = self.execute(statement)
         else:
-            where_clause = GetWhereClauseForImages(imKeys)
-            statement = f"SELECT {p.image_id}, {p.object_id} FROM {p.object_table} WHERE {where_clause} ORDER BY {p.image_id}{limit_clause}"
-        object_numbers = self.execute(statement)
+            with self.where_clause_for_images(imKeys, p.object_table) as where_clause:
+                statement = f"SELECT {p.image_id}, {p.object_id} FROM {p.object_table} WHERE {where_clause} ORDER BY {p.image_id}{limit_clause}"
+                object_numbers = self.execute(statement)
         return object_numbers
 
     def GetPerImageObjectCounts(self):
@@ -658,19 +1727,41 @@ class DBConnect(metaclass=Singleton):
             return []
 
         select = 'SELECT '+UniqueImageClause(p.object_table)+', COUNT('+p.object_table+'.'+p.object_id + ') FROM '+p.object_table + ' GROUP BY '+UniqueImageClause(p.object_table)
-        result1 = self.execute(select)
+        result1 = self.execute_cached(select)
         select = 'SELECT '+UniqueImageClause(p.image_table)+' FROM '+p.image_table
-        result2 = self.execute(select)
+        result2 = self.execute_cached(select)
 
         counts = {}
         for r in result1:
             counts[r[:-1]] = r[-1]
         return [r+(counts[r],) for r in result2 if r in counts]
 
+    def GetPerImageObjectRanges(self):
+        '''
+        Returns a list of (imKey, obCount, min object number, max object
+        number) tuples for the images present in both the per_image and
+        per_object tables. Images whose object numbers are contiguous have
+        max - min + 1 == obCount.
+        '''
+        if p.object_table is None or p.object_id is None:
+            return []
+
+        obcol = p.object_table+'.'+p.object_id
+        select = ('SELECT '+UniqueImageClause(p.object_table)+', COUNT('+obcol+'), MIN('+obcol+'), MAX('+obcol+') FROM '
+                  +p.object_table+' GROUP BY '+UniqueImageClause(p.object_table))
+        result1 = self.execute_cached(select)
+        select = 'SELECT '+UniqueImageClause(p.image_table)+' FROM '+p.image_table
+        result2 = self.execute_cached(select)
+
+        ranges = {}
+        for r in result1:
+            ranges[r[:-3]] = r[-3:]
+        return [r+tuple(ranges[r]) for r in result2 if r in ranges]
+
     def GetAllImageKeys(self):
         ''' Returns a list of all image keys in the image_table. '''
         select = "SELECT "+UniqueImageClause()+" FROM "+p.image_table+" GROUP BY "+UniqueImageClause()
-        return self.execute(select)
+        return self.execute_cached(select)
 
     def GetObjectsFromImage(self, imKey):
         return self.execute('SELECT %s FROM %s WHERE %s'%(UniqueObjectClause(), p.object_table, GetWhereClauseForImages([imKey])))
@@ -710,17 +1801,19 @@ class DBConnect(metaclass=Singleton):
         '''Returns the specified objects' x, y, (and sometimes) z coordinates in an image.
         '''
         if p.process_3D:
-            res = self.execute('SELECT %s, %s, %s, %s, %s FROM %s WHERE %s'%(
-                        p.image_id, p.object_id, p.cell_x_loc, p.cell_y_loc, p.cell_z_loc, p.object_table,
-                        GetWhereClauseForObjects(obKeys)), silent=silent)
+            with self.where_clause_for_objects(obKeys) as where_clause:
+                res = self.execute('SELECT %s, %s, %s, %s, %s FROM %s WHERE %s'%(
+                            p.image_id, p.object_id, p.cell_x_loc, p.cell_y_loc, p.cell_z_loc, p.object_table,
+                            where_clause), silent=silent)
             reslist = [list(coord) for coord in res] #tuples are immutable so first make tuple of tuples a list of lists
             reslist[0][2]=round(reslist[0][2]) #round to get z slice
             restup = [tuple(coord) for coord in reslist] #then convert back to list of tuples
             res = tuple(restup) #convert to tuple of tuples
         else:
-            res = self.execute('SELECT %s, %s, %s, %s FROM %s WHERE %s'%(
-                        p.image_id, p.object_id, p.cell_x_loc, p.cell_y_loc, p.object_table,
-                        GetWhereClauseForObjects(obKeys)), silent=silent)
+            with self.where_clause_for_objects(obKeys) as where_clause:
+                res = self.execute('SELECT %s, %s, %s, %s FROM %s WHERE %s'%(
+                            p.image_id, p.object_id, p.cell_x_loc, p.cell_y_loc, p.object_table,
+                            where_clause), silent=silent)
         if len(res) == 0 or res[0][0] is None or res[0][1] is None:
             message = ('Failed to load coordinates for object key %s. This may '
                        'indicate a problem with your per-object table.\n'
@@ -739,6 +1832,21 @@ class DBConnect(metaclass=Singleton):
                 buffer.append(res_dict[key])
             return buffer
 
+    def GetObjectCoordsByKey(self, obKeys, silent=False):
+        '''Returns {obKey: (x, y)} for the given objects, fetched with a single
+        query. Keys not found in the object table are left out, and missing
+        coordinates are None.
+        '''
+        obKeys = list(set(tuple(obKey) for obKey in obKeys))
+        if not obKeys:
+            return {}
+        nkey = len(object_key_columns())
+        with self.where_clause_for_objects(obKeys) as where_clause:
+            res = self.execute('SELECT %s, %s, %s FROM %s WHERE %s'%(
+                        UniqueObjectClause(), p.cell_x_loc, p.cell_y_loc, p.object_table,
+                        where_clause), silent=silent)
+        return dict((tuple(row[:nkey]), tuple(row[nkey:])) for row in res)
+
     def GetAllObjectCoordsFromImage(self, imKey, z=None):
         ''' Returns a list of lists x, y, z coordinates for all objects in the given image. '''
         if p.process_3D and z is not None:
@@ -766,14 +1874,33 @@ class DBConnect(metaclass=Singleton):
         '''
         assert len(p.image_path_cols) == len(p.image_file_cols), "Number of image_path_cols and image_file_cols do not match!"
 
-        nChannels = len(p.image_path_cols)
-        select = 'SELECT '
-        for i in range(nChannels):
-            select += p.image_path_cols[i]+', '+p.image_file_cols[i]+', '
-        select = select[:-2] # chop off the last ', '
+        select = 'SELECT '+self._channel_path_columns()
         select += ' FROM '+p.image_table+' WHERE '+GetWhereClauseForImages([imKey])
         imPaths = self.execute(select)[0]
-        # parse filenames out of results
+        return self._channel_paths(imPaths)
+
+    def GetFullChannelPathsForImages(self, imKeys):
+        '''
+        Returns {imKey: list of image channel filenames} for the given images,
+        fetched with a single query. Unknown images are left out.
+        '''
+        assert len(p.image_path_cols) == len(p.image_file_cols), "Number of image_path_cols and image_file_cols do not match!"
+        imKeys = list(set(tuple(imKey) for imKey in imKeys))
+        if not imKeys:
+            return {}
+        nkey = len(image_key_columns())
+        with self.where_clause_for_images(imKeys) as where_clause:
+            res = self.execute('SELECT %s, %s FROM %s WHERE %s'%(
+                        UniqueImageClause(p.image_table), self._channel_path_columns(),
+                        p.image_table, where_clause))
+        return dict((tuple(row[:nkey]), self._channel_paths(row[nkey:])) for row in res)
+
+    def _channel_path_columns(self):
+        return ', '.join(['%s, %s'%(path_col, file_col) for path_col, file_col
+                          in zip(p.image_path_cols, p.image_file_cols)])
+
+    def _channel_paths(self, imPaths):
+        # parse filenames out of (path, file, path, file...) results
         filenames = []
         for i in range(0,len(p.image_path_cols*2),2):
             if p.image_url_prepend:
@@ -816,13 +1943,13 @@ class DBConnect(metaclass=Singleton):
                                                           ','.join(image_key_columns()))
             query = query[:where_idx] + join_clause + query[where_idx:]
         try:
-            res = self.execute(query)
+            res, col_names = self.execute_cached(query, column_names=True)
         except DBException as e:
             raise DBException('Group query failed for group "%s". Check the SQL'
                               ' syntax in your properties file.\n'
                               'Error was: "%s"'%(group, e))
 
-        col_names = self.GetResultColumnNames()[key_size:]
+        col_names = col_names[key_size:]
         from_clause = query[from_idx+6 : where_idx].strip()
         if ',' not in from_clause and ' ' not in from_clause:
             col_names = ['%s.%s'%(from_clause, col) for col in col_names]
@@ -873,7 +2000,7 @@ class DBConnect(metaclass=Singleton):
             f = p._filters[filter_name]
             # New filters can be based on object parameters. We need to remove duplicates.
             # Using dict instead of set preserves key order without additional time cost.
-            imKeys = self.execute(self.filter_sql(filter_name))
+            imKeys = self.execute_cached(self.filter_sql(filter_name))
             return list(dict.fromkeys(imKeys))
         except Exception as e:
             logging.error('Filter query failed for filter "%s". Check the SQL syntax in your properties file.'%(filter_name))
@@ -887,17 +2014,7 @@ class DBConnect(metaclass=Singleton):
         q.select(sqltools.object_cols())
         q.where([filter_obj])
         q.group_by(sqltools.object_cols())
-        if random:
-            if p.db_type.lower() == 'sqlite':
-                query = f"{str(q)} ORDER BY RANDOM()"
-            else:
-                query = f"{str(q)} ORDER BY RAND()"
-        else:
-            query = f"{str(q)} ORDER BY {p.object_table}.{p.image_id}"
-        if N is not None:
-            query += f" LIMIT {N}"
-        keys = self.execute(query)
-        return keys
+        return self._select_object_keys(q, N, random)
 
 
     def GetGatedImages(self, gate_name):
@@ -931,17 +2048,25 @@ class DBConnect(metaclass=Singleton):
         q.select(sqltools.object_cols())
         q.where([p.gates[gate_name]])
         q.group_by(sqltools.object_cols())
-        if random:
-            if p.db_type.lower() == 'sqlite':
-                query = f"{str(q)} ORDER BY RANDOM()"
-            else:
-                query = f"{str(q)} ORDER BY RAND()"
-        else:
+        return self._select_object_keys(q, N, random)
+
+    def _select_object_keys(self, q, N=None, random=True):
+        '''
+        Returns the object keys selected by QueryBuilder q: N of them (or
+        all) drawn at random, or else the first N by image. Random keys are
+        drawn in NumPy from all the matching keys rather than by sorting
+        the matches on RAND() in the database.
+        '''
+        if not random:
             query = f"{str(q)} ORDER BY {p.object_table}.{p.image_id}"
-        if N is not None:
-            query += f" LIMIT {N}"
-        keys = self.execute(query)
-        return keys
+            if N is not None:
+                query += f" LIMIT {N}"
+            return self.execute(query)
+        keys = self.fetch_array(str(q), dtype='i8')
+        if len(keys) == 0:
+            return []
+        keys = keys[draw(len(keys), len(keys) if N is None else N)]
+        return [tuple(int(v) for v in key) for key in keys]
 
     def GetTableNames(self):
         '''
@@ -953,6 +2078,9 @@ class DBConnect(metaclass=Singleton):
         elif p.db_type.lower()=='sqlite':
             res = self.execute('SELECT name FROM sqlite_master WHERE type="table" ORDER BY name')
             return [t[0] for t in res]
+        elif p.db_type.lower()=='duckdb':
+            res = self.execute('SELECT table_name FROM information_schema.tables ORDER BY table_name')
+            return [t[0] for t in res]
 
     def get_other_table_names(self):
         '''
@@ -962,11 +2090,68 @@ class DBConnect(metaclass=Singleton):
                       set([p.image_table, p.object_table]))
         return sorted(tables)
 
+    def get_table_schema(self, table):
+        '''
+        Returns the TableSchema (column names and types) for the given table.
+        Schemas are cached per database and table, and dropped when the table
+        is changed by DDL run through execute (CREATE, ALTER, DROP) or when
+        get_objects_modify_date reports a change.
+        '''
+        key = (self._pool_key(), table.lower())
+        with self.schemaLock:
+            schema = self.schemaCache.get(key, None)
+        if schema is None:
+            schema = TableSchema(*self._load_table_schema(table))
+            with self.schemaLock:
+                self.schemaCache[key] = schema
+        return schema
+
+    def _load_table_schema(self, table):
+        '''Queries the column names and SQL types of a table.'''
+        if p.db_type.lower() in ['sqlite', 'duckdb']:
+            # Read on a separate cursor so a result set that is being read
+            # isn't clobbered (see result_dtype). On DuckDB the thread's
+            # connection is also its cursor, so it needs a cursor of its own.
+            connID = threading.currentThread().getName()
+            self._ensure_connection(connID)
+            conn = self.connections[connID]
+            cursor = conn.cursor() if p.db_type.lower() == 'duckdb' else conn
+            try:
+                res = cursor.execute('PRAGMA table_info(%s)'%(table)).fetchall()
+            except Exception as e:
+                raise DBException('Failed to read the columns of table "%s"'
+                                  '\nException was: %s'%(table, e))
+            finally:
+                if cursor is not conn:
+                    cursor.close()
+            if len(res) == 0:
+                raise DBException('Table "%s" was not found in the database.'%(table))
+            return [r[1] for r in res], [r[2] for r in res]
+        else:
+            res = self.execute('SHOW COLUMNS FROM %s'%(table))
+            return [r[0] for r in res], [r[1] for r in res]
+
+    def invalidate_schema_cache(self, table=None):
+        '''Drops the cached schema of the given table, or of all tables.'''
+        with self.schemaLock:
+            if table is None:
+                self.schemaCache = {}
+            else:
+                for key in [k for k in self.schemaCache if k[1] == table.lower()]:
+                    del self.schemaCache[key]
+
+    def _invalidate_schema_for_ddl(self, query):
+        if not self.schemaCache:
+            return
+        match = _ddl_table_re.match(query)
+        if match:
+            self.invalidate_schema_cache(match.group(1).split('.')[-1])
+        elif _ddl_rename_re.match(query):
+            self.invalidate_schema_cache()
+
     def GetColumnNames(self, table):
         '''Returns a list of the column names for the specified table. '''
-        # NOTE: SQLite doesn't like DESCRIBE or SHOW statements so we do it this way.
-        self.execute('SELECT * FROM %s LIMIT 1'%(table))
-        return self.GetResultColumnNames()   # return the column names
+        return list(self.get_table_schema(table).names)
 
 
 
@@ -995,28 +2180,28 @@ class DBConnect(metaclass=Singleton):
         '''adds src, dest, link, order to link_tables_table.
         '''
         self.execute('INSERT INTO %s (src, dest, link, ord) '
-                     'VALUES ("%s", "%s", "%s", "%d")'
+                     "VALUES ('%s', '%s', '%s', %d)"
                      %(p.link_tables_table, src, dest, link, order))
 
     def _add_link_columns_row(self, src, dest, col1, col2):
         '''adds src, dest, col1, col2 to link_columns_table
         '''
         self.execute('INSERT INTO %s (table1, table2, col1, '
-                     'col2) VALUES ("%s", "%s", "%s", "%s")'
+                     "col2) VALUES ('%s', '%s', '%s', '%s')"
                      %(p.link_columns_table, src, dest, col1, col2))
 
     def connected_tables(self, table):
         '''return tables connected (directly or indirectly) to the given table
         '''
         return [r[0] for r in self.execute('SELECT DISTINCT dest FROM %s '
-                                           'WHERE src="%s"'
+                                           "WHERE src='%s'"
                                            %(p.link_tables_table, table))]
 
     def adjacent_tables(self, table):
         '''return tables directly connected to the given table
         '''
         return [r[0] for r in self.execute('SELECT DISTINCT link FROM %s '
-                                           'WHERE src="%s" AND ord=0'
+                                           "WHERE src='%s' AND ord=0"
                                            %(p.link_tables_table, table))]
 
     def adjacent(self, table1, table2):
@@ -1057,7 +2242,7 @@ class DBConnect(metaclass=Singleton):
         # Connect src to everything dest is connected to through dest
         for t in self.connected_tables(dest):
             self._add_link_tables_row(src, t, dest, 0)
-            res = self.execute('SELECT * FROM %s WHERE src="%s" AND dest="%s"'
+            res = self.execute("SELECT * FROM %s WHERE src='%s' AND dest='%s'"
                                %(p.link_tables_table, dest, t))
             for row in res:
                 link = row[2]
@@ -1126,7 +2311,7 @@ class DBConnect(metaclass=Singleton):
         if p.link_tables_table not in self.GetTableNames():
             return None
         res = self.execute('SELECT link FROM %s '
-                          'WHERE src="%s" AND dest="%s" ORDER BY ord'
+                          "WHERE src='%s' AND dest='%s' ORDER BY ord"
                           %(p.link_tables_table, table_from, table_to))
 
         return [row[0] for row in res] or None
@@ -1158,8 +2343,8 @@ class DBConnect(metaclass=Singleton):
         '''
         if p.link_columns_table not in self.GetTableNames():
             raise Exception('Could not find link_columns table "%s".'%(p.link_columns_table))
-        col_pairs = self.execute('SELECT col1, col2 FROM %s WHERE table1="%s" '
-                                 'AND table2="%s"'%(p.link_columns_table, table_from, table_to))
+        col_pairs = self.execute("SELECT col1, col2 FROM %s WHERE table1='%s' "
+                                 "AND table2='%s'"%(p.link_columns_table, table_from, table_to))
         if len(col_pairs[0]) == 0:
             raise Exception('Tables "%s" and "%s" are not directly linked in '
                             'the database'%(table_from, table_to))
@@ -1189,29 +2374,23 @@ class DBConnect(metaclass=Singleton):
 
     def GetColumnTypes(self, table):
         '''Returns python types for each column of the given table. '''
-        sqltypes = self.GetColumnTypeStrings(table)
-        return [sqltype_to_pythontype(t) for t in sqltypes]
+        return list(self.get_table_schema(table).pytypes)
 
     def GetColumnType(self, table, colname):
         '''Returns the python type for a given table column. '''
-        for col, coltype in zip(self.GetColumnNames(table), self.GetColumnTypes(table)):
-            if col == colname:
-                return coltype
+        schema = self.get_table_schema(table)
+        if colname in schema.index:
+            return schema.pytypes[schema.index[colname]]
 
     def GetColumnTypeStrings(self, table):
         '''Returns the SQL type string for each column of the given table.'''
-        if p.db_type.lower() == 'sqlite':
-            res = self.execute('PRAGMA table_info(%s)'%(table))
-            return [r[2] for r in res]
-        elif p.db_type.lower() == 'mysql':
-            res = self.execute('SHOW COLUMNS FROM %s'%(table))
-            return [r[1] for r in res]
+        return list(self.get_table_schema(table).sqltypes)
 
     def GetColumnTypeString(self, table, colname):
         '''Returns the SQL type string for a given table column. '''
-        for col, coltype in zip(self.GetColumnNames(table), self.GetColumnTypeStrings(table)):
-            if col == colname:
-                return coltype
+        schema = self.get_table_schema(table)
+        if colname in schema.index:
+            return schema.sqltypes[schema.index[colname]]
 
     def GetColnamesForClassifier(self, exclude_features_with_no_variance=False,
                                  force=False):
@@ -1281,16 +2460,19 @@ class DBConnect(metaclass=Singleton):
             self.GetColnamesForClassifier()
         query = 'SELECT %s FROM %s' %(', '.join([p.image_id, p.object_id] + self.classifierColNames), p.object_table)
 
-        data = self.execute(query, silent=False)
-        if len(data) == 0:
+        blocks = []
+        for rows in self.execute_iter(query, silent=False):
+            if len(blocks) == 0:
+                # This should be the case
+                valid_types = (int, float, type(None))
+                if not all([type(x) in valid_types for x in rows[0]]):
+                    raise ValueError("Invalid column types were found in the data. "
+                                     "Only numerical columns can be present in the object table")
+            blocks.append(rows_to_array(rows, float))
+        if len(blocks) == 0:
             logging.error('No data in table')
             return None
-        # This should be the case
-        valid_types = (int, float, type(None))
-        if not all([type(x) in valid_types for x in data[0]]):
-            raise ValueError("Invalid column types were found in the data. "
-                             "Only numerical columns can be present in the object table")
-        return np.array(data, dtype=np.float)
+        return np.concatenate(blocks)
 
     def GetCellData(self, obKey):
         '''
@@ -1309,11 +2491,12 @@ class DBConnect(metaclass=Singleton):
         '''
         Returns a list of measurements for multiple objects.
         '''
-        if p.db_type.lower() == 'mysql':
-            query = f'SELECT {p.image_id}, {p.object_id}, {p.object_table}.* FROM {p.object_table} WHERE {GetWhereClauseForObjects(obKeys)}'
-        else:
-            query = f'SELECT {p.image_id}, {p.object_id}, * FROM {p.object_table} WHERE {GetWhereClauseForObjects(obKeys)}'
-        data = self.execute(query, silent=True)
+        with self.where_clause_for_objects(obKeys) as where_clause:
+            if p.db_type.lower() == 'mysql':
+                query = f'SELECT {p.image_id}, {p.object_id}, {p.object_table}.* FROM {p.object_table} WHERE {where_clause}'
+            else:
+                query = f'SELECT {p.image_id}, {p.object_id}, * FROM {p.object_table} WHERE {where_clause}'
+            data = self.execute(query, silent=True)
         if len(data) == 0:
             logging.error('No data for obKeys: %s'%str(obKeys))
             return None
@@ -1402,7 +2585,7 @@ class DBConnect(metaclass=Singleton):
         if type(value) == str:
             if re.search(r'["\'`]', value):
                 raise ValueError('No quotes are allowed in values written to the database.')
-            value = '"'+value+'"'
+            value = "'"+value+"'"
         if value is None:
             value = 'NULL'
         self.execute('UPDATE %s SET %s=%s WHERE %s'%(table, colname, value,
@@ -1415,85 +2598,71 @@ class DBConnect(metaclass=Singleton):
         Creates an SQLite database from files specified in properties
         image_csv_file and object_csv_file.
         '''
-        import csv
-        # CREATE THE IMAGE TABLE
-        # All the ugly code is to establish the type of each column in the table
-        # so we can form a proper CREATE TABLE statement.
-        f = open(p.image_csv_file, 'U')
-        r = csv.reader(f)
-        columnLabels = next(r)
-        columnLabels = [lbl.strip() for lbl in columnLabels]
-
-        dtable = get_data_table_from_csv_reader(r)
-        colTypes = self.InferColTypesFromData(dtable, len(columnLabels))
-
-        # Build the CREATE TABLE statement
-        statement = 'CREATE TABLE '+p.image_table+' ('
-        statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
-        keys = ','.join([x for x in [p.table_id, p.image_id, p.object_id] if x in columnLabels])
-        statement += ',\nPRIMARY KEY (' + keys + ') )'
-        f.close()
-
-        logging.info('Creating table: %s'%(p.image_table))
-        self.execute('DROP TABLE IF EXISTS %s'%(p.image_table))
-        self.execute(statement)
-
+        from . import ingest
+        tables = [(p.image_table, p.image_csv_file)]
         if not p.classification_type == 'image':
-            # CREATE THE OBJECT TABLE
-            # For the object table we assume that all values are type FLOAT
-            # except for the primary keys
-            f = open(p.object_csv_file, 'U')
-            r = csv.reader(f)
-            columnLabels = next(r)
-            columnLabels = [lbl.strip() for lbl in columnLabels]
-            dtable = get_data_table_from_csv_reader(r)
-            colTypes = self.InferColTypesFromData(dtable, len(columnLabels))
-            statement = 'CREATE TABLE '+p.object_table+' ('
-            statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
-            keys = ','.join([x for x in [p.table_id, p.image_id, p.object_id] if x in columnLabels])
-            statement += ',\nPRIMARY KEY (' + keys + ') )'
-            f.close()
+            tables += [(p.object_table, p.object_csv_file)]
 
-            logging.info('Creating table: %s'%(p.object_table))
-            self.execute('DROP TABLE IF EXISTS '+p.object_table)
+        keys = {}
+        for table, filename in tables:
+            # Column types are inferred from a sample of the rows
+            columnLabels, colTypes = ingest.infer_column_types(filename)
+            statement = 'CREATE TABLE '+table+' ('
+            statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
+            statement += ')'
+            keys[table] = [x for x in [p.table_id, p.image_id, p.object_id] if x in columnLabels]
+            logging.info('Creating table: %s'%(table))
+            self.execute('DROP TABLE IF EXISTS %s'%(table))
             self.execute(statement)
 
-        # POPULATE THE IMAGE TABLE
-        f = open(p.image_csv_file, 'U')
-        r = csv.reader(f)
-        row = next(r) # skip the headers
-        row = next(r)
-        while row:
-            self.execute('INSERT INTO '+p.image_table+' VALUES ('+','.join(["'%s'"%(i) for i in row])+')',
-                         silent=True)
-            try:
-                row = next(r)
-            except StopIteration:
-                break
-        f.close()
+        self._ingest_csvs([(table, [filename], True) for table, filename in tables], keys)
 
-        # POPULATE THE OBJECT TABLE
-        if not p.classification_type == 'image':
-            f = open(p.object_csv_file, 'U')
-            r = csv.reader(f)
-            row = next(r) # skip the headers
-            row = next(r)
-            while row:
-                self.execute('INSERT INTO '+p.object_table+' VALUES ('+','.join(["'%s'"%(i) for i in row])+')',
-                             silent=True)
-                try:
-                    row = next(r)
-                except StopIteration: break
-            f.close()
-
-        self.Commit()
+    def _ingest_csvs(self, loads, keys, dlg=None):
+        '''
+        Bulk loads CSV files into existing tables of the SQLite database in one
+        transaction, then builds the primary key indexes.
+        loads -- list of (table, [csv filenames], files have a header row)
+        keys -- maps table names to the columns of their primary key
+        dlg -- optional wx.ProgressDialog, updated by bytes loaded
+        '''
+        from . import ingest
+        connID = threading.currentThread().getName()
+        conn = self.connections[connID]
+        conn.commit()
+        total_bytes = sum([os.path.getsize(fn) for table, filenames, header in loads for fn in filenames])
+        state = {'base': 0, 'pct': -1}
+
+        def progress(done, total):
+            pct = min(int(100 * (state['base'] + done) / max(total_bytes, 1)), 100)
+            if pct != state['pct']:
+                state['pct'] = pct
+                logging.info("... loaded %d%% of CSV data"%(pct))
+                if dlg:
+                    c, s = dlg.Update(pct, '%d%% Complete'%(pct))
+                    return c
+            return True
+
+        with ingest.bulk_load_pragmas(conn):
+            for table, filenames, header in loads:
+                logging.info('Populating table %s with data from %s'%(table, ', '.join(map(os.path.basename, filenames))))
+                nrows = ingest.load_csv_files(conn, table, filenames, progress=progress, header=header)
+                logging.info('Loaded %d rows into %s'%(nrows, table))
+                state['base'] += sum([os.path.getsize(fn) for fn in filenames])
+            # Indexes are cheaper to build once the data is in place.
+            for table in keys:
+                if keys[table]:
+                    logging.info('Indexing table %s'%(table))
+                    ingest.create_indexes(conn, table, primary_key=keys[table])
+            # Commit only at very end. No use in committing if the db is incomplete.
+            conn.commit()
+        logging.info("Finished loading CSV data")
 
     def CreateSQLiteDBFromCSVs(self):
         '''
         Creates an SQLite database from files generated by CellProfiler's
         ExportToDatabase module.
         '''
-        import csv
+        from . import ingest
 
         imcsvs, obcsvs = get_csv_filenames_from_sql_file()
 
@@ -1508,122 +2677,111 @@ class DBConnect(metaclass=Singleton):
                               'Make sure db_sql_file in your properties file is'
                               ' set to the .SQL file output by CellProfiler\'s '
                               'ExportToDatabase module.'%(os.path.split(p.db_sql_file)[1]))
+        if not p.classification_type == 'image':
+            assert len(obcsvs)>0, ('Failed to parse object csv filenames from %s. '
+                              'Make sure db_sql_file in your properties file is'
+                              ' set to the .SQL file output by CellProfiler\'s '
+                              'ExportToDatabase module.'%(os.path.split(p.db_sql_file)[1]))
 
         # parse out create table statements and execute them
-        f = open(p.db_sql_file)
-        lines = f.readlines()
-        create_stmts = []
-        i=0
-        in_create_stmt = False
-        for l in lines:
-            if l.upper().startswith('CREATE TABLE') or in_create_stmt:
-                if in_create_stmt:
-                    create_stmts[i] += l
-                else:
-                    create_stmts.append(l)
-                if l.strip().endswith(';'):
-                    in_create_stmt = False
-                    i+=1
-                else:
-                    in_create_stmt = True
-        f.close()
+        create_stmts = get_create_statements_from_sql_file()
 
+        # Primary keys are indexed after the data is loaded
+        keys = {}
         for q in create_stmts:
+            q, key = ingest.split_primary_key(q)
+            match = re.match(r'\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[`"]?(\w+)', q, re.IGNORECASE)
+            if match:
+                keys[match.group(1)] = key
             self.execute(q)
 
-        import wx
-        if self.gui_parent is not None and issubclass(self.gui_parent.__class__, wx.Window):
-            dlg = wx.ProgressDialog('Creating sqlite DB...', '0% Complete', 100, self.gui_parent, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
-        else:
-            dlg = None
-
-        # find the number of bytes we're going to read
-        total_bytes = 0
-        for file in imcsvs + obcsvs:
-            total_bytes += os.path.getsize(os.path.join(csv_dir, file))
-        total_bytes = float(total_bytes)
+        dlg = None
+        if self.gui_parent is not None:
+            import wx
+            if issubclass(self.gui_parent.__class__, wx.Window):
+                dlg = wx.ProgressDialog('Creating sqlite DB...', '0% Complete', 100, self.gui_parent, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
 
-        base_bytes = 0
-        connID = threading.currentThread().getName()
-        # populate tables with contents of csv files
-        for file in imcsvs:
-            logging.info('Populating image table with data from %s'%file)
-            f = open(os.path.join(csv_dir, file), 'U')
-            r = csv.reader(f)
-            row1 = next(r)
-            command = 'INSERT INTO '+p.image_table+' VALUES ('+','.join(['?' for i in row1])+')'
-            self.cursors[connID].execute(command, row1)
-            self.cursors[connID].executemany(command, [l for l in r if len(l)>0])
-            f.close()
-            base_bytes += os.path.getsize(os.path.join(csv_dir, file))
-            pct = min(int(100 * base_bytes / total_bytes), 100)
-            if dlg:
-                c, s = dlg.Update(pct, '%d%% Complete'%(pct))
-                if not c:
-                    try:
-                        os.remove(p.db_sqlite_file)
-                    except OSError:
-                        wx.MessageBox('Could not remove incomplete database'
-                                      ' at "%s". This file must be removed '
-                                      'manually or CPAnalyst will load it '
-                                      'the next time use use the current '
-                                      'database settings.', 'Error')
-                    raise Exception('cancelled load')
-            logging.info("... loaded %d%% of CSV data"%(pct))
-
-        line_count = 0
+        object_table = p.object_table
+        if p.check_tables:
+            object_table = object_table.split('_checked')[0]
+        loads = [(p.image_table, [os.path.join(csv_dir, file) for file in imcsvs], False)]
         if not p.classification_type == 'image':
-            assert len(obcsvs)>0, ('Failed to parse object csv filenames from %s. '
-                              'Make sure db_sql_file in your properties file is'
-                              ' set to the .SQL file output by CellProfiler\'s '
-                              'ExportToDatabase module.'%(os.path.split(p.db_sql_file)[1]))
+            loads += [(object_table, [os.path.join(csv_dir, file) for file in obcsvs], False)]
+        try:
+            self._ingest_csvs(loads, keys, dlg)
+        except ingest.IngestCancelled:
+            try:
+                os.remove(p.db_sqlite_file)
+            except OSError:
+                import wx
+                wx.MessageBox('Could not remove incomplete database'
+                              ' at "%s". This file must be removed '
+                              'manually or CPAnalyst will load it '
+                              'the next time use use the current '
+                              'database settings.', 'Error')
+            raise Exception('cancelled load')
+        finally:
+            if dlg:
+                dlg.Destroy()
 
-            for file in obcsvs:
-                logging.info('Populating object table with data from %s'%file)
-                f = open(csv_dir+os.path.sep+file, 'U')
-                r = csv.reader(f)
-                row1 = next(r)
-                if p.check_tables:
-                    object_table = p.object_table
-                    object_table = object_table.split('_checked')[0]
-                    command = 'INSERT INTO '+object_table+' VALUES ('+','.join(['?' for i in row1])+')'
-                else:
-                    command = 'INSERT INTO '+p.object_table+' VALUES ('+','.join(['?' for i in row1])+')'
-                # guess at a good number of lines, about 250 megabytes, assuming floats)
-                nlines = (250*1024*1024) // (len(row1) * 64)
-                self.cursors[connID].execute(command, row1)
-                lnum = 1
-                while True:
-                    lnum += 1
-                    # fetch a certain number of lines efficiently
-                    args = [l for idx, l in zip(list(range(nlines)), r) if len(l) > 0]
-                    if args == []:
-                        break
-                    self.cursors[connID].executemany(command, args)
-                    line_count += len(args)
-                    prog = line_count
-                    # pct = min(int(100 * (f.tell() + base_bytes) / total_bytes), 100)
-                    if dlg:
-                        c, s = dlg.Update(prog, '%d lines loaded'%(prog))
-                        if not c:
-                            try:
-                                os.remove(p.db_sqlite_file)
-                            except OSError:
-                                wx.MessageBox('Could not remove incomplete database'
-                                              ' at "%s". This file must be removed '
-                                              'manually or CPAnalyst will load it '
-                                              'the next time use use the current '
-                                              'database settings.', 'Error')
-                            raise Exception('cancelled load')
-                    logging.info("... loaded %d lines of CSV data"%(prog))
-                f.close()
-                logging.info("Finished loading CSV data")
-                base_bytes += os.path.getsize(os.path.join(csv_dir, file))
-
-        # Commit only at very end. No use in committing if the db is incomplete.
+    def CreateDuckDB(self):
+        '''
+        Creates a DuckDB database from the db_sql_file, or the image_csv_file
+        and object_csv_file specified in properties. CSV files are imported
+        by DuckDB's parallel CSV reader. Parquet files are not copied: their
+        tables are views that scan the files.
+        '''
+        from . import ingest
+        connID = threading.currentThread().getName()
+        object_table = p.object_table.split('_checked')[0]
+        nulls = "['\\N', 'NULL', '']"
+
+        def quote(filename):
+            return "'%s'"%(os.path.abspath(filename).replace("'", "''"))
+
+        keys = {}
+        if p.db_sql_file:
+            imcsvs, obcsvs = get_csv_filenames_from_sql_file()
+            csv_dir = os.path.split(p.db_sql_file)[0] or '.'
+            assert len(imcsvs)>0, ('Failed to parse image csv filenames from %s. '
+                                  'Make sure db_sql_file in your properties file is'
+                                  ' set to the .SQL file output by CellProfiler\'s '
+                                  'ExportToDatabase module.'%(os.path.split(p.db_sql_file)[1]))
+            # Primary keys are indexed after the data is loaded
+            for q in get_create_statements_from_sql_file():
+                q, key = ingest.split_primary_key(q)
+                match = re.match(r'\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[`"]?(\w+)', q, re.IGNORECASE)
+                if match:
+                    keys[match.group(1)] = key
+                self.execute(q)
+            loads = [(p.image_table, imcsvs)]
+            if not p.classification_type == 'image':
+                loads += [(object_table, obcsvs)]
+            for table, files in loads:
+                for file in files:
+                    logging.info('Populating table %s with data from %s'%(table, file))
+                    self.execute("COPY %s FROM %s (FORMAT csv, HEADER false, NULLSTR %s)"
+                                 %(table, quote(os.path.join(csv_dir, file)), nulls))
+        else:
+            tables = [(p.image_table, p.image_csv_file)]
+            if not p.classification_type == 'image':
+                tables += [(object_table, p.object_csv_file)]
+            for table, filename in tables:
+                if filename.lower().endswith('.parquet'):
+                    logging.info('Creating view %s of %s'%(table, filename))
+                    self.execute('CREATE OR REPLACE VIEW %s AS SELECT * FROM read_parquet(%s)'%(table, quote(filename)))
+                    continue
+                logging.info('Populating table %s with data from %s'%(table, filename))
+                self.execute('CREATE OR REPLACE TABLE %s AS SELECT * FROM read_csv_auto(%s, header=true, nullstr=%s)'
+                             %(table, quote(filename), nulls))
+                columns = self.GetColumnNames(table)
+                keys[table] = [x for x in [p.table_id, p.image_id, p.object_id] if x in columns]
+        for table in keys:
+            if keys[table]:
+                logging.info('Indexing table %s'%(table))
+                ingest.create_indexes(self.connections[connID], table, primary_key=keys[table])
         self.Commit()
-        if dlg:
-            dlg.Destroy()
+        logging.info("Finished loading data")
 
     def GetImageWidthHeight(self,list_of_cols):
         # Get image width and height
@@ -1646,19 +2804,39 @@ class DBConnect(metaclass=Singleton):
 
     def CreateObjectCheckedTable(self):
         # Create object (checked) table where there are no rows with missing/null values
-        DB_NAME = p.db_name
         DB_TYPE = p.db_type.lower()
 
         object_table = p.object_table
         object_table = object_table.split('_checked')[0]
 
-        # Try to get a quick count of how many table rows we started with.
+        # Skip the rebuild if the source table hasn't changed since the
+        # checked table was last built.
         try:
-            query = f"SELECT COUNT(*) FROM {object_table}"
-            initial_count = self.execute(query)[0][0]
-        except:
-            logging.error("Unable to count table rows")
-            initial_count = 0
+            fingerprint = self._checked_table_fingerprint(object_table)
+            record = self._checked_table_record(p.object_table)
+        except Exception as e:
+            logging.error("Unable to fingerprint the object table: %s"%(e))
+            fingerprint = record = None
+        if record is not None and self.table_exists(p.object_table):
+            if all(record[k] == fingerprint[k] for k in fingerprint):
+                logging.info(f"Checked table {p.object_table} is up to date")
+                self._finish_checked_table(object_table, record['row_count'], record['checked_rows'])
+                return
+            if p.check_tables_incremental and DB_TYPE == 'sqlite' and \
+                    self._append_to_checked_table(object_table, record, fingerprint):
+                self._finish_checked_table(object_table, fingerprint['row_count'])
+                return
+
+        # Try to get a quick count of how many table rows we started with.
+        if fingerprint is not None:
+            initial_count = fingerprint['row_count']
+        else:
+            try:
+                query = f"SELECT COUNT(*) FROM {object_table}"
+                initial_count = self.execute(query)[0][0]
+            except:
+                logging.error("Unable to count table rows")
+                initial_count = 0
 
         all_cols = [str(x) for x in self.GetColumnNames(object_table)]
 
@@ -1678,7 +2856,7 @@ class DBConnect(metaclass=Singleton):
             logging.info(f"Table checking dropped {len(empty_cols)} blank columns")
 
         AreaShape_Area = [x for x in all_cols if 'AreaShape_Area' in x]
-        if DB_TYPE == 'mysql':
+        if DB_TYPE in ['mysql', 'duckdb']:
             if len(AreaShape_Area) > 0:
                 query = f"""CREATE OR REPLACE VIEW {p.object_table} AS SELECT {', '.join(all_cols)} FROM {object_table}
                 WHERE {" IS NOT NULL AND ".join(all_cols)} IS NOT NULL AND {" > 0 AND ".join(AreaShape_Area)} > 0"""
@@ -1687,32 +2865,164 @@ class DBConnect(metaclass=Singleton):
                 WHERE {" IS NOT NULL AND ".join(all_cols)} IS NOT NULL"""
             self.execute(query)
         elif DB_TYPE == 'sqlite':
-            # SQL can only handle 1000 comparisons in a query. If we have too many columns we'll need to break it up.
-            col_buffer = [all_cols[i:i + 400] for i in range(0, len(all_cols), 400)]
-            # Do the largest chunk first, it'll reduce work later on.
-            to_test = col_buffer.pop(0)
-
-            query = f"PRAGMA table_info({object_table})"
-            self.execute(query)
             query = f'DROP TABLE IF EXISTS {p.object_table}'
             self.execute(query)
-            if len(AreaShape_Area) > 0:
-                query = f"""CREATE TABLE {p.object_table} AS SELECT {', '.join(all_cols)} FROM {object_table} WHERE {
-                " IS NOT NULL AND ".join(to_test)} IS NOT NULL AND {" != '' AND ".join(to_test)}  != '' AND {
-                " > 0 AND ".join(AreaShape_Area)} > 0"""
-            else:
-                query = f"""CREATE TABLE {p.object_table} AS SELECT {', '.join(all_cols)} FROM {object_table} WHERE {
-                " IS NOT NULL AND ".join(to_test)} IS NOT NULL AND {" != '' AND ".join(to_test)}  != ''"""
+            self._fill_checked_table(object_table, all_cols)
+        self.Commit()
+        if fingerprint is not None:
+            try:
+                self._save_checked_table_record(p.object_table, object_table, fingerprint)
+            except Exception as e:
+                logging.error("Unable to record the checked table's source: %s"%(e))
+        self._finish_checked_table(object_table, initial_count)
+
+    def _fill_checked_table(self, object_table, cols, where=None):
+        '''
+        Copies the rows of object_table that have no missing values in cols
+        (and positive areas) into the SQLite checked table, creating it if it
+        doesn't exist. where optionally restricts the rows that are copied.
+        '''
+        def complete(chunk):
+            return f"""{" IS NOT NULL AND ".join(chunk)} IS NOT NULL AND {" != '' AND ".join(chunk)} != ''"""
+
+        AreaShape_Area = [x for x in cols if 'AreaShape_Area' in x]
+        # SQL can only handle 1000 comparisons in a query. If we have too many columns we'll need to break it up.
+        col_buffer = [cols[i:i + 400] for i in range(0, len(cols), 400)]
+        # Do the largest chunk first, it'll reduce work later on.
+        conditions = [complete(col_buffer.pop(0))]
+        if len(AreaShape_Area) > 0:
+            conditions += [f"""{" > 0 AND ".join(AreaShape_Area)} > 0"""]
+        if where is not None:
+            conditions += [where]
+        if self.table_exists(p.object_table):
+            query = f"""INSERT INTO {p.object_table} ({', '.join(cols)}) SELECT {', '.join(cols)} FROM {object_table}
+            WHERE {" AND ".join(conditions)}"""
+        else:
+            query = f"""CREATE TABLE {p.object_table} AS SELECT {', '.join(cols)} FROM {object_table}
+            WHERE {" AND ".join(conditions)}"""
+        self.execute(query)
+        # Then remove the copied rows that are missing values in the other columns.
+        for chunk in col_buffer:
+            query = f"DELETE FROM {p.object_table} WHERE NOT ({complete(chunk)})"
+            if where is not None:
+                query += f" AND {where}"
             self.execute(query)
-            for chunk in col_buffer:
-                query = f"""DELETE FROM {p.object_table} WHERE {
-                " IS NOT NULL AND ".join(chunk)} IS NOT NULL AND {" != '' AND ".join(chunk)}  != ''"""
-                self.execute(query)
+
+    def _checked_table_fingerprint(self, object_table):
+        '''
+        Describes the table a checked table is built from: its row count,
+        image number range, columns and a change signal: on MySQL its update
+        time, on SQLite a sample of its rows (see _table_sample_signature).
+        DuckDB's checked table is a view, which is never out of date.
+        '''
+        count, max_image = self.execute(f"SELECT COUNT(*), MAX({p.image_id}) FROM {object_table}")[0]
+        schema = self.get_table_schema(object_table)
+        columns = ','.join(['%s %s'%(col, typ) for col, typ in zip(schema.names, schema.sqltypes)])
+        modified = None
+        if p.db_type.lower() == 'mysql':
+            modified = self.execute("SELECT UPDATE_TIME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME='%s' AND TABLE_SCHEMA='%s'"%(object_table, p.db_name))[0][0]
+        elif p.db_type.lower() == 'sqlite':
+            modified = self._table_sample_signature(object_table)
+        return {'row_count': int(count),
+                'max_image': None if max_image is None else int(max_image),
+                'columns': hashlib.sha1(columns.encode('utf-8')).hexdigest(),
+                'modified': '' if modified is None else str(modified)}
+
+    def _table_sample_signature(self, table, rowids=None, where=None):
+        '''
+        Returns "first:last:digest": the first and last rowid of a SQLite
+        table and a digest of every value of up to CHECKED_TABLE_SAMPLE_ROWS
+        rows spread evenly between them. Rows added or deleted change it, but
+        it reads only the sampled rows, so values edited in place are only
+        noticed in those rows.
+        rowids -- (first, last) rowid to sample between instead of the table's
+        where -- only sample the rows matching this condition
+        '''
+        if rowids is None:
+            rowids = self.execute(f"SELECT (SELECT MIN(rowid) FROM {table}), (SELECT MAX(rowid) FROM {table})")[0]
+        first, last = rowids
+        if first is None:
+            return ''
+        n = CHECKED_TABLE_SAMPLE_ROWS
+        sample = sorted(set([first + (last - first) * i // max(1, n - 1) for i in range(n)]))
+        query = f"SELECT * FROM {table} WHERE rowid IN ({','.join(map(str, sample))})"
+        if where is not None:
+            query += f" AND ({where})"
+        rows = self.execute(query + " ORDER BY rowid")
+        return '%d:%d:%s'%(first, last, hashlib.sha1(repr(rows).encode('utf-8')).hexdigest())
+
+    def _checked_table_record(self, checked_table):
+        '''Returns the fingerprint and row count saved when checked_table was
+        last built, or None.'''
+        if not self.table_exists(CHECKED_TABLES_RECORD):
+            return None
+        res = self.execute("SELECT row_count, max_image, columns, modified, checked_rows FROM %s "
+                           "WHERE checked_table='%s'"%(CHECKED_TABLES_RECORD, checked_table))
+        if len(res) == 0:
+            return None
+        row_count, max_image, columns, modified, checked_rows = res[0]
+        return {'row_count': int(row_count),
+                'max_image': None if max_image is None else int(max_image),
+                'columns': columns, 'modified': modified or '',
+                'checked_rows': int(checked_rows)}
+
+    def _save_checked_table_record(self, checked_table, object_table, fingerprint):
+        if not self.table_exists(CHECKED_TABLES_RECORD):
+            self.execute("CREATE TABLE %s (checked_table VARCHAR(255), source_table VARCHAR(255), "
+                         "row_count BIGINT, max_image BIGINT, columns VARCHAR(64), modified VARCHAR(64), "
+                         "checked_rows BIGINT)"%(CHECKED_TABLES_RECORD))
+        checked_rows = self.execute(f"SELECT COUNT(*) FROM {checked_table}")[0][0]
+        self.execute("DELETE FROM %s WHERE checked_table='%s'"%(CHECKED_TABLES_RECORD, checked_table))
+        self.execute("INSERT INTO %s VALUES ('%s', '%s', %d, %s, '%s', '%s', %d)"
+                     %(CHECKED_TABLES_RECORD, checked_table, object_table, fingerprint['row_count'],
+                       'NULL' if fingerprint['max_image'] is None else fingerprint['max_image'],
+                       fingerprint['columns'], fingerprint['modified'], checked_rows))
+        self.Commit()
+
+    def _append_to_checked_table(self, object_table, record, fingerprint):
+        '''
+        Brings a checked table up to date by copying only the rows of images
+        numbered above the highest image number it was built from. Returns
+        False without changing anything if the object table changed in any
+        other way, or has a table_id, in which case the checked table must
+        be rebuilt.
+        '''
+        if record['columns'] != fingerprint['columns'] or record['max_image'] is None or \
+                fingerprint['max_image'] is None or fingerprint['max_image'] <= record['max_image']:
+            return False
+        if p.table_id:
+            # new images may be numbered from 1 again under another table
+            # number, so image numbers don't tell old rows from new ones
+            return False
+        # the rows that were there before must all still be there, unchanged
+        where = f"{p.image_id} > {record['max_image']}"
+        old_rows = self.execute(f"SELECT COUNT(*) FROM {object_table} WHERE NOT ({where})")[0][0]
+        if old_rows != record['row_count']:
+            return False
+        try:
+            first, last = [int(v) for v in record['modified'].split(':')[:2]]
+        except ValueError:
+            return False
+        if record['modified'] != self._table_sample_signature(object_table, (first, last), f"NOT ({where})"):
+            return False
+        logging.info(f"Appending images after {record['max_image']} to checked table {p.object_table}")
+        self._fill_checked_table(object_table, [str(x) for x in self.GetColumnNames(p.object_table)], where)
         self.Commit()
+        self._save_checked_table_record(p.object_table, object_table, fingerprint)
+        return True
+
+    def _finish_checked_table(self, object_table, initial_count, checked_count=None):
+        '''
+        Reports how many rows table checking removed, offers to fall back to
+        the unchecked table if that was most of them, and links the checked
+        table to the image table.
+        '''
         # Inform user of what we did. Also check whether we nuked the table.
         try:
-            query = f"SELECT COUNT(*) FROM {p.object_table}"
-            res = self.execute(query)[0][0]
+            res = checked_count
+            if res is None:
+                query = f"SELECT COUNT(*) FROM {p.object_table}"
+                res = self.execute(query)[0][0]
             if res == 0:
                 logging.error("Table checking removed all rows, you may have an empty column in your database. "
                               "Disable check_tables in your properties file if this is expected.")
@@ -1745,9 +3055,8 @@ class DBConnect(metaclass=Singleton):
         # Create object table for image classification
         DB_NAME = p.db_name
         DB_TYPE = p.db_type.lower()
-        if DB_TYPE == 'mysql':
-            query = "SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = '%s' AND TABLE_NAME = '%s'"%(DB_NAME, p.image_table)
-            self.execute(query)
+        object_table = p.object_table
+        if DB_TYPE in ['mysql', 'duckdb']:
             list_of_cols = []
             cols = [x for x in self.GetColumnNames(p.image_table)]
             list_of_cols.extend([str(x) for x in cols])
@@ -1797,6 +3106,8 @@ class DBConnect(metaclass=Singleton):
         res = []
         if p.db_type.lower() == 'mysql':
             res = self.execute("SELECT table_name FROM information_schema.tables WHERE table_name='%s' AND table_schema='%s'"%(name, p.db_name))
+        elif p.db_type.lower() == 'duckdb':
+            res = self.execute("SELECT table_name FROM information_schema.tables WHERE table_name='%s'"%(name))
         else:
             res = self.execute("SELECT name FROM sqlite_master WHERE type='table' and name='%s'"%(name))
             res += self.execute("SELECT name FROM sqlite_temp_master WHERE type='table' and name='%s'"%(name))
@@ -1860,7 +3171,7 @@ class DBConnect(metaclass=Singleton):
                     or val is None):
                     vals += ['NULL']
                 else:
-                    vals += ['"%s"'%val]
+                    vals += ["'%s'"%(str(val).replace("'", "''"))]
             vals = ', '.join(vals)
             self.execute('INSERT INTO %s (%s) VALUES (%s)'%(
                           tablename, ', '.join(colnames), vals), silent=True)
@@ -1892,6 +3203,9 @@ class DBConnect(metaclass=Singleton):
     def is_view(self, table):
         if p.db_type == 'sqlite':
             return False
+        if p.db_type == 'duckdb':
+            res = self.execute("SELECT table_type FROM information_schema.tables WHERE table_name='%s'"%(table))
+            return len(res) > 0 and res[0][0] == 'VIEW'
         self.execute('SHOW CREATE TABLE %s'%(table))
         res = self.GetResultColumnNames()
         return res[0].lower() == 'view'
@@ -1901,12 +3215,15 @@ class DBConnect(metaclass=Singleton):
         Queries the DB to check that the per_image and per_object
         tables agree on image numbers.
         '''
-        if p.db_type=='sqlite':
-            logging.warn('Skipping table checking step for sqlite')
+        if p.db_type == 'sqlite':
+            logging.warn('Skipping table checking step for %s'%(p.db_type))
             return
 
         logging.info('Checking database tables...')
-        if not self.is_view(p.image_table):
+        # DuckDB scans columns with zone maps instead of indices, so only
+        # MySQL tables are checked for them.
+        check_indices = p.db_type == 'mysql'
+        if check_indices and not self.is_view(p.image_table):
             # For now, don't check indices on views.
             # Check for index on image_table
             res = self.execute('SHOW INDEX FROM %s'%(p.image_table))
@@ -1921,7 +3238,7 @@ class DBConnect(metaclass=Singleton):
                         'properties file.'%(col, p.object_table),
                         'Missing column index',
                         style=wx.OK|wx.ICON_EXCLAMATION).ShowModal()
-        else:
+        elif check_indices:
             logging.warn('%s is a view. CheckTables will skip the index check on this table'%(p.image_table))
 
         # Explicitly check for TableNumber in case it was not specified in props file
@@ -1932,7 +3249,7 @@ class DBConnect(metaclass=Singleton):
         if not p.object_table:
             return
 
-        if not self.is_view(p.object_table):
+        if check_indices and not self.is_view(p.object_table):
             # Check for index on object_table
             res = self.execute('SHOW INDEX FROM %s'%(p.object_table))
             idx_cols = [r[4] for r in res]
@@ -1946,7 +3263,7 @@ class DBConnect(metaclass=Singleton):
                         'properties file.'%(col, p.object_table),
                         'Missing column index',
                         style=wx.OK|wx.ICON_EXCLAMATION).ShowModal()
-        else:
+        elif check_indices:
             logging.warn('%s is a view. CheckTables will skip the index check on this table'%(p.object_table))
 
         # Explicitly check for TableNumber in case it was not specified in props file
@@ -1967,13 +3284,13 @@ class DBConnect(metaclass=Singleton):
 
         # Check for unlabeled wells
         if p.well_id:
-            res = self.execute('SELECT %s FROM %s WHERE %s IS NULL OR %s=""'%(UniqueImageClause(), p.image_table, p.well_id, p.well_id))
+            res = self.execute('SELECT %s FROM %s WHERE %s IS NULL OR CAST(%s AS CHAR)=\'\''%(UniqueImageClause(), p.image_table, p.well_id, p.well_id))
             if any(res):
                 logging.warn('WARNING: Images were found in "%s" that had a NULL or empty "%s" column value'%(p.image_table, p.well_id))
 
         # Check for unlabeled plates
         if p.plate_id:
-            res = self.execute('SELECT %s FROM %s WHERE %s IS NULL OR %s=""'%(UniqueImageClause(), p.image_table, p.plate_id, p.plate_id))
+            res = self.execute('SELECT %s FROM %s WHERE %s IS NULL OR CAST(%s AS CHAR)=\'\''%(UniqueImageClause(), p.image_table, p.plate_id, p.plate_id))
             if any(res):
                 logging.warn('WARNING: Images were found in "%s" that had a NULL or empty "%s" column value'%(p.image_table, p.plate_id))
         logging.info('Done checking database tables.')
@@ -2017,9 +3334,14 @@ class DBConnect(metaclass=Singleton):
 
     def get_objects_modify_date(self):
         if p.db_type.lower() == 'mysql':
-            return self.execute("select UPDATE_TIME from INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME='%s' and TABLE_SCHEMA='%s'"%(p.object_table, p.db_name))[0][0]
+            date = self.execute("select UPDATE_TIME from INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME='%s' and TABLE_SCHEMA='%s'"%(p.object_table, p.db_name))[0][0]
         else:
-            return os.path.getmtime(p.db_sqlite_file)
+            date = os.path.getmtime(self._database_file())
+        if date != self.schemaModifyDate:
+            # the database was changed behind our back, columns may differ
+            self.invalidate_schema_cache()
+            self.schemaModifyDate = date
+        return date
 
     def verify_objects_modify_date_earlier(self, later):
         cur = self.get_objects_modify_date()
@@ -2047,7 +3369,11 @@ class Entity(object):
             return self.length
 
         def structured_array(self):
-            return self.db.get_results_as_structured_array()
+            return self.db.get_results_as_structured_array(nrows=self.length)
+
+        def columns_arrays(self):
+            """Returns the results as a list of (column name, array) pairs."""
+            return self.db.get_results_as_columns(nrows=self.length)
 
         def sample(self, n):
             """
@@ -313,6 +313,10 @@ class ReduxPanel(FigureCanvasWxAgg):
         dlg.Pulse("Writing to database")
         if p.db_type.lower() == "sqlite":
             scores.to_sql(PCA_TABLE, conn, if_exists="replace", index=False)
+        elif p.db_type.lower() == "duckdb":
+            conn.register("_pca_scores", scores)
+            conn.execute(f"CREATE OR REPLACE TABLE {PCA_TABLE} AS SELECT * FROM _pca_scores")
+            conn.unregister("_pca_scores")
         else:
             # MySQLClient not supported by pandas to_sql.
             csvbuffer = StringIO()
@@ -0,0 +1,256 @@
+'''
+Byte-bounded LRU caches for decoded images, used by imagetools.FetchImage,
+and for rendered bitmaps, used by imagetools.MergeToBitmap.
+Images evicted from memory can optionally be spilled, compressed, to a
+temporary directory on local disk, which is also bounded in size.
+'''
+import atexit
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def image_nbytes(channels):
+    '''Returns the memory used by an image's list of channel arrays.'''
+    return sum([np.asarray(c).nbytes for c in channels])
+
+
+class ImageCache(object):
+    '''
+    Maps keys to images (lists of channel arrays). The memory tier holds at
+    most max_bytes of arrays and evicts its least recently used images
+    first. If spill_bytes is set, evicted images are written to a
+    compressed file in a private temporary directory, up to spill_bytes of
+    files, and read back on a later hit. Cached arrays are shared with
+    callers and must not be modified.
+    '''
+    def __init__(self, max_bytes, spill_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()   # key -> (channels, nbytes)
+        self.memory_bytes = 0
+        self.disk = OrderedDict()     # key -> (file name, nchannels, file size), oldest first
+        self.disk_bytes = 0
+        self.directory = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.memory or key in self.disk
+
+    def __len__(self):
+        with self.lock:
+            return len(self.memory)
+
+    def get(self, key, default=None):
+        '''Returns the cached image for key, or default on a miss.'''
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key][0]
+            if key not in self.disk:
+                self.misses += 1
+                return default
+            name, nchannels, size = self.disk[key]
+            self.disk.move_to_end(key)
+        channels = self._read(name, nchannels)
+        with self.lock:
+            if channels is None:
+                self._remove_file(key)
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.disk_hits += 1
+            evicted = self._put_memory(key, channels)
+        self._spill(evicted)
+        return channels
+
+    def put(self, key, channels):
+        '''Caches an image under key, replacing any previous image.'''
+        channels = list(channels)
+        with self.lock:
+            self._remove_file(key)
+            evicted = self._put_memory(key, channels)
+        self._spill(evicted)
+
+    def discard(self, key):
+        '''Removes key from both tiers.'''
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= self.memory.pop(key)[1]
+            self._remove_file(key)
+
+    def _put_memory(self, key, channels):
+        # Caller must hold self.lock. Returns the evicted (key, channels).
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[1]
+        nbytes = image_nbytes(channels)
+        if nbytes > self.max_bytes:
+            return []
+        self.memory[key] = (channels, nbytes)
+        self.memory_bytes += nbytes
+        evicted = []
+        while self.memory_bytes > self.max_bytes:
+            old_key, (old_channels, old_nbytes) = self.memory.popitem(last=False)
+            self.memory_bytes -= old_nbytes
+            self.evictions += 1
+            evicted.append((old_key, old_channels))
+        return evicted
+
+    def _spill(self, evicted):
+        '''Writes evicted images to the disk tier (without holding the lock).'''
+        if not self.spill_bytes:
+            return
+        for key, channels in evicted:
+            with self.lock:
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                    continue
+                directory = self._spill_directory()
+            if directory is None:
+                return
+            name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npz'
+            path = os.path.join(directory, name)
+            try:
+                np.savez_compressed(path, *channels)
+                size = os.path.getsize(path)
+            except (OSError, ValueError) as e:
+                logging.warn('Failed to spill image %s to "%s": %s'%(key, path, e))
+                continue
+            with self.lock:
+                if key in self.disk:
+                    continue
+                if size > self.spill_bytes or key in self.memory:
+                    # too big to keep, or cached again while being written
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                self.disk[key] = (name, len(channels), size)
+                self.disk_bytes += size
+                while self.disk_bytes > self.spill_bytes:
+                    self._remove_file(next(iter(self.disk)))
+
+    def _spill_directory(self):
+        # Caller must hold self.lock
+        if self.directory is None:
+            try:
+                self.directory = tempfile.mkdtemp(prefix='cpa_images_')
+            except OSError as e:
+                logging.warn('Could not create an image spill directory, caching in memory only: %s'%(e))
+                self.spill_bytes = 0
+                return None
+            atexit.register(shutil.rmtree, self.directory, True)
+        return self.directory
+
+    def _read(self, name, nchannels):
+        try:
+            with np.load(os.path.join(self.directory, name), allow_pickle=False) as f:
+                return [f['arr_%d'%(i)] for i in range(nchannels)]
+        except Exception as e:
+            logging.warn('Failed to read spilled image "%s": %s'%(name, e))
+            return None
+
+    def _remove_file(self, key):
+        # Caller must hold self.lock
+        if key not in self.disk:
+            return
+        name, nchannels, size = self.disk.pop(key)
+        self.disk_bytes -= size
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def clear(self):
+        '''Empties both tiers, deleting the spilled files.'''
+        with self.lock:
+            self.memory = OrderedDict()
+            self.memory_bytes = 0
+            for key in list(self.disk):
+                self._remove_file(key)
+
+    def stats(self):
+        '''Returns a dict of hit/miss/eviction counters and tier sizes.'''
+        with self.lock:
+            return {'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'memory_entries': len(self.memory),
+                    'memory_bytes': self.memory_bytes,
+                    'disk_entries': len(self.disk),
+                    'disk_bytes': self.disk_bytes}
+
+
+class BitmapCache(object):
+    '''
+    Maps keys to rendered bitmaps (or any other objects whose size the
+    caller gives), holding at most max_bytes and evicting the least
+    recently used entries first.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # key -> (bitmap, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key, default=None):
+        '''Returns the cached bitmap for key, or default on a miss.'''
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def put(self, key, bitmap, nbytes):
+        '''Caches a bitmap of nbytes bytes under key.'''
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self.entries[key] = (bitmap, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self.entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.nbytes = 0
+
+    def stats(self):
+        '''Returns a dict of hit/miss/eviction counters and the cache size.'''
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'bytes': self.nbytes}
@@ -203,8 +203,8 @@ class ImageControlPanel(wx.Panel):
         from cpa.imageviewer import ImageViewerPanel
         for listener in self.listeners:
             if isinstance(listener, ImageViewerPanel):
-                client_h, client_w = listener.GetParent().GetSize()
-                img_w, img_h = listener.images[0].shape
+                client_h, client_w = listener.GetClientSize()
+                img_w, img_h = listener.ImageShape()
                 scale = min(client_w / img_w, client_h / img_h)
                 listener.SetScale(scale)
                 break
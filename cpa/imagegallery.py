@@ -16,6 +16,7 @@ from .properties import Properties
 from . import tilecollection
 from . import icons
 from . import dbconnect
+from . import imagepanel
 from . import imagetools
 from . import sortbin
 import os
@@ -980,17 +981,17 @@ class ImageGallery(wx.Frame):
     def SetBrightness(self, brightness):
         ''' Updates the global image brightness across all tiles. '''
         self.brightness = brightness
-        [t.SetBrightness(brightness) for bin in self.all_sort_bins() for t in bin.tiles]
+        imagepanel.UpdateBitmaps([t for bin in self.all_sort_bins() for t in bin.tiles], brightness=brightness)
 
     def SetScale(self, scale):
         ''' Updates the global image scaling across all tiles. '''
         self.scale = scale
-        [t.SetScale(scale) for bin in self.all_sort_bins() for t in bin.tiles]
+        imagepanel.UpdateBitmaps([t for bin in self.all_sort_bins() for t in bin.tiles], scale=scale)
         [bin.UpdateSizer() for bin in self.all_sort_bins()]
 
     def SetContrastMode(self, mode):
         self.contrast = mode
-        [t.SetContrastMode(mode) for bin in self.all_sort_bins() for t in bin.tiles]
+        imagepanel.UpdateBitmaps([t for bin in self.all_sort_bins() for t in bin.tiles], contrast=mode)
 
     def PostMessage(self, message):
         ''' Updates the status bar text and logs to info. '''
@@ -1,5 +1,6 @@
 import wx
 from . import imagetools
+from . import viewport
 from .properties import Properties
 
 p = Properties()
@@ -9,6 +10,8 @@ class ImagePanel(wx.Panel):
     ImagePanels are wxPanels that display a wxBitmap and store multiple
     image channels which can be recombined to mix different bitmaps.
     '''
+    window_class = wx.Panel
+
     def __init__(self, images, channel_map, parent, 
                  scale=1.0, brightness=1.0, contrast=None, display_whole_image=False):
         """
@@ -23,30 +26,30 @@ class ImagePanel(wx.Panel):
         self.chMap       = channel_map
         self.toggleChMap = channel_map[:]
         self.images      = images
+        self.scale         = scale
+        self.brightness    = brightness
+        self.contrast      = contrast
+        self.display_whole_image = display_whole_image
 
         # Displayed bitmap
-        self.bitmap      = imagetools.MergeToBitmap(images,
-                               chMap = channel_map,
-                               scale = scale,
-                               brightness = brightness,
-                               contrast = contrast,
-                               display_whole_image = display_whole_image)
+        self.InitDisplay()
         
         max_size = 1000
-        sizex = min(max_size, self.bitmap.Size[0])
-        sizey = min(max_size, self.bitmap.Size[1])
-        wx.Panel.__init__(self, parent, wx.NewId(), size=(sizex, sizey))
+        width, height = self.DisplaySize()
+        sizex = min(max_size, width)
+        sizey = min(max_size, height)
+        self.window_class.__init__(self, parent, wx.NewId(), size=(sizex, sizey))
         
-        self.scale         = scale
-        self.brightness    = brightness
-        self.contrast      = contrast
         self.selected      = False
-        self.display_whole_image = display_whole_image
         
         self.Bind(wx.EVT_PAINT, self.OnPaint)
+
+    def InitDisplay(self):
+        self.bitmap      = self.MakeBitmap()
         
     def OnPaint(self, evt):
-        self.SetClientSize((self.bitmap.Width, self.bitmap.Height))
+        width, height = self.DisplaySize()
+        self.SetClientSize((width, height))
         dc = wx.PaintDC(self)
         dc.Clear()
         dc.DrawBitmap(self.bitmap, 0, 0)
@@ -54,16 +57,28 @@ class ImagePanel(wx.Panel):
         if self.selected:
             dc.SetPen(wx.Pen("WHITE",1))
             dc.SetBrush(wx.Brush("WHITE", style=wx.TRANSPARENT))
-            dc.DrawRectangle(0,0,self.bitmap.Width,self.bitmap.Height)
+            dc.DrawRectangle(0,0,width,height)
         return dc
 
+    def DisplaySize(self):
+        ''' Returns the (width, height) the image is drawn at. '''
+        return self.bitmap.Width, self.bitmap.Height
+
+    def MakeBitmap(self):
+        ''' Renders the images with the current display settings. '''
+        return imagetools.MergeToBitmap(self.images,
+                                        chMap = self.chMap,
+                                        brightness = self.brightness,
+                                        scale = self.scale,
+                                        contrast = self.contrast,
+                                        display_whole_image = self.display_whole_image)
+
+    def ImageShape(self):
+        ''' Returns the (height, width) of the images at full size. '''
+        return self.images[0].shape
+
     def UpdateBitmap(self):
-        self.bitmap = imagetools.MergeToBitmap(self.images,
-                                               chMap = self.chMap,
-                                               brightness = self.brightness,
-                                               scale = self.scale,
-                                               contrast = self.contrast,
-                                               display_whole_image = self.display_whole_image)
+        self.bitmap = self.MakeBitmap()
         self.Refresh()
         self.Update()
             
@@ -77,7 +92,7 @@ class ImagePanel(wx.Panel):
         if scale != self.scale:
             self.scale = scale
             self.UpdateBitmap()
-            self.SetClientSize((self.bitmap.Width, self.bitmap.Height))
+            self.SetClientSize(self.DisplaySize())
 
     def SetBrightness(self, brightness):
         if brightness != self.brightness:
@@ -89,3 +104,124 @@ class ImagePanel(wx.Panel):
         self.UpdateBitmap()
 
 
+class TiledImagePanel(ImagePanel, wx.ScrolledWindow):
+    '''
+    An ImagePanel for images too large to render whole, eg: in ImageViewer.
+    The panel is a viewport of its own size that scrolls over the displayed
+    image, so no window is ever as large as the image (X11 and GDI windows
+    can't be larger than 32767 pixels). Only the tiles in view are rendered,
+    as they're needed (see viewport).
+    '''
+    window_class = wx.ScrolledWindow
+    scroll_rate = 16
+
+    def __init__(self, images, channel_map, parent,
+                 scale=1.0, brightness=1.0, contrast=None):
+        super(TiledImagePanel, self).__init__(images, channel_map, parent, scale, brightness,
+                                              contrast=contrast, display_whole_image=True)
+        self.SetScrollRate(self.scroll_rate, self.scroll_rate)
+        self.SetVirtualSize(self.DisplaySize())
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
+
+    def InitDisplay(self):
+        # The renderer of the displayed tiles
+        self.bitmap       = None
+        self.tile_bitmaps = {}   # tile key -> wx.Bitmap of the tiles last drawn
+        self.viewport     = viewport.TileRenderer(self.TileSource(), self.OnTileRendered)
+
+    def OnPaint(self, evt):
+        dc = wx.PaintDC(self)
+        # draw in displayed image coordinates
+        self.DoPrepareDC(dc)
+        dc.Clear()
+        self.DrawTiles(dc)
+        return dc
+
+    def DrawTiles(self, dc):
+        ''' Draws the rendered tiles in view and asks for the rest. '''
+        bitmaps = {}
+        for x, y, key, rgb in self.viewport.request(self.VisibleRect(), self.scale, self.DisplaySettings()):
+            bitmap = self.tile_bitmaps.get(key)
+            if bitmap is None:
+                bitmap = wx.Bitmap.FromBuffer(rgb.shape[1], rgb.shape[0], rgb.tobytes())
+            bitmaps[key] = bitmap
+            dc.DrawBitmap(bitmap, x, y)
+        self.tile_bitmaps = bitmaps
+
+    def VisibleRect(self):
+        ''' Returns the (x, y, width, height) of the part of the displayed
+        image scrolled into view. '''
+        x, y = self.CalcUnscrolledPosition(0, 0)
+        width, height = self.GetClientSize()
+        return (x, y, width, height)
+
+    def DisplaySettings(self):
+        ''' Returns the settings tiles are rendered with, see viewport. '''
+        return (tuple(self.chMap), self.brightness, self.contrast,
+                tuple(imagetools.BlendModes(len(self.chMap))))
+
+    def TileSource(self):
+        ''' Returns the images to draw tiles from, see viewport. '''
+        return viewport.ArraySource(self.images, [imagetools.ChannelLimits(im) for im in self.images])
+
+    def OnTileRendered(self, key):
+        # Called from the rendering thread
+        wx.CallAfter(self.RefreshTile, key)
+
+    def RefreshTile(self, key):
+        if self:
+            x, y, width, height = self.viewport.tile_rect(key)
+            x, y = self.CalcScrolledPosition(x, y)
+            self.RefreshRect(wx.Rect(x, y, width, height), eraseBackground=False)
+
+    def OnDestroy(self, evt):
+        if evt.GetEventObject() is self:
+            self.viewport.close()
+        evt.Skip()
+
+    def DisplaySize(self):
+        height, width = viewport.display_shape(self.ImageShape(), self.scale)
+        return width, height
+
+    def UpdateBitmap(self):
+        self.Refresh()
+        self.Update()
+
+    def SetScale(self, scale):
+        ''' Zooms, keeping the middle of the view in place. '''
+        if scale != self.scale:
+            x, y, width, height = self.VisibleRect()
+            mx, my = (x + width / 2.) / self.scale, (y + height / 2.) / self.scale
+            self.scale = scale
+            self.SetVirtualSize(self.DisplaySize())
+            self.Scroll(max(0, int(mx * scale - width / 2.)) // self.scroll_rate,
+                        max(0, int(my * scale - height / 2.)) // self.scroll_rate)
+            self.UpdateBitmap()
+
+
+
+
+def UpdateBitmaps(panels, **settings):
+    '''
+    Applies display settings (scale, brightness and/or contrast) to many
+    ImagePanels and redraws them. Object tiles that share a shape and
+    settings are rendered together with imagetools.MergeToBitmaps.
+    '''
+    groups = {}
+    for panel in panels:
+        for name, value in settings.items():
+            setattr(panel, name, value)
+        if panel.display_whole_image or panel.images is None:
+            panel.UpdateBitmap()
+            continue
+        key = (tuple(panel.chMap), panel.brightness, panel.scale, panel.contrast,
+               tuple(im.shape for im in panel.images))
+        groups.setdefault(key, []).append(panel)
+    for (chMap, brightness, scale, contrast, shapes), group in groups.items():
+        bitmaps = imagetools.MergeToBitmaps([panel.images for panel in group], list(chMap),
+                                            brightness=brightness, scale=scale, contrast=contrast)
+        for panel, bitmap in zip(group, bitmaps):
+            panel.bitmap = bitmap
+            if 'scale' in settings:
+                panel.SetClientSize((bitmap.Width, bitmap.Height))
+            panel.Refresh()
@@ -7,9 +7,14 @@ import bioformats
 import javabridge
 from .properties import Properties
 from .errors import ClearException
+from . import tiffregion
+from .stackreader import open_stack, BioformatsStack
 
 p = Properties()
 IMAGEIO_FORMATS = (".tif", ".tiff", ".bmp", ".gif", ".png", ".jpeg")
+REGION_FORMATS = (".tif", ".tiff")
+# Images whose regions cover more than this fraction of them are read whole
+REGION_MAX_FRACTION = 0.25
 
 class ThrowingURLopener(urllib.request.URLopener):
     def http_error_default(*args, **kwargs):
@@ -19,6 +24,8 @@ class ImageReader(object):
 
     def ReadImages(self, fds, log_io=True, z=None):
         '''fds -- list of file descriptors (filenames or urls)
+        z -- with process_3D, the z slice to read, "mid" for the middle
+             slice, or "max" or "mean" for a projection of the stack
         returns a list of channels as numpy float32 arrays
         '''
         channels = []
@@ -42,6 +49,36 @@ class ImageReader(object):
 
         return channels
 
+    def ReadRegions(self, fds, boxes, log_io=True):
+        '''fds -- list of file descriptors (filenames or urls)
+        boxes -- list of (x0, y0, x1, y1) regions of the image
+        returns a list of channels as numpy arrays for each box, clipped to
+        the image, reading only the part of each file the boxes cover (see
+        tiffregion). Returns None if the image must be read whole instead:
+        it isn't a local TIFF, its channels need rescaling, or the boxes
+        cover much of it.
+        '''
+        if p.force_bioformats or p.process_3D or p.image_rescale:
+            return None
+        regions = [[] for box in boxes]
+        shape = None
+        for i, filename in enumerate(fds):
+            if (os.path.splitext(filename)[-1].lower() not in REGION_FORMATS or
+                    (p.image_url_prepend and urllib.parse.urlparse(p.image_url_prepend + filename).scheme)):
+                return None
+            if log_io:
+                logging.info('TiffFile: Loading %d regions from "%s"' % (len(boxes), filename))
+            result = tiffregion.read_regions(filename, boxes, REGION_MAX_FRACTION)
+            if result is None or shape not in (None, result[0]):
+                # channels of different sizes are rescaled by ReadImages
+                return None
+            shape = result[0]
+            for region, crop in zip(regions, result[1]):
+                region += self._extract_channels(filename, crop,
+                                                 p.image_names[i],
+                                                 int(p.channels_per_image[i]))
+        return regions
+
     def _read_image(self, filename_or_url, log_io=True, z=None):
         if p.image_url_prepend:
             parsed = urllib.parse.urlparse(p.image_url_prepend + filename_or_url)
@@ -61,10 +98,8 @@ class ImageReader(object):
                 logging.info('ImageIO: Loading image from "%s"' % filename_or_url)
             try:
                 if p.process_3D and z is not None:
-                    if z == "mid":
-                        image = imageio.mimread(filename_or_url, memtest=False)
-                        z = round(len(image)/2)
-                    return imageio.mimread(filename_or_url, memtest=False)[z]
+                    with open_stack(filename_or_url) as stack:
+                        return stack.plane(z)
                 else:
                     return imageio.imread(filename_or_url)
             except FileNotFoundError:
@@ -80,7 +115,8 @@ class ImageReader(object):
             logging.info('BioFormats: Loading image from "%s"' % filename_or_url)
         try:
             if p.process_3D and z is not None:
-                return bioformats.load_image(filename_or_url, rescale=False, z=z)
+                with BioformatsStack(filename_or_url) as stack:
+                    return stack.plane(z)
             else:
                 return bioformats.load_image(filename_or_url, rescale=False)
         except FileNotFoundError:
@@ -7,25 +7,56 @@ from . import pilfix
 from .properties import Properties
 from . import dbconnect
 from .imagereader import ImageReader
+from .imagecache import ImageCache, BitmapCache
+from . import render
+from .tilestore import TileStore, LimitStore, image_mtime
+from .pyramid import Pyramid, prune as prune_pyramids
+from .util import cpa_data_dir
+import hashlib
 import logging
+import os
 import scipy.ndimage
 import numpy as np
+import threading
+import weakref
 import wx
 
 p = Properties()
 db = dbconnect.DBConnect()
 
-cache = {}
-cachedkeys = []
+# Default bounds (MB) on the decoded image cache and its disk spill tier
+# (Properties.image_cache_size and image_cache_spill_size)
+DEFAULT_IMAGE_CACHE_SIZE = 1024
+DEFAULT_IMAGE_SPILL_SIZE = 0
+# Default bound (MB) on the rendered bitmap cache (Properties.bitmap_cache_size)
+DEFAULT_BITMAP_CACHE_SIZE = 256
+# Default size (pixels) from which ImageViewer uses image pyramids
+# (Properties.image_pyramid_size)
+DEFAULT_PYRAMID_SIZE = 4096
+# Default bound (MB) on the disk space of image pyramids
+# (Properties.image_pyramid_disk_size)
+DEFAULT_PYRAMID_DISK_SIZE = 4096
 
-cachedparams = None
-cachedresult = None
+cache = None    # ImageCache of decoded images, see image_cache()
+cache_lock = threading.Lock()
+
+tile_stores = {}  # TileStores by project and tile settings, see tile_store()
+limit_store = None   # LimitStore of decoded images' channel ranges, see image_limits()
+
+bitmaps = None  # BitmapCache of rendered tiles and images, see bitmap_cache()
+
+# id(channel array) -> (weak reference to the array, value), for values
+# computed once from arrays that are not modified afterwards, see _memo()
+channel_limits = {}   # (min, max) of decoded channels, see ChannelLimits()
+channel_digests = {}  # content hashes, see ChannelDigest()
 
 def FetchTile(obKey, display_whole_image=False, z=None):
     '''returns a list of image channel arrays cropped around the object
     coordinates
     '''
     imKey = obKey[:-1]
+    if not p.process_3D and not display_whole_image:
+        return FetchTiles([obKey])[0]
     # Could transform object coords here
     if p.process_3D and not display_whole_image:
         pos = list(db.GetObjectCoords(obKey))
@@ -38,68 +69,334 @@ def FetchTile(obKey, display_whole_image=False, z=None):
         else:
             z=pos[2]
     elif p.process_3D and display_whole_image:
-        z="mid"
+        z = p.image_z_projection or "mid"
 
     imgs = FetchImage(imKey, z=z)
     if imgs is None:
         # Loading failed, return gracefully.
         return
 
-    size = (int(p.image_size),int(p.image_size))
     if display_whole_image:
         return imgs
 
     else:
-        size = (int(p.image_tile_size), int(p.image_tile_size))
         if not p.process_3D: 
             pos = list(db.GetObjectCoords(obKey))
-        if None in pos:
-            message = ('Failed to load coordinates for object key %s. This may '
-                       'indicate a problem with your per-object table.\n'
-                       'You can check your per-object table "%s" in TableViewer'
-                       %(', '.join(['%s:%s'%(col, val) for col, val in
-                                    zip(dbconnect.object_key_columns(), obKey)]),
-                       p.object_table))
-            wx.MessageBox(message, 'Error')
-            logging.error(message)
-            return None
+        return CropObject(obKey, imgs, pos)
+
+def FetchTiles(obKeys, display_whole_image=False):
+    '''returns the tiles of a list of objects, like FetchTile, in the same
+    order (None where loading failed). The channel paths of all the images
+    and the coordinates of all the objects are each fetched with one query,
+    and each source image is read once and all of its objects are cropped
+    from it together.
+    '''
+    if p.process_3D:
+        # objects of the same image may lie in different z planes
+        return [FetchTile(obKey, display_whole_image=display_whole_image) for obKey in obKeys]
+    tiles = [None] * len(obKeys)
+    by_image = {}
+    for i, obKey in enumerate(obKeys):
+        by_image.setdefault(tuple(obKey[:-1]), []).append(i)
+    paths = db.GetFullChannelPathsForImages(list(by_image))
+    store = None if display_whole_image else tile_store()
+    mtimes = {}
+    if store is not None:
+        # use the stored tiles, if their image hasn't changed since
+        for imKey, indexes in by_image.items():
+            mtimes[imKey] = image_mtime(paths.get(imKey, []))
+            for i in indexes:
+                tiles[i] = store.get(obKeys[i], mtimes[imKey])
+            by_image[imKey] = [i for i in indexes if tiles[i] is None]
+    if not display_whole_image:
+        coords = db.GetObjectCoordsByKey([obKeys[i] for indexes in by_image.values() for i in indexes])
+    for imKey, indexes in by_image.items():
+        if not indexes:
+            continue
+        if display_whole_image:
+            imgs = FetchImage(imKey, filenames=paths.get(imKey, None))
+            for i in indexes:
+                tiles[i] = imgs
+            continue
+        keys = [tuple(obKeys[i]) for i in indexes]
+        positions = [coords.get(key, (None, None)) for key in keys]
+        crops = CropRegions(imKey, keys, positions, paths.get(imKey, None))
+        if crops is None:
+            imgs = FetchImage(imKey, filenames=paths.get(imKey, None))
+            if imgs is None:
+                continue
+            crops = CropObjects(keys, imgs, positions)
+        for i, tile in zip(indexes, crops):
+            tiles[i] = tile
+            if store is not None and tile is not None:
+                store.put(obKeys[i], mtimes[imKey], tile)
+    return tiles
+
+def tile_store():
+    '''returns the TileStore for the current project and tile settings, or
+    None if Properties.tile_store is off. Stores are kept under ~/CPA/tiles.
+    '''
+    if not p.tile_store:
+        return None
+    db_type, host, user, passwd, name, db_file = db._pool_key()
+    nchannels = sum(map(int, p.channels_per_image))
+    size = int(p.image_tile_size)
+    identity = repr((db_type, host, user, name, db_file and os.path.abspath(db_file),
+                     p.image_table, p.object_table.split('_checked')[0], p.cell_x_loc, p.cell_y_loc,
+                     p.image_path_cols, p.image_file_cols, p.channels_per_image,
+                     p.rescale_object_coords, p.image_rescale, size))
+    with cache_lock:
+        if identity not in tile_stores:
+            digest = hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+            try:
+                tile_stores[identity] = TileStore(cpa_data_dir('tiles', digest), nchannels, size,
+                                                  len(dbconnect.object_key_columns()))
+            except OSError as e:
+                logging.warn('Could not open the tile store, tiles will not be stored: %s'%(e))
+                tile_stores[identity] = None
+        return tile_stores[identity]
+
+def image_limits():
+    '''returns the LimitStore of the intensity ranges of decoded images,
+    kept in ~/CPA, or None if Properties.image_region_reads is off.
+    '''
+    global limit_store
+    if not p.image_region_reads:
+        return None
+    with cache_lock:
+        if limit_store is None:
+            try:
+                limit_store = LimitStore(os.path.join(cpa_data_dir(), 'image_limits.jsonl'))
+            except OSError as e:
+                logging.warn('Could not open the image intensity record, images will be read whole: %s'%(e))
+                limit_store = False
+        return limit_store or None
+
+def CropRegions(imKey, obKeys, positions, filenames):
+    '''returns the tiles of objects of one image, like CropObjects, reading
+    only the part of the image's files under each tile (see
+    ImageReader.ReadRegions). Returns None if the image should be decoded
+    whole instead: it is in the image cache already, it can't be read by
+    region, or the intensity range of its channels, which tiles carry in
+    their corners, isn't known from an earlier read.
+    '''
+    store = image_limits()
+    if store is None or filenames is None or imKey in image_cache():
+        return None
+    limits = store.get(filenames, image_mtime(filenames))
+    if limits is None or len(limits) != sum(map(int, p.channels_per_image)):
+        return None
+    tiles = [None] * len(obKeys)
+    valid = [i for i, pos in enumerate(positions) if None not in pos[:2]]
+    if valid:
+        pos = np.array([positions[i][:2] for i in valid], dtype=float)
         if p.rescale_object_coords:
-            pos[0] *= p.image_rescale[0] / p.image_rescale_from[0]
-            pos[1] *= p.image_rescale[1] / p.image_rescale_from[1]
-
-        return [Crop(im, size, pos) for im in imgs]
-
-def FetchImage(imKey, z=None):
-    global cachedkeys
-    if imKey in cache and z is None:
-        return cache[imKey]
-    else:
-        ir = ImageReader()
-        filenames = db.GetFullChannelPathsForImage(imKey)
+            pos[:, 0] *= p.image_rescale[0] / p.image_rescale_from[0]
+            pos[:, 1] *= p.image_rescale[1] / p.image_rescale_from[1]
+        size = int(p.image_tile_size)
+        # same rounding as Crop
+        corners = (pos + 0.5).astype(int) - size//2
+        boxes = [(x, y, x + size, y + size) for x, y in corners]
         try:
             log_io = wx.GetApp().frame.log_io
         except:
             log_io = True
-        imgs = ir.ReadImages(filenames, log_io, z=z)
-        if imgs is None:
-            # Loading failed
-            return
-        cache[imKey] = imgs
-        if imKey not in cachedkeys: #only add the key if it's new
-            cachedkeys += [imKey]
-        while len(cachedkeys) > int(p.image_buffer_size):
-            del cache[cachedkeys.pop(0)]
-        return cache[imKey]
+        regions = ImageReader().ReadRegions(filenames, boxes, log_io)
+        if regions is None or any(region[0].size == 0 for region in regions):
+            return None
+        for n, i in enumerate(valid):
+            RememberLimits(regions[n], limits)
+            # crop from the region, which starts at the box clipped to the image
+            origin = np.maximum(corners[n], 0)
+            tiles[i] = [CropMany(im, (size, size), pos[n] - origin)[0] for im in regions[n]]
+    for i, pos in enumerate(positions):
+        if None in pos[:2]:
+            CropObject(obKeys[i], None, list(pos))  # reports the missing coordinates
+    return tiles
+
+def CropObject(obKey, imgs, pos):
+    '''returns a tile_size crop of each channel in imgs centered on the
+    object at pos, or None if the object's coordinates are missing.
+    '''
+    size = (int(p.image_tile_size), int(p.image_tile_size))
+    if None in pos:
+        message = ('Failed to load coordinates for object key %s. This may '
+                   'indicate a problem with your per-object table.\n'
+                   'You can check your per-object table "%s" in TableViewer'
+                   %(', '.join(['%s:%s'%(col, val) for col, val in
+                                zip(dbconnect.object_key_columns(), obKey)]),
+                   p.object_table))
+        wx.MessageBox(message, 'Error')
+        logging.error(message)
+        return None
+    if p.rescale_object_coords:
+        pos[0] *= p.image_rescale[0] / p.image_rescale_from[0]
+        pos[1] *= p.image_rescale[1] / p.image_rescale_from[1]
+
+    return [Crop(im, size, pos) for im in imgs]
+
+def CropObjects(obKeys, imgs, positions):
+    '''returns a tile_size crop of each channel in imgs for each of the
+    objects at positions, like CropObject, but cutting all of the crops of a
+    channel with one indexing operation. Objects with missing coordinates
+    get None.
+    '''
+    tiles = [None] * len(obKeys)
+    valid = []
+    for i, pos in enumerate(positions):
+        if None in pos[:2]:
+            CropObject(obKeys[i], imgs, list(pos))  # reports the missing coordinates
+        else:
+            valid.append(i)
+    if not valid:
+        return tiles
+    pos = np.array([positions[i][:2] for i in valid], dtype=float)
+    if p.rescale_object_coords:
+        pos[:, 0] *= p.image_rescale[0] / p.image_rescale_from[0]
+        pos[:, 1] *= p.image_rescale[1] / p.image_rescale_from[1]
+    size = int(p.image_tile_size)
+    crops = [CropMany(im, (size, size), pos) for im in imgs]
+    for n, i in enumerate(valid):
+        tiles[i] = [crop[n] for crop in crops]
+    return tiles
+
+def image_cache():
+    '''returns the ImageCache used by FetchImage, sized from the properties
+    the first time it's used.
+    '''
+    global cache
+    with cache_lock:
+        if cache is None:
+            size = p.image_cache_size or DEFAULT_IMAGE_CACHE_SIZE
+            spill = p.image_cache_spill_size
+            if spill is None:
+                spill = DEFAULT_IMAGE_SPILL_SIZE
+            cache = ImageCache(max_bytes=int(size * 2**20), spill_bytes=int(spill * 2**20))
+        return cache
+
+def FetchImage(imKey, z=None, filenames=None):
+    '''returns the list of channel arrays of an image, or with process_3D of
+    its slice z, "mid" slice or "max" or "mean" projection (see
+    ImageReader.ReadImages). Images, slices and projections are kept in the
+    image cache.
+    '''
+    if z is not None and not isinstance(z, str):
+        # object centres give fractional z; slice int(z) is what's read
+        z = int(z)
+    key = imKey if z is None else (imKey, z)
+    imgs = image_cache().get(key)
+    if imgs is not None:
+        RememberLimits(imgs)
+        return imgs
+    ir = ImageReader()
+    if filenames is None:
+        filenames = db.GetFullChannelPathsForImage(imKey)
+    try:
+        log_io = wx.GetApp().frame.log_io
+    except:
+        log_io = True
+    imgs = ir.ReadImages(filenames, log_io, z=z)
+    if imgs is None:
+        # Loading failed
+        return
+    RememberLimits(imgs)
+    store = image_limits()
+    if store is not None and z is None and not p.image_rescale:
+        # so tiles can be cut from regions of the image later, see CropRegions
+        mtime = image_mtime(filenames)
+        if mtime:
+            store.put(filenames, mtime, [ChannelLimits(im) for im in imgs])
+    image_cache().put(key, imgs)
+    return imgs
+
+def RememberLimits(imgs, limits=None):
+    '''records the intensity range of each channel of a decoded image, so
+    ChannelLimits doesn't need to scan the image again. The channels must
+    not be modified afterwards (see ImageCache).
+    limits - the known (min, max) of each channel, eg: of the full image
+             that a pyramid level was made from
+    '''
+    for i, im in enumerate(imgs):
+        if limits is None:
+            _memo(channel_limits, im, lambda im: (im.min(), im.max()))
+        else:
+            _memo(channel_limits, im, lambda im: limits[i])
+
+def ChannelLimits(im):
+    '''returns the (min, max) intensity of a channel array, from the values
+    recorded when its image was decoded if there are any.
+    '''
+    entry = channel_limits.get(id(im), None)
+    if entry is not None and entry[0]() is im:
+        return entry[1]
+    return (im.min(), im.max())
+
+def ChannelDigest(im):
+    '''returns a hash of the contents of a channel array, computed once for
+    each array. Arrays must not be modified after they have been drawn.
+    '''
+    return _memo(channel_digests, im, _digest)
+
+def _digest(im):
+    h = hashlib.blake2b(repr((im.shape, im.dtype.str)).encode('utf-8'), digest_size=16)
+    h.update(np.ascontiguousarray(im).data)
+    return h.digest()
+
+def _memo(table, im, compute):
+    key = id(im)
+    entry = table.get(key, None)
+    if entry is not None and entry[0]() is im:
+        return entry[1]
+    value = compute(im)
+    table[key] = (weakref.ref(im, lambda ref, key=key: table.pop(key, None)), value)
+    return value
+
+def FetchPyramid(imKey):
+    '''returns the Pyramid of an image for ImageViewer, or None if the image
+    is smaller than Properties.image_pyramid_size. The pyramid is built from
+    the decoded image the first time and kept under ~/CPA/pyramids, after
+    which the image isn't decoded again while its files are unchanged.
+    '''
+    min_size = p.image_pyramid_size
+    if min_size is None:
+        min_size = DEFAULT_PYRAMID_SIZE
+    if not min_size or p.process_3D:
+        return None
+    filenames = db.GetFullChannelPathsForImage(imKey)
+    mtime = image_mtime(filenames)
+    db_type, host, user, passwd, name, db_file = db._pool_key()
+    identity = repr((db_type, host, user, name, db_file and os.path.abspath(db_file),
+                     p.image_table, tuple(imKey), filenames, p.image_rescale))
+    root = cpa_data_dir('pyramids')
+    directory = os.path.join(root, hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16])
+    pyramid = Pyramid.open(directory, mtime)
+    if pyramid is not None:
+        return pyramid
+    imgs = FetchImage(imKey, filenames=filenames)
+    if imgs is None or max(imgs[0].shape) < min_size:
+        return None
+    try:
+        pyramid = Pyramid.build(directory, imgs, mtime, [ChannelLimits(im) for im in imgs])
+    except OSError as e:
+        logging.warn('Could not save the image pyramid of %s: %s'%(imKey, e))
+        return None
+    disk_size = p.image_pyramid_disk_size or DEFAULT_PYRAMID_DISK_SIZE
+    prune_pyramids(root, int(disk_size * 2**20), keep=[directory])
+    return pyramid
 
 def ShowImage(imKey, chMap, parent=None, brightness=1.0, scale=1.0, contrast=None, z=None):
     from .imageviewer import ImageViewer
-    imgs = FetchImage(imKey, z=z)
-    if imgs is None:
-        return
+    pyramid = FetchPyramid(imKey) if z is None else None
+    if pyramid is not None:
+        imgs = None
+    else:
+        imgs = FetchImage(imKey, z=z)
+        if imgs is None:
+            return
     frame = ImageViewer(imgs=imgs, chMap=chMap, img_key=imKey,
                         parent=parent, title=str(imKey),
                         brightness=brightness, scale=scale,
-                        contrast=contrast)
+                        contrast=contrast, pyramid=pyramid)
     frame.Show(True)
     return frame
 
@@ -132,11 +429,34 @@ def Crop(imgdata, xxx_todo_changeme, xxx_todo_changeme1):
     crop[dest_loy:dest_hiy, dest_lox:dest_hix] = imgdata[loy:hiy, lox:hix]
 
     # XXX - hack to make scaling work per-image instead of per-tile
-    crop[0, 0] = imgdata.min()
-    crop[-1, -1] = imgdata.max()
+    crop[0, 0], crop[-1, -1] = ChannelLimits(imgdata)
 
     return crop
 
+def CropMany(imgdata, size, positions):
+    '''
+    Crops an image to the width (w,h) around each of the points (x,y) in
+    positions, like Crop, returning an array of n crops. Area outside of
+    the image is filled with zeros.
+    '''
+    (w, h) = size
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    # same rounding as Crop
+    x = (positions[:, 0] + 0.5).astype(int) - w//2
+    y = (positions[:, 1] + 0.5).astype(int) - h//2
+    rows = y[:, None] + np.arange(h)
+    cols = x[:, None] + np.arange(w)
+    inside = (((rows >= 0) & (rows < imgdata.shape[0]))[:, :, None] &
+              ((cols >= 0) & (cols < imgdata.shape[1]))[:, None, :])
+    rows = np.clip(rows, 0, imgdata.shape[0] - 1)
+    cols = np.clip(cols, 0, imgdata.shape[1] - 1)
+    crops = np.where(inside, imgdata[rows[:, :, None], cols[:, None, :]], 0).astype('float32')
+
+    # XXX - hack to make scaling work per-image instead of per-tile
+    crops[:, 0, 0], crops[:, -1, -1] = ChannelLimits(imgdata)
+
+    return crops
+
 def MergeToBitmap(imgs, chMap, brightness=1.0, scale=1.0, masks=[], contrast=None, display_whole_image=False):
     '''
     imgs  - list of np arrays containing pixel data for each channel of an image
@@ -154,133 +474,109 @@ def MergeToBitmap(imgs, chMap, brightness=1.0, scale=1.0, masks=[], contrast=Non
     # So let's make a copy of the original image data stack while we work.
     imgs = imgs.copy()
 
-    '''
-    This is a bit hacky, but right now the tileloader needs to see and merge several channels when making temporary tiles.
-    The merging process is pretty slow and makes loading data sets painful. We can't easily avoid tile generation, but we can
-    try to figure out if we're using a temporary tile. Temp tiles will always be identical, so we can cache and send back the
-    completed temporary tile.
-    '''
-    global cachedparams
-    global cachedresult
-    # Laziest "hash" ever, but it'll do.
-    imghash = [id(im) for im in imgs]
-    # In temporary tiles, [0,0] is always set to 0 to aid contrasting.
-    if cachedparams is not None and imgs[0][0][0] == 0:
-        if cachedparams == [imghash, chMap, brightness, scale, masks, contrast, display_whole_image]:
-            return cachedresult
-    cachedparams = [imghash, chMap, brightness, scale, masks, contrast, display_whole_image]
+    # Bitmaps are cached by the contents of the channels and the display
+    # settings, so redrawing with earlier settings costs nothing.
+    cache = None if masks else bitmap_cache()
+    if cache is not None:
+        key = _bitmap_key(imgs, chMap, brightness, scale, contrast, display_whole_image)
+        bitmap = cache.get(key)
+        if bitmap is not None:
+            return bitmap
 
     # Before any resizing, record the genuine full intensity range of each image.
-    limits = [(im.min(), im.max()) for im in imgs]
-    if not display_whole_image:
-        # Rescaling 2k x 2k images to make a 25 x 25 tile is slow and silly.
-        # Here we check whether the input image is more than 10x the final tile size.
-        # If it is, we'll do a quick and dirty rescale to give a more managable starting point.
-        tgt_h = int(p.image_size) * 4
-        tgt_w = int(p.image_size) * 4
-        h, w = imgs[0].shape
-        if tgt_h < h and tgt_w < w:
-            rescale_factor = max(tgt_h / h, tgt_w / w)
-            # imgs = [scipy.ndimage.zoom(im, (rescale_factor, rescale_factor), order=1, prefilter=False,
-            #                            mode="grid-constant", grid_mode=True) for im in imgs]
-            tgtsize = (int(w * rescale_factor), int(h * rescale_factor))
-            imgs = [np.array(Image.fromarray(im).resize(tgtsize, resample=Image.NEAREST)) for im in imgs]
-    if contrast=='Log':
-        logims = [log_transform(im, interval=limits[idx]) for idx, im in enumerate(imgs)]
-        imData = MergeChannels(logims, chMap, masks=masks)
-    elif contrast=='Linear':
-        newims = [auto_contrast(im, interval=limits[idx]) for idx, im in enumerate(imgs)]
-        imData = MergeChannels(newims, chMap, masks=masks)
+    limits = [ChannelLimits(im) for im in imgs]
+    h, w = imgs[0].shape
+    if display_whole_image:
+        # Shrink by whole factors before rendering, wx does the rest.
+        factor = int(1 / scale) if scale < 1 else 1
+        base_w, base_h = w, h
     else:
-        # Ensure we're in float 0-1 range, scale based on bit depth.
-        for i in range(len(imgs)):
-            maxval = imgs[i].max()
-            if maxval > 255:
-                imgs[i] = imgs[i] * (1 / 65535)
-            elif maxval > 1:
-                imgs[i] = imgs[i] * (1 / 255)
-        imData = MergeChannels(imgs, chMap, masks=masks)
-
-    h,w = imgs[0].shape
-
-    # Convert from float [0-1] to 8bit
-    imData *= 255.0
-
-    imData[imData>255] = 255
-
-    # Write wx.Image
-    img = wx.Image(w,h)
-    img.SetData(imData.astype('uint8').flatten())
-
-    tmp_h = int(p.image_size)
-    tmp_w = int(p.image_size)
-
-    # Here we do a more careful rescale to the target tile size.
-    if not display_whole_image and h != tmp_h and h!= tmp_w:
-        h = tmp_h
-        w = tmp_w
-        img.Rescale(h,w)
-
-    # Apply brightness & scale
-    if brightness != 1.0:
-        img = img.AdjustChannels(brightness, brightness, brightness)
+        # Rendering 2k x 2k images to make a 25 x 25 tile is slow and silly.
+        # If the input image is more than 4x the final tile size, downsample
+        # it to a more managable starting point.
+        tgt = int(p.image_size) * 4
+        factor = min(h, w) // tgt if tgt < h and tgt < w else 1
+        base_w = base_h = int(p.image_size)
+    rgb = render.render(imgs, chMap, limits, contrast=contrast, brightness=brightness,
+                        factor=factor, blending=BlendModes(len(imgs)), masks=masks)
+    bitmap = _rgb_to_bitmap(rgb, base_w, base_h, scale)
+    if cache is not None:
+        cache.put(key, bitmap, _bitmap_nbytes(bitmap))
+    return bitmap
+
+def MergeToBitmaps(tiles, chMap, brightness=1.0, scale=1.0, contrast=None):
+    '''
+    Renders a list of object tiles of the same shape to bitmaps in one
+    batch, like calling MergeToBitmap on each of them. Tiles with a cached
+    bitmap for these settings aren't rendered again.
+    tiles - list of lists of channel arrays
+    '''
+    result = [None] * len(tiles)
+    cache = bitmap_cache()
+    if cache is not None:
+        keys = [_bitmap_key(tile, chMap, brightness, scale, contrast, False) for tile in tiles]
+        result = [cache.get(key) for key in keys]
+    todo = [i for i, bitmap in enumerate(result) if bitmap is None]
+    if not todo:
+        return result
+    size = int(p.image_size)
+    h, w = tiles[todo[0]][0].shape
+    factor = min(h, w) // (size * 4) if size * 4 < h and size * 4 < w else 1
+    rgb = render.render_batch([tiles[i] for i in todo], chMap, contrast=contrast, brightness=brightness,
+                              factor=factor, blending=BlendModes(len(tiles[todo[0]])))
+    for i, im in zip(todo, rgb):
+        result[i] = _rgb_to_bitmap(im, size, size, scale)
+        if cache is not None:
+            cache.put(keys[i], result[i], _bitmap_nbytes(result[i]))
+    return result
+
+def bitmap_cache():
+    '''returns the BitmapCache shared by every window that draws tiles and
+    images, sized from the properties the first time it's used, or None if
+    Properties.bitmap_cache_size is 0.
+    '''
+    global bitmaps
+    with cache_lock:
+        if bitmaps is None:
+            size = p.bitmap_cache_size
+            if size is None:
+                size = DEFAULT_BITMAP_CACHE_SIZE
+            bitmaps = BitmapCache(max_bytes=int(size * 2**20))
+        return bitmaps if bitmaps.max_bytes > 0 else None
+
+def _bitmap_key(imgs, chMap, brightness, scale, contrast, display_whole_image):
+    return (tuple(ChannelDigest(im) for im in imgs), tuple(chMap), brightness, scale, contrast,
+            display_whole_image, p.image_size, tuple(BlendModes(len(imgs))))
+
+def _bitmap_nbytes(bitmap):
+    return bitmap.Width * bitmap.Height * 4
+
+def _rgb_to_bitmap(rgb, w, h, scale):
+    '''makes a bitmap of w x h times scale pixels from a uint8 RGB array'''
+    img = wx.Image(rgb.shape[1], rgb.shape[0])
+    img.SetData(rgb.tobytes())
+
+    # Here we do a more careful rescale to the target size.
     if scale != 1.0:
         if w*scale>10 and h*scale>10:
-            img.Rescale(w*scale, h*scale)
+            w, h = int(w*scale), int(h*scale)
         else:
-            img.Rescale(10,10)
+            w, h = 10, 10
+    if (w, h) != (img.Width, img.Height):
+        img.Rescale(w, h)
+    return img.ConvertToBitmap()
 
-    cachedresult = img.ConvertToBitmap()
-    return cachedresult
+def BlendModes(n):
+    '''returns the blending mode of each of n channels'''
+    n_channels = sum(map(int, p.channels_per_image))
+    return (p.image_channel_blend_modes or ['add']*n_channels)[:n]
 
 def MergeChannels(imgs, chMap, masks=[]):
     '''
     Merges the given image data into the channels listed in chMap.
     Masks are passed in pairs (mask, blendingfunc).
     '''
-    n_channels = sum(map(int, p.channels_per_image))
-    blending = p.image_channel_blend_modes or ['add']*n_channels
-    h,w = imgs[0].shape
-
-    colormap = {'red'      : [1,0,0],
-                'green'    : [0,1,0],
-                'blue'     : [0,0,1],
-                'cyan'     : [0,1,1],
-                'yellow'   : [1,1,0],
-                'magenta'  : [1,0,1],
-                'gray'     : [1,1,1],
-                'none'     : [0,0,0] }
-
-    imData = np.zeros((h,w,3), dtype='float')
-
-    for i, im in enumerate(imgs):
-        if blending[i].lower() == 'add':
-            c = colormap[chMap[i].lower()]
-            for chan in range(3):
-                imData[:,:,chan] += im * c[chan]
-
-    imData[imData>1.0] = 1.0
-    imData[imData<0.0] = 0.0
-
-    for i, im in enumerate(imgs):
-        if blending[i].lower() == 'subtract':
-            c = colormap[chMap[i].lower()]
-            for chan in range(3):
-                imData[:,:,chan] -= im * c[chan]
-
-    imData[imData>1.0] = 1.0
-    imData[imData<0.0] = 0.0
-
-    for i, im in enumerate(imgs):
-        if blending[i].lower() == 'solid':
-            if chMap[i].lower() != 'none':
-                c = colormap[chMap[i].lower()]
-                for chan in range(3):
-                    imData[:,:,chan][im == 1] = c[chan]
-
-    imData[imData>1.0] = 1.0
-    imData[imData<0.0] = 0.0
-
+    imData = render.blend(np.stack(imgs), chMap, BlendModes(len(imgs)))
     for mask, func in masks:
         imData = func(imData, mask)
 
@@ -13,7 +13,7 @@ import cpa.helpmenu
 from .dbconnect import *
 from .datamodel import DataModel
 from .imagecontrolpanel import *
-from .imagepanel import ImagePanel
+from .imagepanel import TiledImagePanel
 from .properties import Properties
 from . import imagetools
 import pickle
@@ -59,12 +59,16 @@ def rescale_display_coord_to_image(x, y):
     y = y * p.image_rescale_from[1] / p.image_rescale[1]
     return x,y
 
-class ImageViewerPanel(ImagePanel):
+class ImageViewerPanel(TiledImagePanel):
     '''
-    ImagePanel with selection and object class labels.
+    TiledImagePanel with selection and object class labels.
     '''
-    def __init__(self, imgs, chMap, img_key, parent, scale=1.0, brightness=1.0, contrast=None):
-        super(ImageViewerPanel, self).__init__(imgs, chMap, parent, scale, brightness, contrast=contrast, display_whole_image=True)
+    def __init__(self, imgs, chMap, img_key, parent, scale=1.0, brightness=1.0, contrast=None, pyramid=None):
+        # With an image pyramid, imgs is None and the level matching the
+        # zoom is drawn instead of the full size image.
+        self.pyramid = pyramid
+        self.level_images = (None, None)   # (level, channels) last read from the pyramid
+        super(ImageViewerPanel, self).__init__(imgs, chMap, parent, scale, brightness, contrast=contrast)
         self.selectedPoints = []
         self.classes        = {}  # {'Positive':[(x,y),..], 'Negative': [(x2,y2),..],..}
         self.classVisible   = {}
@@ -72,6 +76,31 @@ class ImageViewerPanel(ImagePanel):
         self.img_key        = img_key
         self.show_object_numbers = False
 
+    def MakeBitmap(self):
+        if self.pyramid is None:
+            return super(ImageViewerPanel, self).MakeBitmap()
+        level = self.pyramid.level_for_scale(self.scale)
+        if self.level_images[0] != level:
+            imgs = self.pyramid.channels(level)
+            imagetools.RememberLimits(imgs, self.pyramid.limits)
+            self.level_images = (level, imgs)
+        return imagetools.MergeToBitmap(self.level_images[1],
+                                        chMap = self.chMap,
+                                        brightness = self.brightness,
+                                        scale = self.scale * 2**level,
+                                        contrast = self.contrast,
+                                        display_whole_image = True)
+
+    def ImageShape(self):
+        if self.pyramid is None:
+            return super(ImageViewerPanel, self).ImageShape()
+        return self.pyramid.shape
+
+    def TileSource(self):
+        if self.pyramid is None:
+            return super(ImageViewerPanel, self).TileSource()
+        return self.pyramid
+
     def OnPaint(self, evt):
         dc = super(ImageViewerPanel, self).OnPaint(evt)
         font = self.GetFont()
@@ -186,13 +215,14 @@ class ImageViewer(wx.Frame):
     '''
     def __init__(self, imgs=None, chMap=None, img_key=None, parent=None, title='Image Viewer',
                  classifier=None, brightness=1.0, scale=1.0, contrast=None,
-                 classCoords=None):
+                 classCoords=None, pyramid=None):
         '''
         imgs  : [np.array(dtype=float32), ... ]
         chMap : ['color', ...]
             defines the colors that will be mapped to the corresponding
             image channels in imgs
         img_key : key for this image in the database, to allow selection of cells
+        pyramid : imagetools.FetchPyramid result to draw instead of imgs
         NOTE: imgs lists must be of the same length.
         '''
         wx.Frame.__init__(self, parent, -1, title)
@@ -200,7 +230,6 @@ class ImageViewer(wx.Frame):
         self.SetBackgroundColour("white")
         self.img_key     = img_key
         self.classifier  = parent
-        self.sw          = wx.ScrolledWindow(self)
         self.selection   = []
         self.maxSize     = tuple([xy-50 for xy in wx.DisplaySize()])
         self.defaultFile = 'MyImage.png'
@@ -220,8 +249,8 @@ class ImageViewer(wx.Frame):
         self.SetSizer(wx.BoxSizer(wx.VERTICAL))
         self.CreateMenus()
         self.CreatePopupMenu()
-        if imgs and chMap:
-            self.SetImage(imgs, chMap, brightness, scale, contrast)
+        if (imgs or pyramid) and chMap:
+            self.SetImage(imgs, chMap, brightness, scale, contrast, pyramid=pyramid)
         else:
             self.OnOpenImage()
         self.DoLayout()
@@ -248,17 +277,20 @@ class ImageViewer(wx.Frame):
                                                  (wx.ACCEL_CMD,ord('D'),ID_DESELECT_ALL),])
         self.SetAcceleratorTable(accelerator_table)
 
-    def SetImage(self, imgs, chMap=None, brightness=1, scale=1, contrast=None):
+    def SetImage(self, imgs, chMap=None, brightness=1, scale=1, contrast=None, pyramid=None):
         self.AutoTitle()
         self.chMap = chMap or p.image_channel_colors
         self.toggleChMap = self.chMap[:]
         if self.imagePanel:
             self.imagePanel.Destroy()
+        if pyramid is not None:
+            # Start zoomed out far enough for the image to fit on screen
+            scale = min(scale, min(float(m) / n for m, n in zip(self.maxSize[::-1], pyramid.shape)))
         self.imagePanel = ImageViewerPanel(imgs, self.chMap, self.img_key,
-                                           self.sw, brightness=brightness,
-                                           scale=scale, contrast=contrast)
+                                           self, brightness=brightness,
+                                           scale=scale, contrast=contrast,
+                                           pyramid=pyramid)
         self.imagePanel.Bind(wx.EVT_LEFT_DOWN, self.OnLeftDown)
-        self.imagePanel.Bind(wx.EVT_SIZE, self.OnResizeImagePanel)
         self.imagePanel.Bind(wx.EVT_RIGHT_DOWN, self.OnRightDown)
 
     def CreateMenus(self):
@@ -450,27 +482,24 @@ class ImageViewer(wx.Frame):
             else:
                 self.controls.SetListener(self.imagePanel)
             self.Sizer.Clear()
-            self.Sizer.Add(self.sw, proportion=1, flag=wx.EXPAND)
+            self.Sizer.Add(self.imagePanel, proportion=1, flag=wx.EXPAND)
             self.Sizer.Add(self.cp, 0, wx.RIGHT|wx.LEFT|wx.EXPAND, 25)
-            w, h = self.imagePanel.GetSize()
+            w, h = self.imagePanel.DisplaySize()
             if self.first_layout:
-                self.SetClientSize( (min(self.maxSize[0], w*self.imagePanel.scale),
-                                     min(self.maxSize[1], h*self.imagePanel.scale+55)) )
+                self.SetClientSize( (min(self.maxSize[0], w),
+                                     min(self.maxSize[1], h+55)) )
                 self.Center()
                 self.first_layout = False
-            self.sw.SetScrollbars(1, 1, w*self.imagePanel.scale, h*self.imagePanel.scale)
-            #self.sw.SetScrollRate(1, 1)
+            self.Layout()
             self.CreateChannelMenus()
 
             # Annoying: Need to bind 3 windows to KEY_DOWN in case focus changes.
             self.Bind(wx.EVT_KEY_DOWN, self.HoldKey)
-            self.sw.Bind(wx.EVT_KEY_DOWN, self.HoldKey)
             self.cp.Bind(wx.EVT_KEY_DOWN, self.HoldKey)
             self.imagePanel.Bind(wx.EVT_KEY_DOWN, self.HoldKey)
 
             # Annoying: Need to bind 3 windows to KEY_UP in case focus changes.
             self.Bind(wx.EVT_KEY_UP, self.OnKey)
-            self.sw.Bind(wx.EVT_KEY_UP, self.OnKey)
             self.cp.Bind(wx.EVT_KEY_UP, self.OnKey)
             self.imagePanel.Bind(wx.EVT_KEY_UP, self.OnKey)
             self.Bind(wx.EVT_MENU, lambda e: self.SelectAll(), self.sel_all)
@@ -564,9 +593,6 @@ class ImageViewer(wx.Frame):
             else:
                 evt.Skip()
 
-    def OnResizeImagePanel(self, evt):
-        self.sw.SetVirtualSize(evt.GetSize())
-
     def ToggleChannel(self, chIdx):
         if self.chMap[chIdx] == 'None':
             for (idx, color, item, menu) in list(self.chMapById.values()):
@@ -609,8 +635,9 @@ class ImageViewer(wx.Frame):
 
     def OnLeftDown(self, evt):
         if self.img_key and p.object_table:
-            x = evt.GetPosition().x / self.imagePanel.scale
-            y = evt.GetPosition().y / self.imagePanel.scale
+            x, y = self.imagePanel.CalcUnscrolledPosition(evt.GetPosition())
+            x = x / self.imagePanel.scale
+            y = y / self.imagePanel.scale
             if p.rescale_object_coords:
                 x, y = rescale_display_coord_to_image(x, y)
             obKey = db.GetObjectNear(self.img_key, x, y)
@@ -695,7 +722,9 @@ class ImageViewer(wx.Frame):
         else:
             # load the image
             self.img_key = imkey
-            self.SetImage(imagetools.FetchImage(imkey), p.image_channel_colors)
+            pyramid = imagetools.FetchPyramid(imkey)
+            self.SetImage(None if pyramid else imagetools.FetchImage(imkey),
+                          p.image_channel_colors, pyramid=pyramid)
             self.DoLayout()
 
     def OnSaveImage(self, evt):
@@ -716,7 +745,11 @@ class ImageViewer(wx.Frame):
                     return self.OnSaveImage(evt)
             if format.upper()=='.JPG':
                 format = '.JPEG'
-            imagetools.SaveBitmap(self.imagePanel.bitmap, filename, format.upper()[1:])
+            # The viewer draws tiles as they're needed, so render the whole image to save it
+            bitmap = self.imagePanel.bitmap
+            if bitmap is None:
+                bitmap = self.imagePanel.MakeBitmap()
+            imagetools.SaveBitmap(bitmap, filename, format.upper()[1:])
 
 
     def OnChangeClassRepresentation(self, evt):
@@ -0,0 +1,266 @@
+'''
+Bulk loading of CSV files into SQLite tables.
+
+Files are split into blocks of whole lines that are parsed and converted to
+typed rows in worker processes, while the parent inserts the blocks in file
+order with executemany inside a single transaction. Bulk-load PRAGMAs are set
+for the duration of the load and indexes are meant to be built afterwards
+(see create_indexes).
+'''
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import re
+from collections import deque
+from contextlib import contextmanager
+
+# Bytes of CSV text handed to a worker (and inserted with one executemany)
+DEFAULT_BLOCK_BYTES = 4 * 2**20
+# Rows read from the start of a file to infer column types
+DEFAULT_SAMPLE_ROWS = 1000
+# Page cache used during a bulk load, in KiB
+BULK_CACHE_KB = 512 * 1024
+
+NULL_STRINGS = ('', 'NULL', 'null', '\\N')
+
+
+class IngestCancelled(Exception):
+    '''Raised when the progress callback asks for a load to stop.'''
+    pass
+
+
+def infer_column_types(filename, sample_rows=DEFAULT_SAMPLE_ROWS):
+    '''
+    Reads the header and the first sample_rows rows of a CSV file and
+    returns (column names, SQL types) where each type is INT, FLOAT or
+    VARCHAR(n), the narrowest type that holds every sampled value.
+    '''
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader)]
+        kinds = [None] * len(header)
+        maxlen = [0] * len(header)
+        for n, row in enumerate(reader):
+            if n >= sample_rows:
+                break
+            for i, value in enumerate(row[:len(header)]):
+                if value in NULL_STRINGS:
+                    continue
+                maxlen[i] = max(maxlen[i], len(value))
+                if kinds[i] in (None, 'INT'):
+                    try:
+                        int(value)
+                        kinds[i] = 'INT'
+                        continue
+                    except ValueError:
+                        pass
+                if kinds[i] in (None, 'INT', 'FLOAT'):
+                    try:
+                        float(value)
+                        kinds[i] = 'FLOAT'
+                        continue
+                    except ValueError:
+                        pass
+                kinds[i] = 'VARCHAR'
+    types = []
+    for kind, length in zip(kinds, maxlen):
+        if kind == 'VARCHAR':
+            types.append('VARCHAR(%d)'%(max(length, 1)))
+        else:
+            types.append(kind or 'FLOAT')
+    return header, types
+
+
+def column_kind(sqltype):
+    '''Maps a declared SQL type to the conversion applied while loading:
+    "i" (integer), "f" (float) or "s" (text).'''
+    t = (sqltype or '').upper()
+    if 'INT' in t:
+        return 'i'
+    if any(s in t for s in ('REAL', 'FLOA', 'DOUB', 'DEC', 'NUM')):
+        return 'f'
+    return 's'
+
+
+def _convert(value, kind):
+    if value in NULL_STRINGS:
+        return None
+    if kind == 'i':
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    if kind != 's':
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_block(args):
+    '''Worker function: parses a block of CSV text into typed row tuples.'''
+    data, kinds, encoding = args
+    ncols = len(kinds)
+    rows = []
+    for row in csv.reader(io.StringIO(data.decode(encoding), newline='')):
+        if len(row) == 0:
+            continue
+        rows.append(tuple([_convert(v, k) for v, k in zip(row, kinds)] +
+                          [None] * (ncols - len(row))))
+    return rows
+
+
+def iter_blocks(f, block_bytes=DEFAULT_BLOCK_BYTES):
+    '''
+    Yields blocks of whole CSV records read from binary file f. Blocks end
+    on a newline that is not inside a quoted field.
+    '''
+    pending = b''
+    while True:
+        data = f.read(block_bytes)
+        if not data:
+            break
+        data = pending + data
+        end = len(data)
+        # back up to a newline outside of quotes (an even number of quotes
+        # precedes it, since escaped quotes are doubled)
+        while True:
+            end = data.rfind(b'\n', 0, end)
+            if end < 0 or data.count(b'"', 0, end) % 2 == 0:
+                break
+        if end < 0:
+            pending = data
+            continue
+        pending = data[end + 1:]
+        yield data[:end + 1]
+    if pending.strip():
+        yield pending
+
+
+@contextmanager
+def bulk_load_pragmas(conn):
+    '''
+    Relaxes durability on an SQLite connection for the duration of a bulk
+    load: no rollback journal, no fsync and a large page cache. An
+    interrupted load can leave the database corrupt, so callers should
+    delete it on failure.
+    '''
+    saved = {}
+    for pragma in ('journal_mode', 'synchronous', 'cache_size', 'temp_store'):
+        saved[pragma] = conn.execute('PRAGMA %s'%(pragma)).fetchone()[0]
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA cache_size=-%d'%(BULK_CACHE_KB))
+    conn.execute('PRAGMA temp_store=MEMORY')
+    try:
+        yield conn
+    finally:
+        for pragma, value in saved.items():
+            try:
+                conn.execute('PRAGMA %s=%s'%(pragma, value))
+            except Exception as e:
+                logging.warn('Could not restore PRAGMA %s=%s: %s'%(pragma, value, e))
+
+
+def default_workers():
+    return max(1, min(4, (os.cpu_count() or 1) - 1))
+
+
+def load_csv_files(conn, table, filenames, kinds=None, progress=None,
+                   workers=None, block_bytes=DEFAULT_BLOCK_BYTES,
+                   encoding='utf-8', header=True):
+    '''
+    Loads CSV files into an existing SQLite table and returns the number of
+    rows inserted. Rows are inserted but not committed.
+    kinds -- per column conversions (see column_kind), by default derived
+             from the table's declared column types
+    progress -- optional callable(bytes_done, total_bytes); if it returns
+                False the load stops with IngestCancelled
+    workers -- number of parsing processes (default: up to 4); with 1 the
+               files are parsed in this process
+    header -- whether the first line of each file holds column names
+    '''
+    if kinds is None:
+        declared = conn.execute('PRAGMA table_info(%s)'%(table)).fetchall()
+        kinds = [column_kind(r[2]) for r in declared]
+    insert = 'INSERT INTO %s VALUES (%s)'%(table, ','.join(['?'] * len(kinds)))
+    total_bytes = sum([os.path.getsize(fn) for fn in filenames]) or 1
+    done_bytes = 0
+    nrows = 0
+    workers = workers or default_workers()
+
+    pool = None
+    if workers > 1:
+        try:
+            pool = multiprocessing.Pool(workers)
+        except Exception as e:
+            logging.warn('Could not start CSV parsing processes, parsing in-process: %s'%(e))
+
+    def blocks():
+        for fn in filenames:
+            with open(fn, 'rb') as f:
+                if header:
+                    f.readline()
+                for block in iter_blocks(f, block_bytes):
+                    yield block, len(block)
+
+    try:
+        # keep a bounded number of blocks in flight so memory use doesn't
+        # grow with the size of the input
+        pending = deque()
+        for block, nbytes in blocks():
+            if pool is not None:
+                pending.append((pool.apply_async(parse_block, ((block, kinds, encoding),)), nbytes))
+                if len(pending) < 2 * workers:
+                    continue
+                result, nbytes = pending.popleft()
+                rows = result.get()
+            else:
+                rows = parse_block((block, kinds, encoding))
+            conn.executemany(insert, rows)
+            nrows += len(rows)
+            done_bytes += nbytes
+            if progress is not None and progress(done_bytes, total_bytes) is False:
+                raise IngestCancelled()
+        while pending:
+            result, nbytes = pending.popleft()
+            rows = result.get()
+            conn.executemany(insert, rows)
+            nrows += len(rows)
+            done_bytes += nbytes
+            if progress is not None and progress(done_bytes, total_bytes) is False:
+                raise IngestCancelled()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return nrows
+
+
+def split_primary_key(create_stmt):
+    '''
+    Removes a table level PRIMARY KEY (...) clause from a CREATE TABLE
+    statement so the key can be indexed after loading. Returns the new
+    statement and the list of key columns (empty if there was none).
+    '''
+    match = re.search(r',\s*PRIMARY\s+KEY\s*\(([^)]*)\)', create_stmt, re.IGNORECASE)
+    if match is None:
+        return create_stmt, []
+    columns = [c.strip().strip('`"') for c in match.group(1).split(',')]
+    return create_stmt[:match.start()] + create_stmt[match.end():], columns
+
+
+def create_indexes(conn, table, primary_key=(), indexes=()):
+    '''
+    Builds indexes on a loaded table. primary_key becomes a unique index;
+    indexes is a list of column lists.
+    '''
+    if primary_key:
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s_pkey ON %s (%s)'
+                     %(table, table, ', '.join(primary_key)))
+    for columns in indexes:
+        conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                     %(table, '_'.join(columns), table, ', '.join(columns)))
@@ -0,0 +1,104 @@
+'''
+Binary snapshots of the populated DataModel, kept under ~/CPA so a project
+can be reopened without recounting its objects.
+
+A snapshot file is a fixed preamble (magic, format version and header
+length), a JSON header, and the raw bytes of each array aligned to
+ALIGNMENT bytes. Arrays are loaded as read-only views of a memory map of the
+file, so opening a snapshot costs little more than reading its header.
+'''
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+MAGIC = b'CPADM\0'
+SNAPSHOT_VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<6sHQ')
+
+
+def snapshot_path(directory, identity):
+    '''Returns the snapshot file in directory for an identity string.'''
+    return os.path.join(directory, hashlib.sha1(identity.encode('utf-8')).hexdigest() + '.dm')
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_snapshot(path, identity, stamp, arrays, meta):
+    '''
+    Writes a snapshot atomically.
+    identity -- string naming what the snapshot was built from
+    stamp -- string that must match at load time for the snapshot to be
+             valid, eg: the database modify date
+    arrays -- {name: numpy array}
+    meta -- JSON serializable dict of everything else
+    '''
+    arrays = dict((name, np.ascontiguousarray(a)) for name, a in arrays.items())
+    layout = {}
+    offset = 0
+    for name, a in arrays.items():
+        layout[name] = [a.dtype.str, list(a.shape), offset]
+        offset = _aligned(offset + a.nbytes)
+    header = json.dumps({'identity': identity, 'stamp': stamp,
+                         'arrays': layout, 'meta': meta}).encode('utf-8')
+    data_start = _aligned(_PREAMBLE.size + len(header))
+    tmp = '%s.%d.%d.tmp'%(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(_PREAMBLE.pack(MAGIC, SNAPSHOT_VERSION, len(header)))
+            f.write(header)
+            for name, a in arrays.items():
+                f.seek(data_start + layout[name][2])
+                f.write(a.tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def load_snapshot(path, identity, stamp):
+    '''
+    Returns (arrays, meta) from a snapshot written by save_snapshot, or None
+    if there is no snapshot or it is stale, from another format version or
+    unreadable. The arrays are read-only and backed by a memory map.
+    '''
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _PREAMBLE.size:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_len = _PREAMBLE.unpack_from(mm, 0)
+        if magic != MAGIC or version != SNAPSHOT_VERSION:
+            logging.info('Ignoring DataModel snapshot "%s" from another version.'%(path))
+            return None
+        header = json.loads(mm[_PREAMBLE.size:_PREAMBLE.size + header_len].decode('utf-8'))
+        if header['identity'] != identity or header['stamp'] != stamp:
+            return None
+        data_start = _aligned(_PREAMBLE.size + header_len)
+        arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape, dtype=np.int64))
+            if count == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.frombuffer(mm, dtype=dtype, count=count,
+                                         offset=data_start + offset).reshape(shape)
+        return arrays, header['meta']
+    except Exception as e:
+        logging.warn('Could not read DataModel snapshot "%s": %s'%(path, e))
+        return None
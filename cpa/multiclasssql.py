@@ -8,6 +8,7 @@ sys.path.insert(1, '/home/vagrant/cpa-multiclass/CellProfiler-Analyst/cpa');
 sys.path.insert(1, '/home/vagrant/cpa-multiclass/CellProfiler-Analyst/')
 
 import threading
+from contextlib import nullcontext
 import cpa.sqltools
 from .dbconnect import DBConnect, UniqueObjectClause, UniqueImageClause, image_key_columns, object_key_columns, GetWhereClauseForImages, GetWhereClauseForObjects, object_key_defs
 from .properties import Properties
@@ -53,22 +54,27 @@ def create_perobject_class_table(classifier, classNames, updater):
     updater(0, "Classifying objects...")
     logging.info('Classifying objects...')
     logging.info('Any values that cannot be converted to float will be set to 0')
-    for start in range(0, cap, chunk_size):
+    n_key_cols = len(object_key_columns())
+    query = (f'SELECT {UniqueObjectClause(p.object_table)}, {",".join(db.GetColnamesForClassifier())} '
+             f'FROM {p.object_table}')
+    start = 0
+    # Stream the object table in blocks instead of re-scanning it with LIMIT offsets.
+    for block in db.fetch_blocks(query, block_rows=chunk_size, silent=True):
         updater(int(start / cap * 100), f"Classifying objects... {start}")
 
         logging.debug(f"Classifying objects... {start}")
-        data = db.execute(f'SELECT {UniqueObjectClause(p.object_table)}, {",".join(db.GetColnamesForClassifier())} '
-                          f'FROM {p.object_table} LIMIT {start}, {chunk_size}', silent=True)
+        start += len(block)
 
         logging.debug('Getting predictions...')
-        cell_data, object_keys = processData(data)
+        object_keys = block[:, :n_key_cols].astype(int)
+        cell_data = np.nan_to_num(block[:, n_key_cols:])
         predicted_classes = classifier.Predict(cell_data)
         try:
             logging.debug('Preparing data table...')
             # We need to pass a connection object to Pandas so it can do all the work for us.
+            # While fetch_blocks streams on MySQL, this checks out a spare connection.
             connID = threading.currentThread().getName()
-            if connID not in db.connections:
-                db.connect()
+            db._ensure_connection(connID)
             conn = db.connections[connID]
             class_data = pd.DataFrame(data=object_keys, columns=object_key_columns())
             class_data["class"] = [classNames[i - 1] for i in predicted_classes]
@@ -91,8 +97,8 @@ def FilterObjectsFromClassN(classNum, classifier, filterKeys, uncertain):
     classifier: trained classifier object
     filterKeys: (optional) A list of specific imKeys OR obKeys (NOT BOTH)
         to classify.
-        * WARNING: If this list is too long, you may exceed the size limit to
-          MySQL queries.
+        * Lists longer than Properties.db_key_table_threshold are matched
+          through a temporary key table rather than spelled out in the query.
         * Useful when fetching N objects from a particular class. Use the
           DataModel to get batches of random objects, and sift through them
           here until N objects of the desired class have been accumulated.
@@ -105,25 +111,28 @@ def FilterObjectsFromClassN(classNum, classifier, filterKeys, uncertain):
     if filterKeys != [] and filterKeys is not None:
 
         if isinstance(filterKeys, str):
-            whereclause = filterKeys #+ " AND"
+            where = nullcontext(filterKeys) #+ " AND"
         else:
             isImKey = len(filterKeys[0]) == len(image_key_columns())
             if isImKey:
-                whereclause = GetWhereClauseForImages(filterKeys) #+ " AND"
+                where = db.where_clause_for_images(filterKeys, p.object_table) #+ " AND"
             else:
-                whereclause = GetWhereClauseForObjects(filterKeys) #+ " AND"
+                where = db.where_clause_for_objects(filterKeys, p.object_table) #+ " AND"
     else:
-        whereclause = ""
-
-    if p.area_scoring_column:
-        data = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(p.object_table),
-        ",".join(db.GetColnamesForClassifier()),
-        _objectify(p, p.area_scoring_column), p.object_table, whereclause))
-        area_score = data[-1] #separate area from data
-        data = data[:-1]
-    else:
-        data = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(p.object_table),
-        ",".join(db.GetColnamesForClassifier()), p.object_table, whereclause))
+        where = nullcontext("")
+
+    # long key lists are joined through a temporary table that only lives
+    # for the duration of the with block
+    with where as whereclause:
+        if p.area_scoring_column:
+            data = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(p.object_table),
+            ",".join(db.GetColnamesForClassifier()),
+            _objectify(p, p.area_scoring_column), p.object_table, whereclause))
+            area_score = data[-1] #separate area from data
+            data = data[:-1]
+        else:
+            data = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(p.object_table),
+            ",".join(db.GetColnamesForClassifier()), p.object_table, whereclause))
 
     cell_data, object_keys = processData(data)#, p.check_tables=='yes')
     res = [] # list
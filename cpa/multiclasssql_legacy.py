@@ -30,6 +30,13 @@ def translate(weaklearners):
         b = numpy.array([wl[3] for wl in weaklearners])
         db.setup_sqlite_classifier(thresholds, a, b)
         return "classifier(%s)"%(",".join([wl[0] for wl in weaklearners]))
+    if p.db_type.lower() == 'duckdb':
+        # same function as sqlite, but the features are passed as a list
+        thresholds = numpy.array([wl[1] for wl in weaklearners])
+        a = numpy.array([wl[2] for wl in weaklearners])
+        b = numpy.array([wl[3] for wl in weaklearners])
+        db.setup_sqlite_classifier(thresholds, a, b)
+        return "classifier([%s])"%(",".join([wl[0] for wl in weaklearners]))
     
     if p.db_type.lower() == 'mysql':
         # MySQL
@@ -273,7 +273,7 @@ class PlateMapPanel(wx.Panel):
         imgs = {}
         if self.well_disp == IMAGE:
             if p.plate_id:
-                wells_and_images = db.execute('SELECT %s, %s FROM %s WHERE %s="%s" GROUP BY %s'%(
+                wells_and_images = db.execute("SELECT %s, %s FROM %s WHERE %s='%s' GROUP BY %s"%(
                     p.well_id, p.image_id, p.image_table, p.plate_id, self.plate, 
                     p.well_id))
             else:
@@ -285,7 +285,7 @@ class PlateMapPanel(wx.Panel):
         elif self.well_disp == THUMBNAIL:
             assert p.image_thumbnail_cols, 'No thumbnail columns are defined in the database. Platemap cannot be drawn.'
             if p.plate_id:
-                wells_and_images = db.execute('SELECT %s, %s FROM %s WHERE %s="%s" GROUP BY %s'%(
+                wells_and_images = db.execute("SELECT %s, %s FROM %s WHERE %s='%s' GROUP BY %s"%(
                     p.well_id, ','.join(p.image_thumbnail_cols), p.image_table, 
                     p.plate_id, self.plate, p.well_id))
             else:
@@ -356,7 +356,6 @@ class PlateMapPanel(wx.Panel):
                                                                  display_whole_image=True)
                             dc.DrawBitmap(bmp[well], px+1, py+1)
                     elif self.well_disp == IMAGE:
-                        p.image_buffer_size = p.plate_shape[0] * p.plate_shape[1]
                         wellkey = self.GetWellKeyAtCoord(px+r, py+r)
                         well = wellkey[-1]
                         if well in imgs:
@@ -445,7 +444,7 @@ class PlateMapPanel(wx.Panel):
     def OnDClick(self, evt):
         if self.plate is not None:
             well = self.GetWellLabelAtCoord(self.GetX(evt), self.GetY(evt))
-            imKeys = db.execute('SELECT %s FROM %s WHERE %s="%s" AND %s="%s"'%
+            imKeys = db.execute("SELECT %s FROM %s WHERE %s='%s' AND %s='%s'"%
                                 (UniqueImageClause(), p.image_table, p.well_id, well, p.plate_id, self.plate), silent=False)
             for imKey in imKeys:
                 imagetools.ShowImage(imKey, self.chMap, parent=self)
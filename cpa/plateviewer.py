@@ -260,7 +260,7 @@ class PlateViewer(wx.Frame, CPATool):
                 q.add_filter(p.gates[fltr].as_filter())
             else:
                 raise Exception('Could not find filter "%s" in gates or filters'%(fltr))
-        wellkeys_and_values = db.execute(str(q))
+        wellkeys_and_values = db.execute_cached(str(q))
         wellkeys_and_values = np.array(wellkeys_and_values, dtype=object)
 
         # Replace measurement None's with nan
@@ -591,7 +591,7 @@ class PlateViewer(wx.Frame, CPATool):
             if self.outlineMarked.IsChecked():
                 column = self.annotationCol.Value
                 if p.plate_id:
-                    res = db.execute('SELECT %s, %s FROM %s WHERE %s="%s"'%(
+                    res = db.execute("SELECT %s, %s FROM %s WHERE %s='%s'"%(
                         dbconnect.UniqueWellClause(), column, p.image_table, 
                         p.plate_id, pm.plate))
                 else:
@@ -47,13 +47,24 @@ string_vars = ['db_type',
                'image_tile_size',
                'image_buffer_size',
                'tile_buffer_size',
+               'tile_loader_threads',
+               'tile_store',
+               'image_cache_size',
+               'image_cache_spill_size',
+               'bitmap_cache_size',
+               'image_pyramid_size',
+               'image_pyramid_disk_size',
+               'image_region_reads',
+               'image_z_projection',
                'area_scoring_column',
                'training_set',
                'class_table',
                'plate_type',
                'check_tables',
+               'check_tables_incremental',
                'db_sql_file',
                'db_sqlite_file',
+               'db_duckdb_file',
                'use_larger_image_scale',
                'rescale_object_coords',
                'well_format',
@@ -68,7 +79,13 @@ string_vars = ['db_type',
                'class_names',
                'force_bioformats',
                'use_legacy_fetcher',
-               'process_3D'
+               'process_3D',
+               'db_pool_size',
+               'db_pool_idle_timeout',
+               'db_key_table_threshold',
+               'db_query_cache',
+               'db_query_cache_size',
+               'datamodel_cache',
                ]
 
 list_vars = ['image_path_cols', 'image_channel_paths',
@@ -104,14 +121,25 @@ optional_vars = ['db_port',
                  'class_table',
                  'image_buffer_size',
                  'tile_buffer_size',
+                 'tile_loader_threads',
+                 'tile_store',
+                 'image_cache_size',
+                 'image_cache_spill_size',
+                 'bitmap_cache_size',
+                 'image_pyramid_size',
+                 'image_pyramid_disk_size',
+                 'image_region_reads',
+                 'image_z_projection',
                  'plate_id',
                  'well_id',
                  'plate_type',
                  'classifier_ignore_substrings', 'classifier_ignore_columns',
                  'object_name',
                  'check_tables',
+                 'check_tables_incremental',
                  'db_sql_file',
                  'db_sqlite_file',
+                 'db_duckdb_file',
                  'object_table',
                  'object_id',
                  'cell_x_loc',
@@ -134,7 +162,13 @@ optional_vars = ['db_port',
                  'class_names',
                  'force_bioformats',
                  'use_legacy_fetcher',
-                 'process_3D'
+                 'process_3D',
+                 'db_pool_size',
+                 'db_pool_idle_timeout',
+                 'db_key_table_threshold',
+                 'db_query_cache',
+                 'db_query_cache_size',
+                 'datamodel_cache',
                  ]
 
 # map deprecated fields to new fields
@@ -501,16 +535,25 @@ class Properties(metaclass=Singleton):
         for name in required_vars_all:
             assert self.field_defined(name), '[Properties] ERROR (%s): Field is missing or empty.'%(name)
 
-        assert self.db_type.lower() in ['mysql', 'sqlite'], '[Properties] ERROR (db_type): Value must be either "mysql" or "sqlite".'
+        assert self.db_type.lower() in ['mysql', 'sqlite', 'duckdb'], '[Properties] ERROR (db_type): Value must be "mysql", "sqlite" or "duckdb".'
 
         # BELOW: Check sometimes-optional fields, and print warnings etc
-        if self.db_type.lower()=='sqlite':
+        if self.db_type.lower() in ['sqlite', 'duckdb']:
+            db_type = self.db_type.lower()
+            db_file_field = 'db_%s_file'%(db_type)
             for field in ['db_port', 'db_host', 'db_name', 'db_user', 'db_passwd',]:
                 if self.field_defined(field):
-                    logging.info('[Properties] DEBUG (%s): Field not required with db_type=sqlite.'%(field))
+                    logging.info('[Properties] DEBUG (%s): Field not required with db_type=%s.'%(field, db_type))
 
-            assert any([self.field_defined(field) for field in ['image_csv_file','object_csv_file','db_sql_file','db_sqlite_file']]), \
-                    '[Properties] ERROR: When using db_type=sqlite, you must also supply the fields "image_csv_file" and "object_csv_file" OR "db_sql_file" OR "db_sqlite_file". See the README.'
+            assert any([self.field_defined(field) for field in ['image_csv_file','object_csv_file','db_sql_file',db_file_field]]), \
+                    '[Properties] ERROR: When using db_type=%s, you must also supply the fields "image_csv_file" and "object_csv_file" OR "db_sql_file" OR "%s". See the README.'%(db_type, db_file_field)
+
+            if db_type == 'duckdb' and self.field_defined('db_duckdb_file'):
+                if not os.path.isabs(self.db_duckdb_file):
+                    # Make relative paths relative to the props file location
+                    self.db_duckdb_file = os.path.join(os.path.dirname(self._filename), self.db_duckdb_file)
+                if not os.path.isfile(self.db_duckdb_file):
+                    raise Exception('[Properties] ERROR (%s): DuckDB database could not be found at "%s".'%('db_duckdb_file', self.db_duckdb_file))
 
             if self.field_defined('db_sqlite_file'):
                 if not os.path.isabs(self.db_sqlite_file):
@@ -602,14 +645,94 @@ class Properties(metaclass=Singleton):
         if not self.field_defined('classifier_ignore_columns'):
             logging.warn('[Properties] INFORNING (classifier_ignore_columns): No value(s) specified. Classifier will use ALL NUMERIC per_object columns when training.')
 
-        if not self.field_defined('image_buffer_size'):
-            logging.info('[Properties]: Using default image_buffer_size=1')
-            self.image_buffer_size = '1'
-
         if not self.field_defined('tile_buffer_size'):
             logging.info('[Properties]: Using default tile_buffer_size=1')
             self.tile_buffer_size = '1'
 
+        if self.field_defined('db_pool_size'):
+            try:
+                self.db_pool_size = int(self.db_pool_size)
+                assert self.db_pool_size > 0
+            except (ValueError, AssertionError):
+                logging.warn('[Properties] WARNING (db_pool_size): Field value "%s" is invalid. Using default.'%(self.db_pool_size))
+                self.db_pool_size = None
+
+        if self.field_defined('tile_loader_threads'):
+            try:
+                self.tile_loader_threads = int(self.tile_loader_threads)
+                assert self.tile_loader_threads > 0
+            except (ValueError, AssertionError):
+                logging.warn('[Properties] WARNING (tile_loader_threads): Field value "%s" is invalid. Using default.'%(self.tile_loader_threads))
+                self.tile_loader_threads = None
+
+        if self.field_defined('image_cache_size'):
+            try:
+                self.image_cache_size = float(self.image_cache_size)
+                assert self.image_cache_size > 0
+            except (ValueError, AssertionError):
+                logging.warn('[Properties] WARNING (image_cache_size): Field value "%s" is invalid. Using default.'%(self.image_cache_size))
+                self.image_cache_size = None
+
+        if self.field_defined('image_cache_spill_size'):
+            try:
+                self.image_cache_spill_size = float(self.image_cache_spill_size)
+                assert self.image_cache_spill_size >= 0
+            except (ValueError, AssertionError):
+                logging.warn('[Properties] WARNING (image_cache_spill_size): Field value "%s" is invalid. Using default.'%(self.image_cache_spill_size))
+                self.image_cache_spill_size = None
+
+        if self.field_defined('bitmap_cache_size'):
+            try:
+                self.bitmap_cache_size = float(self.bitmap_cache_size)
+                assert self.bitmap_cache_size >= 0
+            except (ValueError, AssertionError):
+                logging.warn('[Properties] WARNING (bitmap_cache_size): Field value "%s" is invalid. Using default.'%(self.bitmap_cache_size))
+                self.bitmap_cache_size = None
+
+        if self.field_defined('image_pyramid_size'):
+            try:
+                self.image_pyramid_size = int(self.image_pyramid_size)
+                assert self.image_pyramid_size >= 0
+            except (ValueError, AssertionError):
+                logging.warn('[Properties] WARNING (image_pyramid_size): Field value "%s" is invalid. Using default.'%(self.image_pyramid_size))
+                self.image_pyramid_size = None
+
+        if self.field_defined('image_pyramid_disk_size'):
+            try:
+                self.image_pyramid_disk_size = float(self.image_pyramid_disk_size)
+                assert self.image_pyramid_disk_size > 0
+            except (ValueError, AssertionError):
+                logging.warn('[Properties] WARNING (image_pyramid_disk_size): Field value "%s" is invalid. Using default.'%(self.image_pyramid_disk_size))
+                self.image_pyramid_disk_size = None
+
+        if self.field_defined('image_z_projection'):
+            self.image_z_projection = self.image_z_projection.lower()
+            if self.image_z_projection not in ('mid', 'max', 'mean'):
+                logging.warn('[Properties] WARNING (image_z_projection): Field value "%s" is invalid. Using default.'%(self.image_z_projection))
+                self.image_z_projection = None
+
+        if self.field_defined('db_pool_idle_timeout'):
+            try:
+                self.db_pool_idle_timeout = float(self.db_pool_idle_timeout)
+            except ValueError:
+                logging.warn('[Properties] WARNING (db_pool_idle_timeout): Field value "%s" is invalid. Using default.'%(self.db_pool_idle_timeout))
+                self.db_pool_idle_timeout = None
+
+        if self.field_defined('db_key_table_threshold'):
+            try:
+                self.db_key_table_threshold = int(self.db_key_table_threshold)
+            except ValueError:
+                logging.warn('[Properties] WARNING (db_key_table_threshold): Field value "%s" is invalid. Using default.'%(self.db_key_table_threshold))
+                self.db_key_table_threshold = None
+
+        if self.field_defined('db_query_cache_size'):
+            try:
+                self.db_query_cache_size = float(self.db_query_cache_size)
+                assert self.db_query_cache_size > 0
+            except (ValueError, AssertionError):
+                logging.warn('[Properties] WARNING (db_query_cache_size): Field value "%s" is invalid. Using default.'%(self.db_query_cache_size))
+                self.db_query_cache_size = None
+
         if not self.field_defined('object_name'):
             logging.warn('[Properties] WARNING (object_name): No object name specified, will use default: "object_name=cell,cells"')
             self.object_name = ['cell', 'cells']
@@ -677,6 +800,16 @@ class Properties(metaclass=Singleton):
             logging.warn('[Properties] WARNING (check_tables): Field value "%s" is invalid. Replacing with "no".'%(self.check_tables))
             self.check_tables = 'no'
 
+        if self.field_defined('check_tables_incremental') and self.check_tables_incremental.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.check_tables_incremental = True
+        elif self.field_defined('check_tables_incremental') and self.check_tables_incremental.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.check_tables_incremental = False
+        elif self.field_defined('check_tables_incremental'):
+            logging.warn(f'[Properties] WARNING (check_tables_incremental): Field was invalid ({self.check_tables_incremental}), using default of "False".')
+            self.check_tables_incremental = False
+        else:
+            self.check_tables_incremental = False
+
         if self.field_defined('force_bioformats') and self.force_bioformats.lower() in ['true', 'yes', 'on', 't', 'y']:
             self.force_bioformats = True
         elif self.field_defined('force_bioformats') and self.force_bioformats.lower() in ['false', 'no', 'off', 'f', 'n']:
@@ -697,6 +830,46 @@ class Properties(metaclass=Singleton):
         else:
             self.use_legacy_fetcher = False
 
+        if self.field_defined('db_query_cache') and self.db_query_cache.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.db_query_cache = True
+        elif self.field_defined('db_query_cache') and self.db_query_cache.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.db_query_cache = False
+        elif self.field_defined('db_query_cache'):
+            logging.warn(f'[Properties] WARNING (db_query_cache): Field was invalid ({self.db_query_cache}), using default of "False".')
+            self.db_query_cache = False
+        else:
+            self.db_query_cache = False
+
+        if self.field_defined('datamodel_cache') and self.datamodel_cache.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.datamodel_cache = True
+        elif self.field_defined('datamodel_cache') and self.datamodel_cache.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.datamodel_cache = False
+        elif self.field_defined('datamodel_cache'):
+            logging.warn(f'[Properties] WARNING (datamodel_cache): Field was invalid ({self.datamodel_cache}), using default of "False".')
+            self.datamodel_cache = False
+        else:
+            self.datamodel_cache = False
+
+        if self.field_defined('tile_store') and self.tile_store.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.tile_store = True
+        elif self.field_defined('tile_store') and self.tile_store.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.tile_store = False
+        elif self.field_defined('tile_store'):
+            logging.warn(f'[Properties] WARNING (tile_store): Field was invalid ({self.tile_store}), using default of "False".')
+            self.tile_store = False
+        else:
+            self.tile_store = False
+
+        if self.field_defined('image_region_reads') and self.image_region_reads.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.image_region_reads = True
+        elif self.field_defined('image_region_reads') and self.image_region_reads.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.image_region_reads = False
+        elif self.field_defined('image_region_reads'):
+            logging.warn(f'[Properties] WARNING (image_region_reads): Field was invalid ({self.image_region_reads}), using default of "True".')
+            self.image_region_reads = True
+        else:
+            self.image_region_reads = True
+
         if self.field_defined('process_3D') and self.process_3D.lower() in ['true', 'yes', 'on', 't', 'y']:
             self.process_3D = True
         elif self.field_defined('process_3D') and self.process_3D.lower() in ['false', 'no', 'off', 'f', 'n']:
@@ -0,0 +1,254 @@
+'''
+Multi-resolution pyramids of large images, so ImageViewer can show a
+stitched or whole-well image zoomed out without decoding it at full
+resolution every time it's opened.
+
+Level 0 is the image itself and each further level halves the width and
+height of the one before by averaging 2 x 2 blocks, until a level fits in
+one chunk. Each level of each channel is stored as a .npy file of
+CHUNK x CHUNK blocks, shape (rows of blocks, columns of blocks, CHUNK,
+CHUNK), and read through a memory map, so reading a region of a level only
+reads the blocks it overlaps. A JSON file, written last, records the image
+shape, the intensity range of each channel and the modification time of
+the image's files; a pyramid whose files have changed since is rebuilt.
+
+A pyramid is built in a temporary directory next to its own, which then
+takes its place, so a viewer still reading an older pyramid of the image
+keeps its files. prune removes the least recently opened pyramids when
+they use more disk space than allowed.
+'''
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from .render import downsample
+
+CHUNK = 512
+META_FILE = 'pyramid.json'
+PYRAMID_VERSION = 1
+# temporary directories older than this (seconds) are left from failed builds
+STALE_BUILD_AGE = 24 * 3600
+
+
+def level_for_scale(scale, nlevels):
+    '''
+    Returns the smallest pyramid level with at least the resolution needed
+    to draw the image at scale.
+    '''
+    if scale >= 1:
+        return 0
+    return int(min(nlevels - 1, np.floor(np.log2(1. / scale) + 1e-9)))
+
+
+class Pyramid(object):
+    '''
+    A pyramid stored in directory. Use Pyramid.open or Pyramid.build.
+    shape -- (height, width) of level 0
+    limits -- (min, max) intensity of each channel at full resolution
+    '''
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.shape = tuple(meta['shape'])
+        self.nchannels = meta['nchannels']
+        self.nlevels = meta['nlevels']
+        self.limits = [tuple(lim) for lim in meta['limits']]
+        self.mtime = meta['mtime']
+        self.maps = {}   # (channel, level) -> read-only memmap of the blocks
+
+    @staticmethod
+    def _path(directory, channel, level):
+        return os.path.join(directory, 'c%d_l%d.npy'%(channel, level))
+
+    @classmethod
+    def open(cls, directory, mtime):
+        '''
+        Returns the pyramid stored in directory, or None if there is none,
+        or it was built from image files with another modification time.
+        '''
+        path = os.path.join(directory, META_FILE)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warn('Could not read image pyramid "%s": %s'%(path, e))
+            return None
+        if meta.get('version') != PYRAMID_VERSION or meta.get('mtime') != mtime:
+            return None
+        try:
+            os.utime(path, None)   # for prune
+        except OSError:
+            pass
+        return cls(directory, meta)
+
+    @classmethod
+    def build(cls, directory, channels, mtime, limits=None):
+        '''
+        Builds and stores the pyramid of an image.
+        channels -- list of 2D channel arrays of the same shape
+        mtime -- modification time of the image's files, see Pyramid.open
+        limits -- (min, max) of each channel, computed if not given
+        '''
+        parent, name = os.path.split(os.path.abspath(directory))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        build_dir = tempfile.mkdtemp(prefix=name + '.', dir=parent)
+        try:
+            meta = cls._build_levels(build_dir, channels, mtime, limits)
+            cls._swap(build_dir, directory)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        return cls(directory, meta)
+
+    @classmethod
+    def _build_levels(cls, directory, channels, mtime, limits):
+        if limits is None:
+            limits = [(im.min(), im.max()) for im in channels]
+        nlevels = 0
+        for c, im in enumerate(channels):
+            level, n = im, 0
+            while True:
+                cls._write_level(cls._path(directory, c, n), level)
+                n += 1
+                if max(level.shape) <= CHUNK:
+                    break
+                level = downsample(level, 2)
+            nlevels = n
+        meta = {'version': PYRAMID_VERSION,
+                'shape': list(channels[0].shape),
+                'nchannels': len(channels),
+                'nlevels': nlevels,
+                'limits': [[float(lo), float(hi)] for lo, hi in limits],
+                'mtime': mtime}
+        with open(os.path.join(directory, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        return meta
+
+    @staticmethod
+    def _swap(build_dir, directory):
+        # Files of the old pyramid are unlinked rather than overwritten, so
+        # memory maps of them stay valid.
+        old_dir = None
+        if os.path.exists(directory):
+            old_dir = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.', dir=os.path.dirname(build_dir))
+            os.replace(directory, os.path.join(old_dir, 'old'))
+        try:
+            os.replace(build_dir, directory)
+        finally:
+            if old_dir is not None:
+                shutil.rmtree(old_dir, ignore_errors=True)
+
+    @staticmethod
+    def _write_level(path, level):
+        h, w = level.shape
+        ny, nx = -(-h // CHUNK), -(-w // CHUNK)
+        blocks = np.lib.format.open_memmap(path, mode='w+', dtype=level.dtype, shape=(ny, nx, CHUNK, CHUNK))
+        for iy in range(ny):
+            rows = level[iy * CHUNK:(iy + 1) * CHUNK]
+            for ix in range(nx):
+                block = rows[:, ix * CHUNK:(ix + 1) * CHUNK]
+                blocks[iy, ix, :block.shape[0], :block.shape[1]] = block
+        blocks.flush()
+        del blocks
+
+    def level_shape(self, level):
+        '''Returns the (height, width) of a level.'''
+        h, w = self.shape
+        for i in range(level):
+            h, w = h // 2, w // 2
+        return h, w
+
+    def level_for_scale(self, scale):
+        return level_for_scale(scale, self.nlevels)
+
+    def _blocks(self, channel, level):
+        key = (channel, level)
+        if key not in self.maps:
+            self.maps[key] = np.load(self._path(self.directory, channel, level), mmap_mode='r')
+        return self.maps[key]
+
+    def read(self, channel, level, region=None):
+        '''
+        Returns a channel of a level, or the region (x0, y0, x1, y1) of it in
+        that level's pixel coordinates, reading only the blocks it overlaps.
+        '''
+        h, w = self.level_shape(level)
+        x0, y0, x1, y1 = region or (0, 0, w, h)
+        x0, y0 = max(0, int(x0)), max(0, int(y0))
+        x1, y1 = min(w, int(x1)), min(h, int(y1))
+        blocks = self._blocks(channel, level)
+        if x1 <= x0 or y1 <= y0:
+            return np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=blocks.dtype)
+        by0, bx0 = y0 // CHUNK, x0 // CHUNK
+        by1, bx1 = -(-y1 // CHUNK), -(-x1 // CHUNK)
+        sub = np.asarray(blocks[by0:by1, bx0:bx1])
+        sub = sub.swapaxes(1, 2).reshape((by1 - by0) * CHUNK, (bx1 - bx0) * CHUNK)
+        oy, ox = y0 - by0 * CHUNK, x0 - bx0 * CHUNK
+        return np.ascontiguousarray(sub[oy:oy + y1 - y0, ox:ox + x1 - x0])
+
+    def channels(self, level, region=None):
+        '''Returns every channel of a level (or of a region of it).'''
+        return [self.read(c, level, region) for c in range(self.nchannels)]
+
+
+def directory_size(directory):
+    '''Returns the total size in bytes of the files under directory.'''
+    nbytes = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            try:
+                nbytes += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return nbytes
+
+
+def prune(root, max_bytes, keep=()):
+    '''
+    Removes the least recently opened pyramids under root until the rest use
+    at most max_bytes, and any temporary directories left by failed builds.
+    keep -- directories of pyramids that are not removed, eg: in use
+    Returns the number of bytes removed.
+    '''
+    keep = set(os.path.abspath(d) for d in keep)
+    pyramids, total, removed = [], 0, 0
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return 0
+    for name in names:
+        path = os.path.join(root, name)
+        if not os.path.isdir(path) or os.path.abspath(path) in keep:
+            continue
+        if '.' in name:
+            # a build in progress, or left over from a failed one
+            try:
+                stale = time.time() - os.path.getmtime(path) > STALE_BUILD_AGE
+            except OSError:
+                continue
+            if stale:
+                removed += directory_size(path)
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        try:
+            used = os.path.getmtime(os.path.join(path, META_FILE))
+        except OSError:
+            used = 0
+        nbytes = directory_size(path)
+        pyramids.append((used, path, nbytes))
+        total += nbytes
+    total += sum(directory_size(d) for d in keep if os.path.isdir(d))
+    for used, path, nbytes in sorted(pyramids):
+        if total <= max_bytes:
+            break
+        logging.info('Removing image pyramid "%s" to stay within the disk budget'%(path))
+        shutil.rmtree(path, ignore_errors=True)
+        total -= nbytes
+        removed += nbytes
+    return removed
@@ -0,0 +1,178 @@
+'''
+A size-bounded LRU cache for query results, kept in memory and (optionally)
+on disk so results survive between sessions. Used by
+DBConnect.execute_cached.
+'''
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    '''
+    Maps string keys to picklable values. The memory tier and the disk tier
+    are each bounded to max_bytes (measured as pickled size) and evict their
+    least recently used entries first. Entries may be put in a group (eg:
+    one per database), so that they can be discarded without touching the
+    others.
+    directory -- where cache files are written, or None for memory only
+    '''
+    def __init__(self, max_bytes=64 * 2**20, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()   # (group, key) -> (value, nbytes)
+        self.memory_bytes = 0
+        self.disk = OrderedDict()     # file name -> nbytes, oldest first
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory is not None:
+            self._scan_directory()
+
+    def _scan_directory(self):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            files = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    st = os.stat(os.path.join(self.directory, name))
+                    files.append((st.st_mtime, name, st.st_size))
+        except OSError as e:
+            logging.warn('Query cache directory "%s" is unusable, caching in memory only: %s'%(self.directory, e))
+            self.directory = None
+            return
+        for mtime, name, size in sorted(files):
+            self.disk[name] = size
+            self.disk_bytes += size
+        with self.lock:
+            self._evict_disk()
+
+    def _filename(self, key, group=None):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl'
+        return name if group is None else '%s-%s'%(group, name)
+
+    def get(self, key, default=None, group=None):
+        '''Returns the cached value for key, or default on a miss.'''
+        with self.lock:
+            if (group, key) in self.memory:
+                self.memory.move_to_end((group, key))
+                self.hits += 1
+                return self.memory[group, key][0]
+            name = self._filename(key, group)
+            if self.directory is None or name not in self.disk:
+                self.misses += 1
+                return default
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'rb') as f:
+                    # the key is pickled ahead of the value, see put
+                    stored_key = pickle.load(f)
+                    if stored_key != key:
+                        raise ValueError('hash collision')
+                    value = pickle.load(f)
+                    nbytes = f.tell()
+                os.utime(path, None)
+            except Exception:
+                self._remove_file(name)
+                self.misses += 1
+                return default
+            self.disk.move_to_end(name)
+            self.hits += 1
+            self.disk_hits += 1
+            self._put_memory(key, value, nbytes, group)
+            return value
+
+    def put(self, key, value, group=None):
+        '''Stores value under key in memory and on disk.'''
+        data = (pickle.dumps(key, pickle.HIGHEST_PROTOCOL) +
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self._put_memory(key, value, len(data), group)
+            if self.directory is None or len(data) > self.max_bytes:
+                return
+            name = self._filename(key, group)
+            path = os.path.join(self.directory, name)
+            try:
+                tmp = '%s.%d.tmp'%(path, threading.get_ident())
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except OSError as e:
+                logging.warn('Failed to write query cache file "%s": %s'%(path, e))
+                return
+            self.disk_bytes += len(data) - self.disk.pop(name, 0)
+            self.disk[name] = len(data)
+            self._evict_disk()
+
+    def _put_memory(self, key, value, nbytes, group):
+        # Caller must hold self.lock
+        if (group, key) in self.memory:
+            self.memory_bytes -= self.memory.pop((group, key))[1]
+        if nbytes > self.max_bytes:
+            return
+        self.memory[group, key] = (value, nbytes)
+        self.memory_bytes += nbytes
+        while self.memory_bytes > self.max_bytes:
+            old_key, (old_value, old_nbytes) = self.memory.popitem(last=False)
+            self.memory_bytes -= old_nbytes
+
+    def _evict_disk(self):
+        # Caller must hold self.lock
+        while self.disk_bytes > self.max_bytes and self.disk:
+            self._remove_file(next(iter(self.disk)))
+
+    def _remove_file(self, name):
+        # Caller must hold self.lock
+        self.disk_bytes -= self.disk.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def clear(self):
+        '''Empties both tiers, deleting the cache files.'''
+        with self.lock:
+            self.memory = OrderedDict()
+            self.memory_bytes = 0
+            if self.directory is not None:
+                for name in list(self.disk):
+                    self._remove_file(name)
+
+    def discard(self, group, match=None):
+        '''
+        Removes the entries of a group from both tiers, or only those whose
+        key match(key) is true for. Only the keys of the group's cache files
+        are read.
+        '''
+        with self.lock:
+            for key_group, key in list(self.memory):
+                if key_group == group and (match is None or match(key)):
+                    self.memory_bytes -= self.memory.pop((key_group, key))[1]
+            if self.directory is None:
+                return
+            for name in [n for n in self.disk if n.startswith(group + '-')]:
+                if match is not None:
+                    try:
+                        with open(os.path.join(self.directory, name), 'rb') as f:
+                            if not match(pickle.load(f)):
+                                continue
+                    except Exception:
+                        pass
+                self._remove_file(name)
+
+    def stats(self):
+        '''Returns a dict of hit/miss counters and tier sizes.'''
+        with self.lock:
+            return {'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'memory_entries': len(self.memory),
+                    'memory_bytes': self.memory_bytes,
+                    'disk_entries': len(self.disk),
+                    'disk_bytes': self.disk_bytes}
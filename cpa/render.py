@@ -0,0 +1,182 @@
+'''
+Vectorized rendering of multichannel images to 8-bit RGB, used by
+imagetools.MergeToBitmap, MergeToBitmaps and MergeChannels.
+
+Channels are contrast-stretched to [0, 1] in float32 (or through a lookup
+table for 8 and 16 bit images), blended into RGB with one matrix multiply
+per blending mode, and converted to uint8 with the brightness applied.
+Large images are downsampled before any of this so the cost follows the
+displayed size. Tiles of the same shape can be rendered together into one
+(N, h, w, 3) buffer.
+'''
+import numpy as np
+
+COLORS = {'red'      : [1,0,0],
+          'green'    : [0,1,0],
+          'blue'     : [0,0,1],
+          'cyan'     : [0,1,1],
+          'yellow'   : [1,1,0],
+          'magenta'  : [1,0,1],
+          'gray'     : [1,1,1],
+          'none'     : [0,0,0] }
+
+# images with fewer pixels than this many times the lookup table size are
+# normalized directly
+LUT_MIN_RATIO = 4
+
+
+def color_matrix(chMap):
+    '''Returns the (channels, 3) float32 matrix of RGB weights for chMap.'''
+    return np.array([COLORS[c.lower()] for c in chMap], dtype=np.float32).reshape(-1, 3)
+
+
+def downsample(im, factor, mode='area'):
+    '''
+    Shrinks a 2D image by an integer factor, by averaging factor x factor
+    blocks ('area') or taking every factor'th pixel ('strided'). Edge pixels
+    that don't fill a block are dropped.
+    '''
+    if factor <= 1:
+        return im
+    if mode == 'strided':
+        return im[::factor, ::factor]
+    h, w = (im.shape[0] // factor) * factor, (im.shape[1] // factor) * factor
+    if h == 0 or w == 0:
+        return im[::factor, ::factor]
+    blocks = np.asarray(im[:h, :w], dtype=np.float32).reshape(h // factor, factor, w // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def normalize(data, lo, hi, contrast=None):
+    '''
+    Scales channel intensities to [0, 1] for display, like
+    imagetools.log_transform ('Log'), imagetools.auto_contrast ('Linear') or
+    by the bit depth of the values (None). Returns a new float32 array.
+    data -- array (..., h, w) of one or more channels
+    lo, hi -- the intensity range of each channel, arrays of shape
+              data.shape[:-2] (or scalars for a single channel)
+    '''
+    data = np.array(data, dtype=np.float32)
+    lo = np.asarray(lo, dtype=np.float32)[..., None, None]
+    hi = np.asarray(hi, dtype=np.float32)[..., None, None]
+    if contrast not in ('Log', 'Linear'):
+        data *= np.where(hi > 255, 1 / 65535., np.where(hi > 1, 1 / 255., 1.)).astype(np.float32)
+        return data
+    # binary channels are left as they are
+    varied = ((data > lo) & (data < hi)).any(axis=(-2, -1), keepdims=True)
+    original = None if varied.all() else data.copy()
+    if contrast == 'Log':
+        if (lo > 0).all():
+            pos = lo
+        else:
+            pos = np.where(data > 0, data, np.inf).min(axis=(-2, -1), keepdims=True)
+            varied &= np.isfinite(pos)
+            pos = np.where(np.isfinite(pos), pos, 1)
+        top = np.maximum(hi, pos)
+        np.clip(data, pos, top, out=data)
+        np.log(data, out=data)
+        logpos = np.log(pos)
+        data -= logpos
+        span = np.log(top) - logpos
+        data /= np.where(span > 0, span, 1)
+    else:
+        data -= lo
+        np.maximum(data, 0, out=data)
+        data /= np.where(hi > 0, hi, 1)
+    if original is not None:
+        data = np.where(varied, data, original)
+    return data
+
+
+def normalize_channel(im, limits, contrast=None):
+    '''
+    normalize for a single 2D channel with intensity range limits. Large 8
+    and 16 bit images are mapped through a lookup table built from the
+    values that occur in them.
+    '''
+    if im.dtype in (np.uint8, np.uint16):
+        size = np.iinfo(im.dtype).max + 1
+        if im.size >= LUT_MIN_RATIO * size:
+            values = np.flatnonzero(np.bincount(im.ravel(), minlength=size))
+            lut = np.zeros(size, dtype=np.float32)
+            # the result only depends on which values occur, not where
+            lut[values] = normalize(values[None, :], limits[0], limits[1], contrast)[0]
+            return lut[im]
+    return normalize(im, limits[0], limits[1], contrast)
+
+
+def blend(planes, chMap, blending=None):
+    '''
+    Blends normalized channels into RGB. Channels are added, then
+    subtracted, then painted solid where they are 1, according to blending.
+    planes -- array (channels, ..., h, w)
+    blending -- list of 'add', 'subtract' or 'solid' per channel (default:
+                all 'add')
+    Returns a float32 array (..., h, w, 3) in [0, 1].
+    '''
+    planes = np.asarray(planes, dtype=np.float32)
+    n = planes.shape[0]
+    flat = planes.reshape(n, -1)
+    colors = color_matrix(chMap[:n])
+    modes = [b.lower() for b in (blending or ['add'] * n)[:n]]
+
+    def mix(which):
+        # (pixels, channels) x (channels, 3)
+        if len(which) == n:
+            return np.dot(flat.T, colors)
+        return np.dot(flat[which].T, colors[which])
+
+    add = [i for i, mode in enumerate(modes) if mode == 'add']
+    rgb = mix(add) if add else np.zeros((flat.shape[1], 3), dtype=np.float32)
+    np.clip(rgb, 0, 1, out=rgb)
+    subtract = [i for i, mode in enumerate(modes) if mode == 'subtract']
+    if subtract:
+        rgb -= mix(subtract)
+        np.clip(rgb, 0, 1, out=rgb)
+    for i, mode in enumerate(modes):
+        if mode == 'solid' and chMap[i].lower() != 'none':
+            rgb[flat[i] == 1] = colors[i]
+    return rgb.reshape(planes.shape[1:] + (3,))
+
+
+def to_rgb8(rgb, brightness=1.0):
+    '''
+    Converts float RGB in [0, 1] to uint8, multiplied by brightness. rgb is
+    scaled in place.
+    '''
+    rgb *= np.float32(255 * brightness)
+    np.clip(rgb, 0, 255, out=rgb)
+    return rgb.astype(np.uint8)
+
+
+def render(imgs, chMap, limits, contrast=None, brightness=1.0, factor=1,
+           blending=None, masks=()):
+    '''
+    Renders one image to a uint8 (h, w, 3) array.
+    imgs -- list of 2D channel arrays
+    limits -- (min, max) of each full channel, used for contrast
+    factor -- integer to downsample the channels by before rendering
+    masks -- (mask, func) pairs, func(rgb, mask) is applied to the blended
+             float RGB image
+    '''
+    planes = [normalize_channel(downsample(im, factor), lim, contrast) for im, lim in zip(imgs, limits)]
+    rgb = blend(np.stack(planes), chMap, blending)
+    for mask, func in masks:
+        rgb = np.asarray(func(rgb, mask), dtype=np.float32)
+    return to_rgb8(rgb, brightness)
+
+
+def render_batch(tiles, chMap, contrast=None, brightness=1.0, factor=1, blending=None):
+    '''
+    Renders N tiles of the same shape at once, into one contiguous uint8
+    (N, h, w, 3) array. The contrast of each tile is set by its own range
+    of intensities.
+    tiles -- list of N lists of 2D channel arrays
+    factor -- integer to downsample the tiles by (strided) before rendering
+    '''
+    if len(tiles) == 0:
+        return np.zeros((0, 0, 0, 3), dtype=np.uint8)
+    data = np.asarray(tiles, dtype=np.float32).transpose(1, 0, 2, 3)   # channels, N, h, w
+    lo, hi = data.min(axis=(-2, -1)), data.max(axis=(-2, -1))
+    planes = normalize(data[..., ::factor, ::factor], lo, hi, contrast)
+    return to_rgb8(blend(planes, chMap, blending), brightness)
@@ -0,0 +1,154 @@
+'''
+Uniform random sampling of objects without sorting the object table.
+
+Objects are given dense ordinals image by image: the objects of image i are
+numbered cumsums[i] to cumsums[i+1]-1, where cumsums is the cumulative sum
+of the per-image object counts (see DataModel.cumSums). A sample is drawn
+as ordinals in NumPy, mapped back to (image, rank within the image) with
+searchsorted, and the ranks are then turned into object numbers by an
+ObjectIDResolver.
+'''
+import threading
+import numpy as np
+
+
+def draw(total, N, with_replacement=False, rng=None):
+    '''
+    Returns N ordinals drawn uniformly from range(total). Without
+    replacement N is capped at total.
+    '''
+    rng = rng or np.random.default_rng()
+    if with_replacement:
+        return rng.integers(0, total, size=N)
+    return rng.choice(total, size=min(N, total), replace=False)
+
+
+def locate(cumsums, ordinals):
+    '''
+    Maps ordinals to (image rows, ranks within those images). Images without
+    objects repeat a cumulative sum, so the last image whose sum is <= the
+    ordinal is the one that holds it.
+    '''
+    rows = np.searchsorted(cumsums, ordinals, 'right') - 1
+    return rows, ordinals - cumsums[rows]
+
+
+class ObjectIDResolver(object):
+    '''
+    Maps (image, 0-based rank) to object keys, where objects are ranked by
+    object number within their image. Images whose object numbers are
+    contiguous are resolved by arithmetic. The sorted object numbers of the
+    other images are fetched the first time they are needed and cached as
+    NumPy arrays.
+    imkeys -- image keys
+    counts -- number of objects in each image
+    first_ids -- smallest object number in each image
+    last_ids -- largest object number in each image
+    fetch -- callable(imkeys) returning {imkey: sorted object numbers}
+    rows -- optional {imkey: index into imkeys}, to share the caller's map
+    '''
+    def __init__(self, imkeys, counts, first_ids, last_ids, fetch, rows=None):
+        self.imkeys = imkeys
+        self.rows = rows if rows is not None else dict((key, i) for i, key in enumerate(imkeys))
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.first_ids = np.asarray(first_ids, dtype=np.int64)
+        self.last_ids = np.asarray(last_ids, dtype=np.int64)
+        # object numbers first_id..first_id+count-1 with no gaps
+        self.dense = (self.last_ids - self.first_ids + 1) == self.counts
+        self.fetch = fetch
+        self.arrays = {}         # row -> sorted object numbers, for images with gaps
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.imkeys)
+
+    def load(self, imkeys=None):
+        '''
+        Fetches the object numbers of the given images (default: every image
+        with gaps in its object numbers) with a single query.
+        '''
+        if imkeys is None:
+            rows = np.flatnonzero(~self.dense)
+        else:
+            rows = [self.rows[key] for key in imkeys if key in self.rows]
+        self._load(rows)
+
+    def _load(self, rows):
+        with self.lock:
+            missing = sorted(set(int(r) for r in rows if not self.dense[r]) - set(self.arrays))
+        if not missing:
+            return
+        fetched = self.fetch([self.imkeys[r] for r in missing])
+        with self.lock:
+            for r in missing:
+                self.arrays[r] = np.asarray(fetched.get(self.imkeys[r], []), dtype=np.int64)
+
+    def object_ids(self, rows, ranks):
+        '''Returns the object numbers at the given ranks of the given image rows.'''
+        rows = np.asarray(rows, dtype=np.int64)
+        ranks = np.asarray(ranks, dtype=np.int64)
+        ids = self.first_ids[rows] + ranks
+        sparse = np.flatnonzero(~self.dense[rows])
+        if len(sparse):
+            needed, which = np.unique(rows[sparse], return_inverse=True)
+            self._load(needed)
+            # gather from the needed arrays laid end to end
+            arrays = [self.arrays[r] for r in needed]
+            offsets = np.zeros(len(arrays), dtype=np.int64)
+            np.cumsum([len(a) for a in arrays[:-1]], out=offsets[1:])
+            ids[sparse] = np.concatenate(arrays)[offsets[which] + ranks[sparse]]
+        return ids
+
+    def object_keys(self, rows, ranks):
+        '''Returns the object keys at the given ranks of the given image rows.'''
+        ids = self.object_ids(rows, ranks)
+        return [self.imkeys[r] + (int(i),) for r, i in zip(rows, ids)]
+
+    def key_at_index(self, imkey, index):
+        '''
+        Returns the key of the index'th object (1, 2, 3...) in an image, like
+        DBConnect.GetObjectIDAtIndex.
+        '''
+        return self.object_keys([self.rows[imkey]], [index - 1])[0]
+
+    def image_object_ids(self, imkey):
+        '''Returns the sorted object numbers of an image.'''
+        r = self.rows[imkey]
+        return self.object_ids(np.full(self.counts[r], r), np.arange(self.counts[r]))
+
+
+class ObjectSampler(object):
+    '''
+    Draws object keys uniformly from all objects, or from the objects in a
+    subset of the images.
+    resolver -- ObjectIDResolver for the images
+    cumsums -- cumulative object counts of the resolver's images, starting
+               with 0
+    '''
+    def __init__(self, resolver, cumsums, rng=None):
+        self.resolver = resolver
+        self.cumsums = np.asarray(cumsums, dtype=np.int64)
+        self.rng = rng or np.random.default_rng()
+
+    def __len__(self):
+        return int(self.cumsums[-1])
+
+    def sample(self, N, imkeys=None, with_replacement=False):
+        '''
+        Returns N random object keys, drawn from the images in imkeys if
+        given. Without replacement at most all of the objects are returned.
+        '''
+        if imkeys is None:
+            cumsums = self.cumsums
+            subset = None
+        else:
+            rowmap = self.resolver.rows
+            subset = np.unique([rowmap[key] for key in imkeys if key in rowmap]).astype(np.int64)
+            cumsums = np.zeros(len(subset) + 1, dtype=np.int64)
+            np.cumsum(self.resolver.counts[subset], out=cumsums[1:])
+        if N <= 0 or cumsums[-1] == 0:
+            return []
+        rows, ranks = locate(cumsums, draw(int(cumsums[-1]), N, with_replacement, self.rng))
+        if subset is not None:
+            rows = subset[rows]
+        return self.resolver.object_keys(rows, ranks)
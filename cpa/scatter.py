@@ -242,14 +242,16 @@ class ScatterControlPanel(wx.Panel):
     def update_figpanel(self, evt=None):
         self.gate_choice.set_gatable_columns([self.x_column, self.y_column])
         self.gate_choice.update_info()
-        keys_and_points = self._load_points()
         col_types = self.get_selected_column_types()
-                
-        # Convert keys and points into a np array
-        # NOTE: We must set dtype "object" on creation or values like 0.34567e-9
-        #       may be truncated to 0.34567e (error) or 0.345 (no error) when
-        #       the array contains strings.
-        kps = np.array(keys_and_points, dtype='object')
+        if col_types[0] in (float, int) and col_types[1] in (float, int):
+            # Purely numeric: stream straight into a float array.
+            kps = db.fetch_array(self._points_query())
+        else:
+            # Convert keys and points into a np array
+            # NOTE: We must set dtype "object" on creation or values like 0.34567e-9
+            #       may be truncated to 0.34567e (error) or 0.345 (no error) when
+            #       the array contains strings.
+            kps = np.array(self._load_points(), dtype='object')
         # Strip out keys
         if self._plotting_per_object_data():
             key_indices = list(range(len(object_key_columns())))
@@ -280,6 +282,9 @@ class ScatterControlPanel(wx.Panel):
         self.figpanel.draw()
         
     def _load_points(self):
+        return db.execute(self._points_query())
+
+    def _points_query(self):
         q = sql.QueryBuilder()
         select = []
         #
@@ -297,7 +302,7 @@ class ScatterControlPanel(wx.Panel):
             q.add_filter(self.filter)
         q.add_where(sql.Expression(self.x_column, 'IS NOT NULL'))
         q.add_where(sql.Expression(self.y_column, 'IS NOT NULL'))
-        return db.execute(str(q))
+        return str(q)
     
     def get_selected_column_types(self):
         ''' Returns a tuple containing the x and y column types. '''
@@ -4,6 +4,7 @@ from .imagetile import ImageTile
 from .imagetilesizer import ImageTileSizer
 from .imagecontrolpanel import ImageControlPanel
 from .properties import Properties
+from . import imagepanel
 from . import imagetools
 import pickle
 import wx
@@ -49,14 +50,14 @@ class CellMontageFrame(wx.Frame):
     # required by ImageControlPanel
     #
     def SetBrightness(self, brightness):
-        [t.SetBrightness(brightness) for t in self.sb.tiles]
+        imagepanel.UpdateBitmaps(self.sb.tiles, brightness=brightness)
 
     def SetScale(self, scale):
-        [t.SetScale(scale) for t in self.sb.tiles]
+        imagepanel.UpdateBitmaps(self.sb.tiles, scale=scale)
         self.sb.UpdateSizer()
 
     def SetContrastMode(self, mode):
-        [t.SetContrastMode(mode) for t in self.sb.tiles]
+        imagepanel.UpdateBitmaps(self.sb.tiles, contrast=mode)
 
     def Destroy(self):
         ''' Kill off all threads before combusting. '''
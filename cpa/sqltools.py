@@ -228,7 +228,7 @@ class Gate1D(Observable):
         return not self.__eq__(wc)
     
     def __str__(self):
-        return '%s BETWEEN "%s" AND "%s"'%(self.column, self.min, self.max)
+        return "%s BETWEEN '%s' AND '%s'"%(self.column, self.min, self.max)
 
     def __hash__(self):
         return hash(str(self))
@@ -268,8 +268,8 @@ class Gate1D(Observable):
         self.notify(None)
     
     def as_filter(self):
-        return Filter(self.column.copy(), '>="%s" AND '%(self.min),
-                      self.column.copy(), '<="%s"'%(self.max))
+        return Filter(self.column.copy(), ">='%s' AND "%(self.min),
+                      self.column.copy(), "<='%s'"%(self.max))
     
     def get_init_params(self):
         '''This is used for encoding and decoding Gate objects.
@@ -432,6 +432,19 @@ class Filter(Expression):
         init_param_list = eval(filter_encoding)
         return Filter(*init_param_list)
 
+    def __str__(self):
+        if (p.db_type or '').lower() != 'duckdb':
+            return Expression.__str__(self)
+        # DuckDB has no REGEXP operator: "a REGEXP b" -> regexp_matches(a, b)
+        tokens = []
+        exp = iter(self.exp)
+        for token in exp:
+            if str(token).upper() == 'REGEXP' and tokens:
+                tokens[-1] = 'regexp_matches(%s, %s)'%(tokens[-1], str(next(exp, '')))
+            else:
+                tokens.append(str(token))
+        return ' '.join(tokens)
+
 
 def get_tables_from_explain(sql_query):
     rows = cpa.db.execute("EXPLAIN " + sql_query)
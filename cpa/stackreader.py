@@ -0,0 +1,137 @@
+'''
+Lazy readers of z-stacks, used by ImageReader when process_3D is on.
+
+A stack is opened without reading any pixels. Its number of slices comes
+from the file's metadata, and slices are read one at a time when they're
+asked for, so showing one slice of a 200 slice stack reads one slice.
+Maximum and mean projections are accumulated one slice at a time.
+
+open_stack reads TIFFs with tifffile (one slice per page, as
+imageio.mimread does) and other formats through imageio's reader.
+BioformatsStack reads anything Bio-Formats can.
+'''
+import abc
+import os
+
+import imageio
+import numpy as np
+import tifffile
+
+TIFF_FORMATS = ('.tif', '.tiff')
+PROJECTIONS = ('max', 'mean')
+
+
+class Stack(abc.ABC):
+    '''
+    Base class of the stack readers: subclasses implement __len__, read and
+    close.
+    '''
+    @abc.abstractmethod
+    def __len__(self):
+        '''Returns the number of slices.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def read(self, z):
+        '''Returns slice z.'''
+
+    def planes(self, start=0, stop=None):
+        '''Yields slices start to stop (default: the last), reading each
+        only when it's reached.'''
+        for z in range(*slice(start, stop).indices(len(self))):
+            yield self.read(z)
+
+    def plane(self, z):
+        '''
+        Returns slice z, or for z = "mid" the middle slice, or for "max" or
+        "mean" the projection of the whole stack.
+        '''
+        if z == 'mid':
+            # the slice CPA has always shown; halves round to even, so for
+            # some odd numbers of slices (3, 7, 11...) it's one past the middle
+            return self.read(round(len(self) / 2))
+        if z in PROJECTIONS:
+            return self.project(z)
+        return self.read(int(z))
+
+    def project(self, mode='max', start=0, stop=None):
+        '''
+        Returns the maximum ("max") or mean ("mean", as float32) of slices
+        start to stop, holding only one slice besides the result in memory.
+        '''
+        result, n = None, 0
+        for im in self.planes(start, stop):
+            if result is None:
+                result = np.array(im, dtype=np.float64 if mode == 'mean' else None)
+            elif mode == 'mean':
+                result += im
+            else:
+                np.maximum(result, im, out=result)
+            n += 1
+        if result is None:
+            raise ValueError('No slices to project')
+        if mode == 'mean':
+            result = (result / n).astype(np.float32)
+        return result
+
+
+class TiffStack(Stack):
+    '''The pages of a TIFF file.'''
+    def __init__(self, filename):
+        self.tif = tifffile.TiffFile(filename)
+
+    def __len__(self):
+        return len(self.tif.pages)
+
+    def read(self, z):
+        return self.tif.pages[z].asarray()
+
+    def close(self):
+        self.tif.close()
+
+
+class ImageIOStack(Stack):
+    '''The frames of an image file imageio can read.'''
+    def __init__(self, filename):
+        self.reader = imageio.get_reader(filename)
+
+    def __len__(self):
+        return self.reader.get_length()
+
+    def read(self, z):
+        return self.reader.get_data(z)
+
+    def close(self):
+        self.reader.close()
+
+
+class BioformatsStack(Stack):
+    '''The z planes of an image file read with Bio-Formats (the JVM must be
+    running).'''
+    def __init__(self, filename):
+        import bioformats
+        self.reader = bioformats.ImageReader(filename)
+
+    def __len__(self):
+        return self.reader.rdr.getSizeZ()
+
+    def read(self, z):
+        return self.reader.read(z=z, rescale=False)
+
+    def close(self):
+        self.reader.close()
+
+
+def open_stack(filename):
+    '''Returns a TiffStack or ImageIOStack of a file, by its extension.'''
+    if os.path.splitext(filename)[-1].lower() in TIFF_FORMATS:
+        return TiffStack(filename)
+    return ImageIOStack(filename)
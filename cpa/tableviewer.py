@@ -377,10 +377,10 @@ class DBTable(TableData):
         if self.key_indices is None:
             return None
         cols = ','.join(self.col_labels[self.key_indices])
-        key = db.execute('SELECT %s FROM %s %s ORDER BY %s LIMIT %s,%s'%
+        key = db.execute('SELECT %s FROM %s %s ORDER BY %s LIMIT %s OFFSET %s'%
                           (cols, self.table_name, self.filter, 
                            ','.join([c+' '+self.order_direction for c in self.order_by]),
-                           row, 1))[0]
+                           1, row))[0]
         return key
     
     def get_image_keys_at_row(self, row):
@@ -485,10 +485,10 @@ class DBTable(TableData):
             lo = max(row - 25, 0)
             hi = row + 25
             cols = ','.join(self.col_labels[self.shown_columns])
-            vals = db.execute('SELECT %s FROM %s %s ORDER BY %s LIMIT %s,%s'%
+            vals = db.execute('SELECT %s FROM %s %s ORDER BY %s LIMIT %s OFFSET %s'%
                               (cols, self.table_name, self.filter, 
                                ','.join([c+' '+self.order_direction for c in self.order_by]),
-                               lo, hi-lo), 
+                               hi-lo, lo), 
                               silent=False)
             self.cache.update((lo+i, v) for i,v in enumerate(vals))
             # if cache exceeds 1000 entries, clip to last 500
@@ -1,4 +1,7 @@
+import numpy as np
 from mock import patch
+import shutil
+import tempfile
 import unittest
 import cpa.datamodel
 
@@ -78,3 +81,95 @@ class GetWellPositionFromName(unittest.TestCase):
 
     def test_reverse_absent(self):
         self.assertRaises(KeyError, lambda: self.dm.get_well_name_from_position((1, 0)))
+
+
+class PopulateModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dm = cpa.datamodel.DataModel()
+        self.p = cpa.datamodel.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.check_tables = 'no'
+        self.p._groups = {'Well': 'SELECT ImageNumber, well FROM Per_Image'}
+        with patch('cpa.datamodel.db') as db:
+            db.GetAllImageKeys.return_value = [(1,), (2,), (3,), (4,)]
+            # image 3 has no objects; image 4 has gaps in its object numbers
+            db.GetPerImageObjectRanges.return_value = [(1, 2, 1, 2), (2, 3, 1, 3), (4, 2, 3, 7)]
+            db.group_map.return_value = ({(1,): ('A01',), (2,): ('A02',), (3,): ('A01',), (4,): ('A01',)}, ['well'])
+            db.GetObjectIDArrays.side_effect = lambda imkeys: {(4,): [3, 7]}
+            self.dm.PopulateModel(delete_model=True)
+            self.objects = sorted(self.dm.GetRandomObjects(100))
+
+    def tearDown(self):
+        self.dm.DeleteModel()
+
+    def test_counts(self):
+        self.assertEqual(self.dm.get_total_object_count(), 7)
+        self.assertEqual(self.dm.GetObjectCountFromImage((2,)), 3)
+        self.assertEqual(self.dm.GetImageKeysAndObjectCounts(), [((1,), 2), ((2,), 3), ((3,), 0), ((4,), 2)])
+        self.assertEqual(list(self.dm.cumSums), [0, 2, 5, 5, 7])
+
+    def test_random_objects(self):
+        self.assertEqual(self.objects, [(1, 1), (1, 2), (2, 1), (2, 2), (2, 3), (4, 3), (4, 7)])
+
+    def test_groups(self):
+        self.assertEqual(self.dm.GetImagesInGroup('Well', ('A01',)), [(1,), (3,), (4,)])
+        self.assertEqual(self.dm.GetImagesInGroup('Well', ('B01',)), [])
+        self.assertEqual(self.dm.GetImagesInGroupWithWildcards('Well', ('__ANY__',)), [(1,), (3,), (4,), (2,)])
+        self.assertEqual(sorted(self.dm.GetGroupKeysInGroup('Well')), [('A01',), ('A02',)])
+        self.assertEqual(self.dm.GetGroupColumnTypes('Well'), [str])
+
+    def test_sum_to_group(self):
+        sums = self.dm.SumToGroup({(1,): np.array([1., 2.]), (2,): np.array([3., 4.]), (4,): np.array([5., 6.])}, 'Well')
+        self.assertEqual(sorted(sums), [('A01',), ('A02',)])
+        self.assertEqual(list(sums[('A01',)]), [6., 8.])
+        self.assertEqual(list(sums[('A02',)]), [3., 4.])
+
+    def test_lookup_rows(self):
+        rows = self.dm._lookup_rows(np.array([[4], [9], [1], [3]]))
+        self.assertEqual(list(rows), [3, -1, 0, 2])
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dm = cpa.datamodel.DataModel()
+        self.p = cpa.datamodel.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.check_tables = 'no'
+        self.p.datamodel_cache = True
+        self.p._groups = {'Well': 'SELECT ImageNumber, well FROM Per_Image'}
+
+    def tearDown(self):
+        self.p.datamodel_cache = False
+        self.dm.DeleteModel()
+        shutil.rmtree(self.dir)
+
+    def populate(self, modify_date, build):
+        with patch('cpa.datamodel.db') as db, patch('cpa.datamodel.cpa_data_dir', return_value=self.dir):
+            db.get_objects_modify_date.return_value = modify_date
+            db._pool_key.return_value = ('sqlite', None, None, None, None, '/data/db.sqlite')
+            if build:
+                db.GetAllImageKeys.return_value = [(1,), (2,), (3,)]
+                db.GetPerImageObjectRanges.return_value = [(1, 2, 1, 2), (3, 2, 4, 9)]
+                db.group_map.return_value = ({(1,): ('A01',), (2,): ('A02',), (3,): ('A01',)}, ['well'])
+            else:
+                db.GetAllImageKeys.side_effect = AssertionError('the snapshot was not used')
+            self.dm.PopulateModel(delete_model=True)
+            return db
+
+    def test_reopen(self):
+        self.populate(1.0, build=True)
+        db = self.populate(1.0, build=False)
+        self.assertFalse(db.GetPerImageObjectRanges.called)
+        self.assertEqual(self.dm.GetImageKeysAndObjectCounts(), [((1,), 2), ((2,), 0), ((3,), 2)])
+        self.assertEqual(list(self.dm.cumSums), [0, 2, 2, 4])
+        self.assertEqual(self.dm.GetImagesInGroup('Well', ('A01',)), [(1,), (3,)])
+        self.assertEqual(self.dm.GetGroupColumnTypes('Well'), [str])
+        self.assertFalse(self.dm.resolver.dense[2])
+
+    def test_modified_database(self):
+        self.populate(1.0, build=True)
+        db = self.populate(2.0, build=True)
+        self.assertTrue(db.GetPerImageObjectRanges.called)
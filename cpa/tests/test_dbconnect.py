@@ -1,3 +1,4 @@
+import numpy as np
 import threading
 from mock import patch, Mock
 import unittest
@@ -83,12 +84,569 @@ class UpdateWellsTestCase(unittest.TestCase):
     def test_null(self):
         with patch.object(self.db, 'execute') as execute:
             self.db.UpdateWells("Per_Image", "User_BarColumn", None, [('A01',)])
-            execute.assert_called_with('UPDATE Per_Image SET User_BarColumn=NULL WHERE Well IN ("A01")')
+            execute.assert_called_with("UPDATE Per_Image SET User_BarColumn=NULL WHERE Well IN ('A01')")
 
     def test_string(self):
         with patch.object(self.db, 'execute') as execute:
             self.db.UpdateWells("Per_Image", "User_BarColumn", "baz", [('A01',)])
-            execute.assert_called_with('UPDATE Per_Image SET User_BarColumn="baz" WHERE Well IN ("A01")')
+            execute.assert_called_with("UPDATE Per_Image SET User_BarColumn='baz' WHERE Well IN ('A01')")
 
 
 
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = cpa.dbconnect.ConnectionPool(max_size=2, idle_timeout=300)
+        self.factory = lambda: (Mock(), Mock())
+
+    def test_reuse(self):
+        conn, cursor = self.pool.checkout('db', self.factory, lambda c, cur: True)
+        self.pool.checkin('db', conn, cursor)
+        conn2, cursor2 = self.pool.checkout('db', self.factory, lambda c, cur: True)
+        self.assertIs(conn, conn2)
+        stats = self.pool.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 1)
+        self.assertEqual(stats['in_use'], 1)
+
+    def test_unhealthy_connection_is_replaced(self):
+        conn, cursor = self.pool.checkout('db', self.factory, lambda c, cur: True)
+        self.pool.checkin('db', conn, cursor)
+        conn2, cursor2 = self.pool.checkout('db', self.factory, lambda c, cur: False)
+        self.assertIsNot(conn, conn2)
+        conn.close.assert_called_with()
+        self.assertEqual(self.pool.stats()['open'], 1)
+
+    def test_exhausted(self):
+        for i in range(2):
+            self.pool.checkout('db', self.factory, lambda c, cur: True)
+        self.assertRaises(cpa.dbconnect.DBException,
+                          lambda: self.pool.checkout('db', self.factory, lambda c, cur: True, timeout=0.1))
+        self.assertEqual(self.pool.stats()['waits'], 1)
+
+    def test_idle_eviction(self):
+        conn, cursor = self.pool.checkout('db', self.factory, lambda c, cur: True)
+        self.pool.idle_timeout = -1
+        self.pool.checkin('db', conn, cursor)
+        conn.close.assert_called_with()
+        self.assertEqual(self.pool.stats()['evicted'], 1)
+        self.assertEqual(self.pool.stats()['open'], 0)
+
+
+class ThreadConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = cpa.dbconnect.p
+        self.db = cpa.dbconnect.DBConnect()
+        self.db.pool = cpa.dbconnect.ConnectionPool(max_size=2)
+        self.opened = []
+        def open_connection():
+            conn, cursor = Mock(), Mock()
+            cursor.fetchall.return_value = [(1,)]
+            self.opened.append(conn)
+            return conn, cursor
+        self.patches = [patch.object(self.db, '_open_connection', side_effect=open_connection),
+                        patch.object(self.db, '_connection_is_alive', return_value=True)]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        self.db.pool = cpa.dbconnect.ConnectionPool()
+
+    def test_checked_in_when_thread_exits(self):
+        thread = threading.Thread(target=lambda: self.db._checkout_connection('Worker'), name='Worker')
+        thread.start()
+        thread.join()
+        self.assertNotIn('Worker', self.db.connections)
+        self.assertEqual(self.db.pool.stats()['in_use'], 0)
+
+    def test_stream_on_own_connection(self):
+        self.p.db_type = 'mysql'
+        connID = threading.currentThread().getName()
+        conn, cursor = Mock(), Mock()
+        self.db.connections[connID], self.db.cursors[connID] = conn, cursor
+        stream = Mock()
+        stream.fetchmany.side_effect = [[(1,), (2,)], [(3,)], []]
+        cursors = Mock(SSCursor=Mock(return_value=stream))
+        try:
+            with patch.dict('sys.modules', {'MySQLdb': Mock(cursors=cursors), 'MySQLdb.cursors': cursors}):
+                blocks = []
+                for rows in self.db.execute_iter('SELECT a FROM Foo', block_rows=2):
+                    blocks.append(rows)
+                    # other queries meanwhile use a spare connection
+                    self.assertEqual(self.db.execute('SELECT 1'), [(1,)])
+            cursors.SSCursor.assert_called_once_with(conn)
+            self.assertEqual(blocks, [[(1,), (2,)], [(3,)]])
+            self.assertEqual(len(self.opened), 1)
+            self.assertIs(self.db.connections[connID], conn)
+            self.assertIs(self.db.cursors[connID], cursor)
+            self.assertEqual(self.db.pool.stats()['idle'], 1)
+        finally:
+            self.db.connections.pop(connID)
+            self.db.cursors.pop(connID)
+            self.db.poolKeys.pop(connID, None)
+
+    def test_query_in_fetch_blocks_does_not_reconnect(self):
+        self.p.db_type = 'mysql'
+        connID = threading.currentThread().getName()
+        conn, cursor = Mock(), Mock()
+        self.db.connections[connID], self.db.cursors[connID] = conn, cursor
+        stream = Mock()
+        stream.fetchmany.side_effect = [[(1,), (2,)], [(3,)], []]
+        cursors = Mock(SSCursor=Mock(return_value=stream))
+        try:
+            with patch.dict('sys.modules', {'MySQLdb': Mock(cursors=cursors), 'MySQLdb.cursors': cursors}), \
+                 patch.object(self.db, 'connect') as connect:
+                for block in self.db.fetch_blocks('SELECT a FROM Foo', block_rows=2, dtype='i8'):
+                    with self.db.key_table(block, ['a']) as table:
+                        self.db.execute('SELECT a FROM %s'%(table))
+            connect.assert_not_called()
+            self.assertEqual(len(self.opened), 1)
+            self.assertIs(self.db.connections[connID], conn)
+            self.assertEqual(self.db.pool.stats()['in_use'], 0)
+        finally:
+            self.db.connections.pop(connID)
+            self.db.cursors.pop(connID)
+            self.db.poolKeys.pop(connID, None)
+
+
+class RowsToArrayTestCase(unittest.TestCase):
+    def test_float(self):
+        a = cpa.dbconnect.rows_to_array([(1, 2.5), (3, None)])
+        self.assertEqual(a.shape, (2, 2))
+        self.assertEqual(a.dtype, np.float64)
+        self.assertTrue(np.isnan(a[1, 1]))
+
+    def test_float_coerces_strings(self):
+        a = cpa.dbconnect.rows_to_array([(1, '2.5'), (2, 'abc')])
+        self.assertEqual(a[0, 1], 2.5)
+        self.assertTrue(np.isnan(a[1, 1]))
+
+    def test_int(self):
+        a = cpa.dbconnect.rows_to_array([(1, 2), (3, 4)], 'i8')
+        self.assertEqual(a.dtype, np.int64)
+        self.assertRaises(TypeError, lambda: cpa.dbconnect.rows_to_array([(1, None)], 'i8'))
+
+
+class SQLiteResultDtypeTestCase(unittest.TestCase):
+    def test_declared_and_inferred(self):
+        db = cpa.dbconnect.DBConnect()
+        cursor = Mock()
+        cursor.description = [('ImageNumber',), ('Intensity',), ('Well',), ('n',), ('n',)]
+        with patch.object(db, '_sqlite_declared_types',
+                          return_value=(['ImageNumber', 'Intensity'], ['INTEGER', 'FLOAT'])):
+            descr = db._sqlite_result_dtype(cursor, tables=['Per_Image'],
+                                            rows=[(1, 2.5, 'A01', 3, 1.5)])
+        self.assertEqual(descr, [('ImageNumber', 'i8'), ('Intensity', 'f8'),
+                                 ('Well', 'O'), ('n', 'i8'), ('n_', 'f8')])
+
+
+class KeyTableTestCase(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.image_table = 'Per_Image'
+        self.p.object_table = 'Per_Object'
+        self.p.db_key_table_threshold = 2
+        self.db = cpa.dbconnect.DBConnect()
+        connID = threading.currentThread().getName()
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE Per_Object (ImageNumber INT, ObjectNumber INT)')
+        conn.executemany('INSERT INTO Per_Object VALUES (?,?)', [(i, j) for i in range(5) for j in range(3)])
+        self.db.connections[connID] = conn
+        self.db.cursors[connID] = conn.cursor()
+
+    def tearDown(self):
+        connID = threading.currentThread().getName()
+        self.db.connections.pop(connID).close()
+        self.db.cursors.pop(connID)
+        self.p.db_key_table_threshold = None
+
+    def test_short_list_is_inlined(self):
+        with self.db.where_clause_for_images([(1,), (3,)]) as where:
+            self.assertEqual(where, 'Per_Image.ImageNumber IN (1,3)')
+
+    def test_images(self):
+        with self.db.where_clause_for_images([(4,), (1,), (3,), (1,)], 'Per_Object') as where:
+            self.assertIn('_cpa_keys_', where)
+            res = self.db.execute('SELECT DISTINCT ImageNumber FROM Per_Object WHERE %s ORDER BY ImageNumber'%(where))
+        self.assertEqual(res, [(1,), (3,), (4,)])
+        self.assertEqual(self.db.execute("SELECT name FROM sqlite_temp_master"), [])
+
+    def test_objects(self):
+        obkeys = [(0, 1), (2, 2), (4, 0), (9, 9)]
+        with self.db.where_clause_for_objects(obkeys) as where:
+            res = self.db.execute('SELECT ImageNumber, ObjectNumber FROM Per_Object WHERE %s ORDER BY ImageNumber'%(where))
+        self.assertEqual(res, obkeys[:3])
+
+
+class BatchedLookupTestCase(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.image_table = 'Per_Image'
+        self.p.object_table = 'Per_Object'
+        self.p.cell_x_loc = 'x'
+        self.p.cell_y_loc = 'y'
+        self.p.image_path_cols = ['PathA', 'PathB']
+        self.p.image_file_cols = ['FileA', 'FileB']
+        self.p.image_url_prepend = None
+        self.p.db_key_table_threshold = 2
+        self.db = cpa.dbconnect.DBConnect()
+        connID = threading.currentThread().getName()
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE Per_Image (ImageNumber INT, PathA TEXT, FileA TEXT, PathB TEXT, FileB TEXT)')
+        conn.executemany('INSERT INTO Per_Image VALUES (?,?,?,?,?)',
+                         [(i, '/a', 'a%d.tif'%(i), '/b', 'b%d.tif'%(i)) for i in range(4)])
+        conn.execute('CREATE TABLE Per_Object (ImageNumber INT, ObjectNumber INT, x FLOAT, y FLOAT)')
+        conn.executemany('INSERT INTO Per_Object VALUES (?,?,?,?)',
+                         [(i, j, 10. * i, 1. * j) for i in range(4) for j in range(3)])
+        conn.execute('UPDATE Per_Object SET x = NULL WHERE ImageNumber = 3 AND ObjectNumber = 2')
+        self.db.connections[connID] = conn
+        self.db.cursors[connID] = conn.cursor()
+
+    def tearDown(self):
+        connID = threading.currentThread().getName()
+        self.db.connections.pop(connID).close()
+        self.db.cursors.pop(connID)
+        self.p.db_key_table_threshold = None
+
+    def test_object_coords(self):
+        obkeys = [(1, 2), (3, 2), (2, 0), (1, 2), (9, 9)]
+        with patch.object(self.db, 'execute', wraps=self.db.execute) as execute:
+            coords = self.db.GetObjectCoordsByKey(obkeys)
+        self.assertEqual(coords, {(1, 2): (10., 2.), (3, 2): (None, 2.), (2, 0): (20., 0.)})
+        selects = [c for c in execute.call_args_list if c[0][0].startswith('SELECT')]
+        self.assertEqual(len(selects), 1)
+        self.assertEqual(self.db.GetObjectCoordsByKey([]), {})
+
+    def test_channel_paths(self):
+        paths = self.db.GetFullChannelPathsForImages([(2,), (0,), (7,)])
+        self.assertEqual(paths, {(0,): ['/a/a0.tif', '/b/b0.tif'], (2,): ['/a/a2.tif', '/b/b2.tif']})
+        self.assertEqual(self.db.GetFullChannelPathsForImage((2,)), paths[(2,)])
+
+
+class RandomObjectKeysTestCase(unittest.TestCase):
+    setUp = KeyTableTestCase.setUp
+    tearDown = KeyTableTestCase.tearDown
+
+    def test_random_without_sorting(self):
+        q = Mock(__str__=Mock(return_value='SELECT ImageNumber, ObjectNumber FROM Per_Object WHERE ImageNumber > 1'))
+        with patch.object(self.db, 'execute', wraps=self.db.execute) as execute:
+            keys = self.db._select_object_keys(q, 5)
+            self.assertFalse(any('RAND' in str(c) for c in execute.call_args_list))
+        self.assertEqual(len(keys), 5)
+        self.assertEqual(len(set(keys)), 5)
+        self.assertTrue(all(k[0] > 1 and isinstance(k[0], int) for k in keys))
+        self.assertEqual(sorted(self.db._select_object_keys(q)), [(i, j) for i in range(2, 5) for j in range(3)])
+        self.assertEqual(self.db._select_object_keys(q, 3, random=False), [(2, 0), (2, 1), (2, 2)])
+
+
+class CheckedTableTestCase(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.image_table = 'Per_Image'
+        self.p.object_table = 'Per_Object_checked'
+        self.p.check_tables_incremental = False
+        self.db = cpa.dbconnect.DBConnect()
+        self.db.invalidate_schema_cache()
+        connID = threading.currentThread().getName()
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE Per_Object (ImageNumber INT, ObjectNumber INT, AreaShape_Area FLOAT, x FLOAT)')
+        self.add_images(1, 4)
+        self.conn.execute('UPDATE Per_Object SET x = NULL WHERE ImageNumber = 2 AND ObjectNumber = 1')
+        self.db.connections[connID] = self.conn
+        self.db.cursors[connID] = self.conn.cursor()
+
+    def tearDown(self):
+        connID = threading.currentThread().getName()
+        self.db.connections.pop(connID).close()
+        self.db.cursors.pop(connID)
+        self.db.invalidate_schema_cache()
+        self.p.object_table = 'Per_Object'
+        self.p.check_tables_incremental = False
+
+    def add_images(self, first, last):
+        self.conn.executemany('INSERT INTO Per_Object VALUES (?,?,?,?)',
+                              [(i, j, 10., 1.) for i in range(first, last) for j in range(3)])
+
+    def checked_rows(self):
+        return self.db.execute('SELECT COUNT(*) FROM Per_Object_checked')[0][0]
+
+    def test_unchanged_is_not_rebuilt(self):
+        self.db.CreateObjectCheckedTable()
+        self.assertEqual(self.checked_rows(), 8)
+        with patch.object(self.db, '_fill_checked_table') as fill:
+            self.db.CreateObjectCheckedTable()
+            self.assertFalse(fill.called)
+        self.add_images(4, 5)
+        self.db.CreateObjectCheckedTable()
+        self.assertEqual(self.checked_rows(), 11)
+
+    def test_update_in_place_is_rebuilt(self):
+        self.db.CreateObjectCheckedTable()
+        self.assertEqual(self.checked_rows(), 8)
+        self.conn.execute('UPDATE Per_Object SET x = NULL WHERE ImageNumber = 3 AND ObjectNumber = 0')
+        self.db.CreateObjectCheckedTable()
+        self.assertEqual(self.checked_rows(), 7)
+        self.conn.execute('UPDATE Per_Object SET x = 2.0 WHERE ImageNumber = 2 AND ObjectNumber = 1')
+        self.db.CreateObjectCheckedTable()
+        self.assertEqual(self.checked_rows(), 8)
+
+    def test_sampled_rows(self):
+        self.conn.execute("ALTER TABLE Per_Object ADD COLUMN Well TEXT DEFAULT 'A01'")
+        self.db.CreateObjectCheckedTable()
+        with patch.object(cpa.dbconnect, 'CHECKED_TABLE_SAMPLE_ROWS', 2):
+            self.db.CreateObjectCheckedTable()
+            # text values of the first and last rows are compared
+            self.conn.execute("UPDATE Per_Object SET Well = 'B02' WHERE rowid = 9")
+            with patch.object(self.db, '_fill_checked_table', wraps=self.db._fill_checked_table) as fill:
+                self.db.CreateObjectCheckedTable()
+                self.assertTrue(fill.called)
+            # rows between them aren't read
+            self.conn.execute("UPDATE Per_Object SET Well = 'B02' WHERE rowid = 5")
+            with patch.object(self.db, '_fill_checked_table') as fill:
+                self.db.CreateObjectCheckedTable()
+                self.assertFalse(fill.called)
+
+    def test_incremental(self):
+        self.p.check_tables_incremental = True
+        self.db.CreateObjectCheckedTable()
+        self.add_images(4, 6)
+        with patch.object(self.db, '_fill_checked_table', wraps=self.db._fill_checked_table) as fill:
+            self.db.CreateObjectCheckedTable()
+            self.assertEqual(fill.call_args[0][2], 'ImageNumber > 3')
+        self.assertEqual(self.checked_rows(), 14)
+        # removing an old row forces a full rebuild
+        self.conn.execute('DELETE FROM Per_Object WHERE ImageNumber = 1 AND ObjectNumber = 0')
+        self.add_images(6, 7)
+        with patch.object(self.db, '_fill_checked_table', wraps=self.db._fill_checked_table) as fill:
+            self.db.CreateObjectCheckedTable()
+            self.assertEqual(len(fill.call_args[0]), 2)
+        self.assertEqual(self.checked_rows(), 16)
+        # as does changing an old row in place
+        self.conn.execute('UPDATE Per_Object SET x = NULL WHERE ImageNumber = 1 AND ObjectNumber = 1')
+        self.add_images(7, 8)
+        with patch.object(self.db, '_fill_checked_table', wraps=self.db._fill_checked_table) as fill:
+            self.db.CreateObjectCheckedTable()
+            self.assertEqual(len(fill.call_args[0]), 2)
+        self.assertEqual(self.checked_rows(), 18)
+
+    def test_no_incremental_with_table_id(self):
+        self.p.check_tables_incremental = True
+        self.db.CreateObjectCheckedTable()
+        record = self.db._checked_table_record('Per_Object_checked')
+        self.add_images(4, 5)
+        fingerprint = self.db._checked_table_fingerprint('Per_Object')
+        self.p.table_id = 'TableNumber'
+        try:
+            self.assertFalse(self.db._append_to_checked_table('Per_Object', record, fingerprint))
+        finally:
+            self.p.table_id = None
+
+    def test_many_columns(self):
+        # rows missing values in columns past the first chunk are removed
+        self.conn.execute('DROP TABLE Per_Object')
+        cols = ['c%d'%(i) for i in range(450)]
+        self.conn.execute('CREATE TABLE Per_Object (ImageNumber INT, %s)'%(', '.join(c + ' FLOAT' for c in cols)))
+        self.conn.executemany('INSERT INTO Per_Object VALUES (%s)'%(','.join(['?'] * 451)),
+                              [[i] + [1.] * 450 for i in range(1, 5)])
+        self.conn.execute('UPDATE Per_Object SET c420 = NULL WHERE ImageNumber = 3')
+        self.db.CreateObjectCheckedTable()
+        self.assertEqual(self.db.execute('SELECT ImageNumber FROM Per_Object_checked'), [(1,), (2,), (4,)])
+
+
+class SchemaCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.db = cpa.dbconnect.DBConnect()
+        self.db.invalidate_schema_cache()
+        connID = threading.currentThread().getName()
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE Foo (a INTEGER, b FLOAT, c TEXT)')
+        self.db.connections[connID] = self.conn
+        self.db.cursors[connID] = self.conn.cursor()
+
+    def tearDown(self):
+        connID = threading.currentThread().getName()
+        self.db.connections.pop(connID).close()
+        self.db.cursors.pop(connID)
+        self.db.invalidate_schema_cache()
+
+    def test_cached(self):
+        self.assertEqual(self.db.GetColumnNames('Foo'), ['a', 'b', 'c'])
+        with patch.object(self.db, '_load_table_schema') as load:
+            self.assertEqual(self.db.GetColumnTypes('Foo'), [int, float, str])
+            self.assertEqual(self.db.GetColumnType('Foo', 'b'), float)
+            self.assertEqual(self.db.GetColumnTypeString('Foo', 'c'), 'TEXT')
+            self.assertEqual(self.db.GetColumnType('Foo', 'x'), None)
+            self.assertFalse(load.called)
+
+    def test_ddl_invalidates(self):
+        self.db.GetColumnNames('Foo')
+        self.db.execute('ALTER TABLE Foo ADD User_d INTEGER')
+        self.assertEqual(self.db.GetColumnNames('Foo'), ['a', 'b', 'c', 'User_d'])
+        self.db.execute('DROP TABLE IF EXISTS Foo')
+        self.db.execute('CREATE TABLE Foo (z FLOAT)')
+        self.assertEqual(self.db.GetColumnNames('Foo'), ['z'])
+
+    def test_missing_table(self):
+        self.assertRaises(cpa.dbconnect.DBException, lambda: self.db.GetColumnNames('Bar'))
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        from cpa.querycache import QueryCache
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.db_query_cache = True
+        self.db = cpa.dbconnect.DBConnect()
+        self.db.queryCache = QueryCache()
+        connID = threading.currentThread().getName()
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE Foo (a INTEGER)')
+        self.conn.execute('INSERT INTO Foo VALUES (1)')
+        self.db.connections[connID] = self.conn
+        self.db.cursors[connID] = self.conn.cursor()
+        self.stamp = patch.object(self.db, 'query_cache_stamp', return_value=(1.0,))
+        self.stamp.start()
+
+    def tearDown(self):
+        self.stamp.stop()
+        connID = threading.currentThread().getName()
+        self.db.connections.pop(connID).close()
+        self.db.cursors.pop(connID)
+        self.db.queryCache = None
+        self.p.db_query_cache = False
+
+    def test_cached(self):
+        self.assertEqual(self.db.execute_cached('SELECT a FROM Foo'), [(1,)])
+        self.conn.execute('UPDATE Foo SET a=2')
+        self.assertEqual(self.db.execute_cached('SELECT a FROM Foo'), [(1,)])
+
+    def test_write_clears(self):
+        self.db.execute_cached('SELECT a FROM Foo')
+        self.db.execute('CREATE TEMPORARY TABLE Bar (b INTEGER)')
+        self.assertEqual(self.db.query_cache_stats()['memory_entries'], 1)
+        self.db.execute('UPDATE Foo SET a=2')
+        self.assertEqual(self.db.execute_cached('SELECT a FROM Foo'), [(2,)])
+
+    def test_write_discards_its_table(self):
+        self.conn.execute('CREATE TABLE Bar (b INTEGER)')
+        self.db.execute_cached('SELECT a FROM Foo')
+        self.db.execute_cached('SELECT b FROM Bar')
+        # bookkeeping doesn't touch the cache
+        self.db.execute('CREATE INDEX idx_Foo ON Foo (a)')
+        self.db.execute('CREATE TABLE %s (checked_table TEXT)'%(cpa.dbconnect.CHECKED_TABLES_RECORD))
+        self.assertEqual(self.db.query_cache_stats()['memory_entries'], 2)
+        self.db.execute('INSERT INTO Bar VALUES (1)')
+        self.assertEqual(self.db.query_cache_stats()['memory_entries'], 1)
+        self.conn.execute('UPDATE Foo SET a=2')
+        self.assertEqual(self.db.execute_cached('SELECT a FROM Foo'), [(1,)])
+        self.assertEqual(self.db.execute_cached('SELECT b FROM Bar'), [(1,)])
+
+    def test_unknown_stamp(self):
+        self.db.query_cache_stamp.return_value = None
+        self.db.execute_cached('SELECT a FROM Foo')
+        self.conn.execute('UPDATE Foo SET a=2')
+        self.assertEqual(self.db.execute_cached('SELECT a FROM Foo'), [(2,)])
+        self.assertEqual(self.db.query_cache_stats()['memory_entries'], 0)
+
+
+class SqliteAggregatesTestCase(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        self.conn = sqlite3.connect(':memory:')
+        cpa.dbconnect.register_sqlite_functions(self.conn)
+        self.values = np.random.RandomState(0).normal(10, 3, 5000)
+        self.conn.execute('CREATE TABLE t (x FLOAT, s TEXT)')
+        self.conn.executemany('INSERT INTO t VALUES (?, ?)', [(float(v), 'a%d'%i) for i, v in enumerate(self.values)])
+        self.conn.execute('INSERT INTO t VALUES (NULL, NULL)')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def query(self, q):
+        return self.conn.execute(q).fetchone()[0]
+
+    def test_stddev(self):
+        self.assertAlmostEqual(self.query('SELECT stddev(x) FROM t'), np.std(self.values))
+
+    def test_median(self):
+        self.assertAlmostEqual(self.query('SELECT median(x) FROM t'), np.median(self.values), places=1)
+        self.assertAlmostEqual(self.query('SELECT median_exact(x) FROM t'), np.median(self.values))
+
+    def test_percentile(self):
+        self.assertAlmostEqual(self.query('SELECT percentile(x, 0.9) FROM t'), np.percentile(self.values, 90), places=1)
+        self.assertAlmostEqual(self.query('SELECT percentile(x, 90) FROM t'), np.percentile(self.values, 90), places=1)
+        self.assertAlmostEqual(self.query('SELECT percentile_exact(x, 0.25) FROM t'), np.percentile(self.values, 25))
+
+    def test_few_values_are_exact(self):
+        self.assertEqual(self.query('SELECT median(x) FROM (SELECT x FROM t LIMIT 4)'), np.median(self.values[:4]))
+        self.assertEqual(self.query('SELECT median(x) FROM t WHERE x IS NULL'), None)
+
+    def test_regexp(self):
+        self.assertEqual(self.query("SELECT COUNT(*) FROM t WHERE s REGEXP 'a1[0-9]$'"), 10)
+
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+@unittest.skipIf(duckdb is None, 'duckdb is not installed')
+class DuckDBFunctionsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = duckdb.connect()
+        cpa.dbconnect.register_duckdb_functions(self.conn)
+        self.values = np.random.RandomState(0).normal(10, 3, 1000)
+        self.conn.execute('CREATE TABLE t (x DOUBLE)')
+        self.conn.executemany('INSERT INTO t VALUES (?)', [(float(v),) for v in self.values])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def query(self, q):
+        return self.conn.execute(q).fetchone()[0]
+
+    def test_stddev(self):
+        self.assertAlmostEqual(self.query('SELECT stddev(x) FROM t'), np.std(self.values))
+
+    def test_percentile(self):
+        self.assertAlmostEqual(self.query('SELECT percentile(x, 90) FROM t'), np.percentile(self.values, 90))
+        self.assertAlmostEqual(self.query('SELECT percentile_exact(x, 0.25) FROM t'), np.percentile(self.values, 25))
+        self.assertAlmostEqual(self.query('SELECT median_exact(x) FROM t'), np.median(self.values))
+
+    def test_schema_keeps_result_set(self):
+        p = cpa.dbconnect.p
+        db_type, p.db_type = p.db_type, 'duckdb'
+        db = cpa.dbconnect.DBConnect()
+        db.invalidate_schema_cache()
+        connID = threading.currentThread().getName()
+        db.connections[connID] = db.cursors[connID] = self.conn
+        try:
+            self.conn.execute('SELECT x FROM t')
+            self.assertEqual(db.get_table_schema('t').names, ['x'])
+            self.assertEqual(len(self.conn.fetchall()), 1000)
+        finally:
+            db.connections.pop(connID)
+            db.cursors.pop(connID)
+            db.invalidate_schema_cache()
+            p.db_type = db_type
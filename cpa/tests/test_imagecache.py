@@ -0,0 +1,69 @@
+import os
+import unittest
+import numpy as np
+from cpa.imagecache import ImageCache, BitmapCache
+
+
+def image(value, n=10):
+    # two channels of n x n float64 (800 bytes each for n=10)
+    return [np.full((n, n), value, dtype=float), np.full((n, n), -value, dtype=float)]
+
+
+class ImageCacheTestCase(unittest.TestCase):
+    def test_lru_by_bytes(self):
+        cache = ImageCache(max_bytes=4000)
+        cache.put('a', image(1))
+        cache.put('b', image(2))
+        self.assertEqual(cache.get('a')[0][0, 0], 1)
+        cache.put('c', image(3))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a')[1][0, 0], -1)
+        self.assertEqual(cache.get('c')[0][0, 0], 3)
+        stats = cache.stats()
+        self.assertEqual(stats['memory_bytes'], 3200)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual((stats['hits'], stats['misses']), (3, 1))
+
+    def test_too_large(self):
+        cache = ImageCache(max_bytes=1000)
+        cache.put('big', image(1))
+        self.assertNotIn('big', cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_spill(self):
+        cache = ImageCache(max_bytes=1600, spill_bytes=2**20)
+        cache.put('a', image(1))
+        cache.put('b', image(2))
+        self.assertEqual(cache.stats()['disk_entries'], 1)
+        self.assertIn('a', cache)
+        imgs = cache.get('a')
+        np.testing.assert_array_equal(imgs[1], image(1)[1])
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+        # b was pushed out by a, and a is still on disk
+        self.assertEqual(cache.stats()['disk_entries'], 2)
+        directory = cache.directory
+        cache.clear()
+        self.assertEqual(os.listdir(directory), [])
+        self.assertIsNone(cache.get('a'))
+
+    def test_spill_bound(self):
+        cache = ImageCache(max_bytes=1600, spill_bytes=1)
+        cache.put('a', image(1))
+        cache.put('b', image(2))
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.stats()['disk_bytes'], 0)
+
+
+class BitmapCacheTestCase(unittest.TestCase):
+    def test_lru_by_bytes(self):
+        cache = BitmapCache(max_bytes=100)
+        cache.put(('a', 1.0), 'bitmap a', 40)
+        cache.put(('b', 1.0), 'bitmap b', 40)
+        self.assertEqual(cache.get(('a', 1.0)), 'bitmap a')
+        cache.put(('a', 2.0), 'bitmap a2', 40)
+        self.assertNotIn(('b', 1.0), cache)
+        self.assertEqual(cache.get(('a', 2.0)), 'bitmap a2')
+        cache.put('big', 'big bitmap', 101)
+        self.assertNotIn('big', cache)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 0, 'evictions': 1,
+                                         'entries': 2, 'bytes': 80})
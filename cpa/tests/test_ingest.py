@@ -0,0 +1,65 @@
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from cpa import ingest
+
+
+class IngestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.csv = os.path.join(self.dir, 'objects.csv')
+        with open(self.csv, 'w') as f:
+            f.write('ImageNumber,ObjectNumber,Area,Label\n')
+            for i in range(1, 51):
+                for j in range(1, 21):
+                    f.write('%d,%d,%s,"cell, %d\n%d"\n'%(i, j, '' if j == 3 else '%d.5'%j, i, j))
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE Per_Object (ImageNumber INT, ObjectNumber INT, Area FLOAT, Label TEXT)')
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def test_infer_column_types(self):
+        header, types = ingest.infer_column_types(self.csv)
+        self.assertEqual(header, ['ImageNumber', 'ObjectNumber', 'Area', 'Label'])
+        self.assertEqual(types[:3], ['INT', 'INT', 'FLOAT'])
+        self.assertTrue(types[3].startswith('VARCHAR'))
+
+    def test_iter_blocks_keeps_quoted_newlines(self):
+        data = b'1,"a\nb"\n2,"c"\n3,d\n'
+        blocks = list(ingest.iter_blocks(io.BytesIO(data), block_bytes=4))
+        self.assertEqual(b''.join(blocks), data)
+        rows = sum([ingest.parse_block((b, ['i', 's'], 'utf-8')) for b in blocks], [])
+        self.assertEqual(rows, [(1, 'a\nb'), (2, 'c'), (3, 'd')])
+
+    def load(self, workers):
+        seen = []
+        with ingest.bulk_load_pragmas(self.conn):
+            n = ingest.load_csv_files(self.conn, 'Per_Object', [self.csv], workers=workers,
+                                      block_bytes=1024, progress=lambda done, total: seen.append((done, total)))
+            ingest.create_indexes(self.conn, 'Per_Object', primary_key=['ImageNumber', 'ObjectNumber'])
+            self.conn.commit()
+        self.assertEqual(n, 1000)
+        self.assertEqual(seen[-1][0], seen[-1][1] - len('ImageNumber,ObjectNumber,Area,Label\n'))
+        self.assertEqual(self.conn.execute('SELECT * FROM Per_Object WHERE ImageNumber=7 AND ObjectNumber=3').fetchall(),
+                         [(7, 3, None, 'cell, 7\n3')])
+        self.assertEqual(self.conn.execute('SELECT SUM(Area) FROM Per_Object').fetchone()[0], 50 * (210 + 10 - 3.5))
+
+    def test_load_in_process(self):
+        self.load(workers=1)
+
+    def test_load_in_workers(self):
+        self.load(workers=2)
+
+    def test_cancel(self):
+        self.assertRaises(ingest.IngestCancelled,
+                          lambda: ingest.load_csv_files(self.conn, 'Per_Object', [self.csv], workers=1,
+                                                        block_bytes=1024, progress=lambda done, total: False))
+
+    def test_split_primary_key(self):
+        stmt, key = ingest.split_primary_key('CREATE TABLE t (a INT, b INT,\nPRIMARY KEY (a, b));')
+        self.assertEqual((stmt, key), ('CREATE TABLE t (a INT, b INT);', ['a', 'b']))
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from cpa import modelcache
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = modelcache.snapshot_path(self.dir, 'project')
+        self.arrays = {'keys': np.arange(12, dtype=np.int64).reshape(6, 2),
+                       'codes': np.array([0, -1, 1], dtype=np.int32),
+                       'empty': np.zeros(0, dtype=np.int64)}
+        modelcache.save_snapshot(self.path, 'project', '1.5', self.arrays, {'groups': [['Well', ['A01']]]})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        arrays, meta = modelcache.load_snapshot(self.path, 'project', '1.5')
+        self.assertEqual(meta, {'groups': [['Well', ['A01']]]})
+        self.assertEqual(sorted(arrays), sorted(self.arrays))
+        for name, a in self.arrays.items():
+            self.assertEqual(arrays[name].dtype, a.dtype)
+            np.testing.assert_array_equal(arrays[name], a)
+        self.assertFalse(arrays['keys'].flags.writeable)
+
+    def test_stale(self):
+        self.assertIsNone(modelcache.load_snapshot(self.path, 'project', '2.5'))
+        self.assertIsNone(modelcache.load_snapshot(self.path, 'other', '1.5'))
+        self.assertIsNone(modelcache.load_snapshot(os.path.join(self.dir, 'missing.dm'), 'project', '1.5'))
+
+    def test_corrupt(self):
+        with open(self.path, 'r+b') as f:
+            f.write(b'garbage')
+        self.assertIsNone(modelcache.load_snapshot(self.path, 'project', '1.5'))
+        with open(self.path, 'wb') as f:
+            f.write(b'x')
+        self.assertIsNone(modelcache.load_snapshot(self.path, 'project', '1.5'))
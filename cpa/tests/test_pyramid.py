@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from cpa import pyramid
+from cpa.pyramid import Pyramid, level_for_scale
+
+
+class RecordingArray(object):
+    def __init__(self, array):
+        self.array = array
+        self.dtype = array.dtype
+        self.reads = []
+
+    def __getitem__(self, index):
+        self.reads.append(index)
+        return self.array[index]
+
+
+class PyramidTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.chunk = mock.patch.object(pyramid, 'CHUNK', 16)
+        self.chunk.start()
+        rng = np.random.default_rng(0)
+        self.channels = [(rng.random((70, 45)) * 1000).astype(np.uint16),
+                         rng.random((70, 45)).astype(np.float32)]
+
+    def tearDown(self):
+        self.chunk.stop()
+        shutil.rmtree(self.dir)
+
+    def test_level_for_scale(self):
+        self.assertEqual(level_for_scale(2.0, 5), 0)
+        self.assertEqual(level_for_scale(0.6, 5), 0)
+        self.assertEqual(level_for_scale(0.5, 5), 1)
+        self.assertEqual(level_for_scale(0.2, 5), 2)
+        self.assertEqual(level_for_scale(0.001, 5), 4)
+
+    def test_build_and_read(self):
+        built = Pyramid.build(self.dir, self.channels, 12.5)
+        pyr = Pyramid.open(self.dir, 12.5)
+        self.assertEqual((pyr.shape, pyr.nchannels, pyr.nlevels), ((70, 45), 2, 4))
+        self.assertEqual(pyr.limits, built.limits)
+        self.assertEqual(pyr.level_shape(3), (8, 5))
+        for c, im in enumerate(self.channels):
+            np.testing.assert_array_equal(pyr.read(c, 0), im)
+            np.testing.assert_array_equal(pyr.read(c, 0, (10, 20, 40, 69)), im[20:69, 10:40])
+        level1 = self.channels[1][:70, :44].reshape(35, 2, 22, 2).mean(axis=(1, 3))
+        np.testing.assert_allclose(pyr.channels(1)[1], level1, rtol=1e-6)
+        self.assertEqual(pyr.read(0, 1, (30, 30, 100, 100)).shape, (5, 0))
+
+    def test_reads_only_needed_blocks(self):
+        Pyramid.build(self.dir, self.channels, 0)
+        pyr = Pyramid.open(self.dir, 0)
+        blocks = RecordingArray(pyr._blocks(0, 0))
+        with mock.patch.object(pyr, '_blocks', return_value=blocks):
+            tile = pyr.read(0, 0, (17, 17, 20, 20))
+        np.testing.assert_array_equal(tile, self.channels[0][17:20, 17:20])
+        self.assertEqual(blocks.reads, [(slice(1, 2), slice(1, 2))])
+
+    def test_stale(self):
+        Pyramid.build(self.dir, self.channels, 1.0)
+        self.assertIsNone(Pyramid.open(self.dir, 2.0))
+        self.assertIsNone(Pyramid.open(self.dir + '_missing', 1.0))
+
+    def test_rebuild_keeps_open_files(self):
+        directory = os.path.join(self.dir, 'pyramid')
+        old = Pyramid.build(directory, self.channels, 1.0)
+        before = old.read(0, 0)
+        Pyramid.build(directory, [im[::-1] for im in self.channels], 2.0)
+        # the old pyramid's files were replaced, not overwritten
+        np.testing.assert_array_equal(old.read(0, 0), before)
+        np.testing.assert_array_equal(Pyramid.open(directory, 2.0).read(0, 0), self.channels[0][::-1])
+        self.assertEqual(os.listdir(self.dir), ['pyramid'])
+
+    def test_prune(self):
+        root = os.path.join(self.dir, 'pyramids')
+        for i, name in enumerate(['a', 'b', 'c']):
+            Pyramid.build(os.path.join(root, name), self.channels, 0)
+            os.utime(os.path.join(root, name, pyramid.META_FILE), (100 + i, 100 + i))
+        Pyramid.open(os.path.join(root, 'a'), 0)
+        size = pyramid.directory_size(os.path.join(root, 'a'))
+        os.makedirs(os.path.join(root, 'd.tmp'))
+        os.utime(os.path.join(root, 'd.tmp'), (0, 0))
+        pyramid.prune(root, 2 * size, keep=[os.path.join(root, 'c')])
+        # b was opened least recently; c is in use
+        self.assertEqual(sorted(os.listdir(root)), ['a', 'c'])
@@ -0,0 +1,63 @@
+import shutil
+import tempfile
+import unittest
+from cpa.querycache import QueryCache
+from cpa.dbconnect import _normalize_sql
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_memory_lru(self):
+        cache = QueryCache(max_bytes=200)
+        cache.put('a', 'a' * 50)
+        cache.put('b', 'b' * 50)
+        self.assertEqual(cache.get('a'), 'a' * 50)
+        cache.put('c', 'c' * 50)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'a' * 50)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertTrue(stats['memory_bytes'] <= 200)
+
+    def test_disk_survives(self):
+        cache = QueryCache(directory=self.dir)
+        cache.put('SELECT 1', ([(1,)], ['1']))
+        cache = QueryCache(directory=self.dir)
+        self.assertEqual(cache.get('SELECT 1'), ([(1,)], ['1']))
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+        cache.clear()
+        self.assertEqual(QueryCache(directory=self.dir).get('SELECT 1'), None)
+
+    def test_disk_eviction(self):
+        cache = QueryCache(max_bytes=300, directory=self.dir)
+        for i in range(10):
+            cache.put('q%d'%i, list(range(20)))
+        self.assertTrue(cache.stats()['disk_bytes'] <= 300)
+        self.assertEqual(QueryCache(max_bytes=300, directory=self.dir).get('q9'), list(range(20)))
+
+    def test_discard(self):
+        cache = QueryCache(directory=self.dir)
+        cache.put('SELECT a FROM Foo', 1, group='db1')
+        cache.put('SELECT b FROM Bar', 2, group='db1')
+        cache.put('SELECT a FROM Foo', 3, group='db2')
+        cache.discard('db1', lambda key: 'Foo' in key)
+        self.assertEqual(cache.get('SELECT a FROM Foo', group='db1'), None)
+        cache = QueryCache(directory=self.dir)
+        self.assertEqual(cache.get('SELECT a FROM Foo', group='db1'), None)
+        self.assertEqual(cache.get('SELECT b FROM Bar', group='db1'), 2)
+        self.assertEqual(cache.get('SELECT a FROM Foo', group='db2'), 3)
+        cache.discard('db2')
+        self.assertEqual(QueryCache(directory=self.dir).get('SELECT a FROM Foo', group='db2'), None)
+
+
+class NormalizeSqlTestCase(unittest.TestCase):
+    def test_whitespace(self):
+        self.assertEqual(_normalize_sql(' SELECT  a,\n b FROM t ; '), 'SELECT a, b FROM t')
+
+    def test_quoted_strings_kept(self):
+        self.assertEqual(_normalize_sql("SELECT  'a  b' FROM t"), "SELECT 'a  b' FROM t")
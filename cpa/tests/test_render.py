@@ -0,0 +1,71 @@
+import unittest
+import numpy as np
+from cpa import render
+
+
+class NormalizeTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.im = (rng.random((600, 500)) * 3000 + 10).astype(np.uint16)
+        self.limits = (self.im.min(), self.im.max())
+
+    def test_linear(self):
+        lo, hi = self.limits
+        expected = np.maximum(self.im.astype(float) - lo, 0) / hi
+        np.testing.assert_allclose(render.normalize(self.im, lo, hi, 'Linear'), expected, atol=1e-6)
+
+    def test_log(self):
+        lo, hi = self.limits
+        expected = (np.log(self.im.astype(float)) - np.log(lo)) / (np.log(hi) - np.log(lo))
+        np.testing.assert_allclose(render.normalize(self.im, lo, hi, 'Log'), expected, atol=1e-6)
+
+    def test_bit_depth(self):
+        out = render.normalize(self.im, *self.limits)
+        np.testing.assert_allclose(out, self.im / 65535., atol=1e-6)
+
+    def test_binary_unchanged(self):
+        im = np.zeros((4, 4), dtype=np.float32)
+        im[1, 1] = 1
+        for contrast in ('Log', 'Linear'):
+            np.testing.assert_array_equal(render.normalize(im, 0, 1, contrast), im)
+
+    def test_lookup_table(self):
+        # big 16 bit images go through a lookup table with the same result
+        im = np.tile(self.im, (1, 2))
+        for contrast in ('Log', 'Linear', None):
+            np.testing.assert_allclose(render.normalize_channel(im, self.limits, contrast),
+                                       render.normalize(im, self.limits[0], self.limits[1], contrast),
+                                       atol=1e-6)
+
+
+class BlendTestCase(unittest.TestCase):
+    def test_blend(self):
+        planes = np.array([[[0.5, 1.0]], [[0.25, 0.0]], [[0.5, 0.5]]], dtype=np.float32)
+        rgb = render.blend(planes, ['red', 'gray', 'blue'], ['add', 'add', 'subtract'])
+        self.assertEqual(rgb.shape, (1, 2, 3))
+        np.testing.assert_allclose(rgb[0], [[0.75, 0.25, 0.0], [1.0, 0.0, 0.0]])
+
+    def test_solid(self):
+        planes = np.array([[[0.2, 0.2]], [[1.0, 0.0]]], dtype=np.float32)
+        rgb = render.blend(planes, ['gray', 'yellow'], ['add', 'solid'])
+        np.testing.assert_allclose(rgb[0], [[1, 1, 0], [0.2, 0.2, 0.2]], atol=1e-6)
+
+    def test_downsample(self):
+        im = np.arange(36, dtype=np.float32).reshape(6, 6)
+        self.assertEqual(render.downsample(im, 4).shape, (1, 1))
+        np.testing.assert_array_equal(render.downsample(im, 2)[0], [3.5, 5.5, 7.5])
+        np.testing.assert_array_equal(render.downsample(im, 2, 'strided')[0], [0, 2, 4])
+
+
+class RenderBatchTestCase(unittest.TestCase):
+    def test_matches_single(self):
+        rng = np.random.default_rng(1)
+        tiles = [[rng.random((20, 30)).astype(np.float32) * (i + 1) for _ in range(3)] for i in range(6)]
+        chMap = ['red', 'green', 'blue']
+        batch = render.render_batch(tiles, chMap, 'Log', brightness=1.5)
+        self.assertEqual(batch.shape, (6, 20, 30, 3))
+        self.assertTrue(batch.flags['C_CONTIGUOUS'])
+        for tile, rgb in zip(tiles, batch):
+            limits = [(im.min(), im.max()) for im in tile]
+            np.testing.assert_array_equal(rgb, render.render(tile, chMap, limits, 'Log', brightness=1.5))
+        self.assertEqual(len(render.render_batch([], chMap)), 0)
@@ -0,0 +1,87 @@
+import unittest
+import numpy as np
+from mock import Mock
+from cpa.sampling import ObjectIDResolver, ObjectSampler, draw, locate
+
+
+class LocateTestCase(unittest.TestCase):
+    def test_skips_empty_images(self):
+        # images 0 and 2 have no objects
+        cumsums = np.array([0, 0, 3, 3, 5])
+        rows, ranks = locate(cumsums, np.arange(5))
+        self.assertEqual(list(rows), [1, 1, 1, 3, 3])
+        self.assertEqual(list(ranks), [0, 1, 2, 0, 1])
+
+    def test_draw(self):
+        rng = np.random.default_rng(0)
+        self.assertEqual(sorted(draw(10, 20, rng=rng)), list(range(10)))
+        self.assertEqual(len(draw(10, 20, with_replacement=True, rng=rng)), 20)
+
+
+def make_resolver(objects):
+    imkeys = list(objects)
+    fetch = Mock(side_effect=lambda keys: dict((k, np.array(objects[k])) for k in keys))
+    resolver = ObjectIDResolver(imkeys, [len(objects[k]) for k in imkeys],
+                                [min(objects[k] or [0]) for k in imkeys],
+                                [max(objects[k] or [-1]) for k in imkeys], fetch)
+    return resolver, fetch
+
+
+class ObjectIDResolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.objects = {(1, 1): [1, 2, 3], (1, 2): [2, 5, 9], (2, 1): [], (2, 2): [4, 7]}
+        self.resolver, self.fetch = make_resolver(self.objects)
+
+    def test_key_at_index(self):
+        self.assertEqual(self.resolver.key_at_index((1, 1), 3), (1, 1, 3))
+        self.assertFalse(self.fetch.called)
+        self.assertEqual(self.resolver.key_at_index((1, 2), 2), (1, 2, 5))
+        self.assertEqual(self.resolver.key_at_index((2, 2), 1), (2, 2, 4))
+
+    def test_batch_fetches_once(self):
+        rows = [1, 0, 3, 1, 3, 1]
+        ranks = [2, 0, 1, 0, 0, 1]
+        self.assertEqual(list(self.resolver.object_ids(rows, ranks)), [9, 1, 7, 2, 4, 5])
+        self.assertEqual(self.fetch.call_count, 1)
+        self.resolver.object_ids(rows, ranks)
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_image_object_ids(self):
+        for imkey, ids in self.objects.items():
+            self.assertEqual(list(self.resolver.image_object_ids(imkey)), ids)
+
+
+class ObjectSamplerTestCase(unittest.TestCase):
+    def setUp(self):
+        # image (3,) has gaps in its object numbers: 2, 5, 9
+        self.objects = {(1,): [1, 2, 3], (2,): [], (3,): [2, 5, 9], (4,): [4, 5]}
+        imkeys = list(self.objects)
+        counts = [len(self.objects[k]) for k in imkeys]
+        resolver, self.resolve = make_resolver(self.objects)
+        self.sampler = ObjectSampler(resolver, np.concatenate([[0], np.cumsum(counts)]),
+                                     rng=np.random.default_rng(0))
+        self.all = sorted(k + (o,) for k in imkeys for o in self.objects[k])
+
+    def test_without_replacement(self):
+        self.assertEqual(len(self.sampler), 8)
+        self.assertEqual(sorted(self.sampler.sample(100)), self.all)
+        keys = self.sampler.sample(5)
+        self.assertEqual(len(set(keys)), 5)
+        self.assertTrue(set(keys) <= set(self.all))
+
+    def test_with_replacement(self):
+        keys = self.sampler.sample(100, with_replacement=True)
+        self.assertEqual(len(keys), 100)
+        self.assertEqual(sorted(set(keys)), self.all)
+
+    def test_only_gaps_are_resolved(self):
+        self.sampler.sample(100, [(1,), (4,)])
+        self.assertFalse(self.resolve.called)
+        keys = self.sampler.sample(100, [(3,)])
+        self.assertEqual(sorted(keys), [(3, 2), (3, 5), (3, 9)])
+        self.assertEqual(self.resolve.call_count, 1)
+
+    def test_image_subset(self):
+        self.assertEqual(sorted(self.sampler.sample(100, [(4,), (2,), (5,)])), [(4, 4), (4, 5)])
+        self.assertEqual(self.sampler.sample(10, [(2,)]), [])
+        self.assertEqual(self.sampler.sample(10, []), [])
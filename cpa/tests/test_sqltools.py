@@ -27,3 +27,25 @@ class TestOldFilter(unittest.TestCase):
                 GetResultColumnNames.return_value = ['id', 'select_type', 'table', 'type', 'possible_keys', 'key', 'key_len', 'ref', 'rows', 'Extra']
                 tables = filter.get_tables()
         self.assertEqual(tables, set(['Morphology_Per_Image']))
+
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+@unittest.skipIf(duckdb is None, 'duckdb is not installed')
+class GateSQLTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = duckdb.connect()
+        self.conn.execute('CREATE TABLE t (x DOUBLE)')
+        self.conn.executemany('INSERT INTO t VALUES (?)', [(float(v),) for v in range(10)])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_gate_runs_on_duckdb(self):
+        from cpa.sqltools import Gate1D
+        gate = Gate1D(('t', 'x'), (2, 5))
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM t WHERE %s'%(gate)).fetchone()[0], 4)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM t WHERE %s'%(gate.as_filter())).fetchone()[0], 4)
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import tifffile
+from cpa.stackreader import Stack, TiffStack, open_stack
+
+
+class StackReaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'stack.tif')
+        rng = np.random.default_rng(0)
+        self.stack = (rng.random((7, 20, 30)) * 4000).astype(np.uint16)
+        tifffile.imwrite(self.path, self.stack)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_slices(self):
+        with open_stack(self.path) as stack:
+            self.assertIsInstance(stack, TiffStack)
+            self.assertEqual(len(stack), 7)
+            np.testing.assert_array_equal(stack.plane(4), self.stack[4])
+            np.testing.assert_array_equal(stack.plane('mid'), self.stack[4])
+            planes = list(stack.planes(2, 5))
+            np.testing.assert_array_equal(np.array(planes), self.stack[2:5])
+
+    def test_reads_one_slice(self):
+        with open_stack(self.path) as stack:
+            with mock.patch.object(tifffile.TiffPage, 'asarray', autospec=True,
+                                   side_effect=lambda page: self.stack[page.index]) as asarray:
+                stack.plane('mid')
+                stack.plane(6)
+        self.assertEqual([call[0][0].index for call in asarray.call_args_list], [4, 6])
+
+    def test_projections(self):
+        with open_stack(self.path) as stack:
+            maximum = stack.plane('max')
+            mean = stack.plane('mean')
+            part = stack.project('mean', 1, 3)
+        np.testing.assert_array_equal(maximum, self.stack.max(axis=0))
+        self.assertEqual(maximum.dtype, np.uint16)
+        np.testing.assert_allclose(mean, self.stack.mean(axis=0), rtol=1e-6)
+        self.assertEqual(mean.dtype, np.float32)
+        np.testing.assert_allclose(part, self.stack[1:3].mean(axis=0), rtol=1e-6)
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, Stack)
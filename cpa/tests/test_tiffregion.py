@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import tifffile
+from cpa.tiffregion import read_regions
+
+BOXES = [(10, 20, 74, 84), (-30, 250, 34, 314), (480, -5, 544, 59)]
+
+
+class TiffRegionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.gray = (rng.random((300, 500)) * 4000).astype(np.uint16)
+        self.rgb = (rng.random((300, 500, 3)) * 255).astype(np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data, **kwargs):
+        path = os.path.join(self.dir, name)
+        tifffile.imwrite(path, data, **kwargs)
+        return path
+
+    def check(self, path, image):
+        shape, regions = read_regions(path, BOXES)
+        self.assertEqual(shape, image.shape[:2])
+        for (x0, y0, x1, y1), region in zip(BOXES, regions):
+            np.testing.assert_array_equal(region, image[max(0, y0):y1, max(0, x0):x1])
+            self.assertEqual(region.dtype, image.dtype)
+
+    def test_tiled(self):
+        self.check(self.write('tiled.tif', self.gray, tile=(64, 64), compression='zlib'), self.gray)
+
+    def test_strips(self):
+        self.check(self.write('strips.tif', self.gray, rowsperstrip=16, compression='zlib'), self.gray)
+        self.check(self.write('rgb.tif', self.rgb, photometric='rgb', rowsperstrip=7), self.rgb)
+
+    def test_memmap(self):
+        path = self.write('raw.tif', self.gray.astype('>u2'), byteorder='>')
+        with tifffile.TiffFile(path) as tif:
+            self.assertTrue(tif.pages[0].is_memmappable)
+        self.check(path, self.gray)
+
+    def test_unsupported(self):
+        planes = self.write('planes.tif', np.moveaxis(self.rgb, 2, 0), photometric='rgb', planarconfig='separate')
+        self.assertIsNone(read_regions(planes, BOXES))
+        pages = self.write('pages.tif', np.zeros((2, 10, 10), dtype=np.uint8))
+        self.assertIsNone(read_regions(pages, BOXES))
+        self.assertIsNone(read_regions(os.path.join(self.dir, 'missing.tif'), BOXES))
+
+    def test_max_fraction(self):
+        path = self.write('raw.tif', self.gray)
+        self.assertIsNone(read_regions(path, [(0, 0, 500, 100)], max_fraction=0.25))
+        self.assertIsNotNone(read_regions(path, [(0, 0, 500, 50)], max_fraction=0.25))
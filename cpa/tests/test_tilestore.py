@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from cpa import tilestore
+from cpa.tilestore import TileStore, LimitStore
+
+
+def tile(value):
+    return [np.full((4, 4), value, dtype=np.float32), np.full((4, 4), -value, dtype=np.float32)]
+
+
+class TileStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return TileStore(self.dir, 2, 4, 2)
+
+    def test_round_trip(self):
+        store = self.open()
+        store.put((1, 2), 10.0, tile(3))
+        self.assertEqual(len(store.get((1, 2), 10.0)), 2)
+        np.testing.assert_array_equal(store.get((1, 2), 10.0)[1], tile(3)[1])
+        self.assertIsNone(store.get((1, 2), 11.0))
+        self.assertIsNone(store.get((1, 3), 10.0))
+        self.assertEqual(store.stats()['hits'], 2)
+
+    def test_reopen(self):
+        store = self.open()
+        store.put((1, 2), 10.0, tile(3))
+        store.put((1, 2), 11.0, tile(4))
+        store.put((5, 1), 10.0, tile(5))
+        # a partly written record is ignored
+        with open(os.path.join(self.dir, tilestore.INDEX_FILE), 'ab') as f:
+            f.write(b'xx')
+        store = self.open()
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.get((1, 2), 10.0))
+        self.assertEqual(store.get((1, 2), 11.0)[0][0, 0], 4)
+        self.assertEqual(store.get((5, 1), 10.0)[1][0, 0], -5)
+        store.put((6, 1), 10.0, tile(6))
+        self.assertEqual(store.stats()['slots'], 4)
+        # and cut off, so records added after it can be read back
+        store = self.open()
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.get((6, 1), 10.0)[0][0, 0], 6)
+
+    def test_two_writers(self):
+        # eg: the GUI and a pre-crop run on the same store
+        first, second = self.open(), self.open()
+        first.put((1, 1), 0.0, tile(1))
+        second.put((2, 1), 0.0, tile(2))
+        first.put((3, 1), 0.0, tile(3))
+        self.assertEqual(first.get((2, 1), 0.0)[0][0, 0], 2)
+        store = self.open()
+        self.assertEqual(store.stats()['slots'], 3)
+        for i in (1, 2, 3):
+            self.assertEqual(store.get((i, 1), 0.0)[0][0, 0], i)
+
+    def test_chunks(self):
+        store = self.open()
+        n = tilestore.CHUNK_SLOTS + 2
+        for i in range(n):
+            store.put((i, 1), 0.0, tile(i))
+        self.assertEqual(store.get((n - 1, 1), 0.0)[0][0, 0], n - 1)
+        self.assertEqual(store.get((1, 1), 0.0)[0][0, 0], 1)
+
+    def test_wrong_shape(self):
+        store = self.open()
+        store.put((1, 2), 0.0, tile(1)[:1])
+        self.assertIsNone(store.get((1, 2), 0.0))
+
+
+class LimitStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'limits.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        store = LimitStore(self.path)
+        store.put(['a.tif', 'b.tif'], 10.0, [(np.uint16(3), np.uint16(900)), (0, 1.5)])
+        store.put(['c.tif'], 10.0, [(1, 2)])
+        store.put(['c.tif'], 12.0, [(1, 4)])
+        # a partly written record is ignored
+        with open(self.path, 'a') as f:
+            f.write('{"files": ["d.tif"')
+        store = LimitStore(self.path)
+        self.assertEqual(store.get(('a.tif', 'b.tif'), 10.0), [(3.0, 900.0), (0.0, 1.5)])
+        self.assertIsNone(store.get(['a.tif', 'b.tif'], 11.0))
+        self.assertEqual(store.get(['c.tif'], 12.0), [(1.0, 4.0)])
+        self.assertIsNone(store.get(['c.tif'], 10.0))
+        self.assertIsNone(store.get(['d.tif'], 10.0))
@@ -0,0 +1,105 @@
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import numpy as np
+from cpa import pyramid, render, viewport
+from cpa.pyramid import Pyramid
+from cpa.viewport import ArraySource, TileRenderer, render_tile, tiles_in_view
+
+SETTINGS = (('red', 'green'), 1.0, 'Linear', ('add', 'add'))
+
+
+class BlockingSource(ArraySource):
+    '''Holds the renderer on its first read until released.'''
+    def __init__(self, imgs, limits):
+        super(BlockingSource, self).__init__(imgs, limits)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def channels(self, level, region=None):
+        self.started.set()
+        self.release.wait(5)
+        return super(BlockingSource, self).channels(level, region)
+
+
+class ViewportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tile = mock.patch.object(viewport, 'TILE', 16)
+        self.tile.start()
+        rng = np.random.default_rng(0)
+        self.imgs = [(rng.random((70, 45)) * 1000).astype(np.uint16),
+                     rng.random((70, 45)).astype(np.float32)]
+        self.limits = [(im.min(), im.max()) for im in self.imgs]
+        self.source = ArraySource(self.imgs, self.limits)
+
+    def tearDown(self):
+        self.tile.stop()
+
+    def test_tiles_in_view(self):
+        tiles = tiles_in_view((16, 16, 16, 16), (70, 45))
+        self.assertEqual(tiles, [(1, 1)])
+        tiles = tiles_in_view((16, 16, 16, 16), (70, 45), border=1)
+        self.assertEqual(tiles[0], (1, 1))
+        self.assertEqual(sorted(tiles), [(c, r) for c in range(3) for r in range(3)])
+        self.assertEqual(len(tiles_in_view((0, 0, 1000, 1000), (70, 45))), 3 * 5)
+
+    def test_render_tile(self):
+        # at full size, tiles are crops of the whole rendered image
+        whole = render.render(self.imgs, list(SETTINGS[0]), self.limits, contrast='Linear')
+        tile = render_tile(self.source, 0, (2, 4), 1.0, SETTINGS)
+        np.testing.assert_array_equal(tile, whole[64:70, 32:45])
+        # zoomed in, each pixel is repeated
+        tile = render_tile(self.source, 0, (0, 0), 4.0, SETTINGS)
+        np.testing.assert_array_equal(tile, whole[:4, :4].repeat(4, axis=0).repeat(4, axis=1))
+
+    def test_pyramid_source(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(pyramid, 'CHUNK', 16):
+                pyr = Pyramid.build(directory, self.imgs, 0)
+                for scale in (1.0, 0.5, 0.3):
+                    level = pyr.level_for_scale(scale)
+                    source = ArraySource(pyr.channels(level), self.limits)
+                    shape = viewport.display_shape(pyr.shape, scale)
+                    for tile in tiles_in_view((0, 0, 100, 100), shape):
+                        np.testing.assert_array_equal(render_tile(pyr, level, tile, scale, SETTINGS),
+                                                      render_tile(source, 0, tile, scale * 2**level, SETTINGS))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_progressive(self):
+        done = []
+        finished = threading.Event()
+        renderer = TileRenderer(self.source, callback=lambda key: (done.append(key), finished.set()))
+        view = (0, 0, 16, 16)
+        self.assertEqual(renderer.request(view, 0.5, SETTINGS), [])
+        while len(done) < 5:
+            self.assertTrue(finished.wait(5))
+            finished.clear()
+        renderer.close()
+        # coarse tile first, then the full one, then the border
+        self.assertEqual([key[:3] for key in done[:2]], [(3, 0, 0), (1, 0, 0)])
+        self.assertEqual(sorted(key[:3] for key in done[2:]), [(1, 0, 1), (1, 1, 0), (1, 1, 1)])
+        drawn = renderer.request((0, 0, 20, 20), 0.5, SETTINGS)
+        self.assertEqual([(x, y, key[0]) for x, y, key, rgb in drawn[:1]], [(0, 0, 1)])
+        self.assertEqual(len(drawn), 4)
+        np.testing.assert_array_equal(drawn[0][3], render_tile(self.source, 1, (0, 0), 0.5, SETTINGS))
+
+    def test_cancel(self):
+        source = BlockingSource(self.imgs, self.limits)
+        done = []
+        renderer = TileRenderer(source, callback=done.append)
+        renderer.request((0, 0, 16, 16), 1.0, SETTINGS)
+        self.assertTrue(source.started.wait(5))
+        running = renderer.running
+        # scrolling away drops everything queued for the first view
+        renderer.request((0, 48, 16, 16), 1.0, SETTINGS)
+        self.assertNotIn(running, renderer.wanted)
+        self.assertTrue(all(key[2] >= 2 for key in renderer.jobs))
+        renderer.close()
+        source.release.set()
+        renderer.thread.join(5)
+        self.assertEqual(done, [])
+        self.assertIsNotNone(renderer.cache.get(running))
@@ -0,0 +1,108 @@
+'''
+Reading rectangular regions of TIFF images without decoding the rest of
+the image, used by ImageReader.ReadRegions to cut object tiles.
+
+Uncompressed images stored in one contiguous block are read through a
+memory map. Other images are read by strip or tile with tifffile: only the
+segments that overlap a region are read and decoded, and a segment shared
+by several regions is decoded once.
+
+Only single page, single plane TIFFs with interleaved samples (if any) are
+read this way. read_regions returns None for anything else, and the caller
+decodes the whole image instead.
+'''
+import logging
+
+import numpy as np
+import tifffile
+
+PHOTOMETRIC_PALETTE = 3
+
+
+def _supported(tif, page):
+    return (len(tif.pages) == 1 and page.dtype is not None and
+            page.imagedepth == 1 and
+            (page.samplesperpixel == 1 or page.planarconfig == 1) and
+            page.photometric != PHOTOMETRIC_PALETTE and
+            not page.is_subsampled)
+
+
+def _clip(box, w, h):
+    x0, y0, x1, y1 = [int(v) for v in box]
+    x0, y0 = min(max(0, x0), w), min(max(0, y0), h)
+    return x0, y0, max(x0, min(w, x1)), max(y0, min(h, y1))
+
+
+def read_regions(filename, boxes, max_fraction=1.0):
+    '''
+    Reads regions of the first page of a TIFF file.
+    boxes -- list of (x0, y0, x1, y1), clipped to the image
+    max_fraction -- if the boxes cover more than this fraction of the image,
+                    return None, since decoding it whole is as quick
+    Returns ((height, width) of the image, list of region arrays), each
+    region (y1 - y0, x1 - x0) or (y1 - y0, x1 - x0, samples) like
+    imageio.imread, or None if the file can't be read by region.
+    '''
+    try:
+        with tifffile.TiffFile(filename) as tif:
+            page = tif.pages[0]
+            if not _supported(tif, page):
+                return None
+            h, w = page.imagelength, page.imagewidth
+            boxes = [_clip(box, w, h) for box in boxes]
+            area = sum([(x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes])
+            if area > max_fraction * w * h:
+                return None
+            if page.is_memmappable:
+                regions = _read_memmap(tif, page, filename, boxes)
+            else:
+                regions = _read_segments(tif, page, boxes)
+    except Exception as e:
+        logging.info('Reading regions of "%s" failed, the whole image will be read: %s'%(filename, e))
+        return None
+    if page.samplesperpixel == 1:
+        regions = [region[:, :, 0] for region in regions]
+    return (h, w), regions
+
+
+def _read_memmap(tif, page, filename, boxes):
+    samples = page.samplesperpixel
+    dtype = np.dtype(page.dtype).newbyteorder(tif.byteorder)
+    image = np.memmap(filename, dtype=dtype, mode='r', offset=page.dataoffsets[0],
+                      shape=(page.imagelength, page.imagewidth, samples))
+    return [np.array(image[y0:y1, x0:x1], dtype=page.dtype) for x0, y0, x1, y1 in boxes]
+
+
+def _read_segments(tif, page, boxes):
+    h, w = page.imagelength, page.imagewidth
+    if page.is_tiled:
+        seg_h, seg_w = page.tilelength, page.tilewidth
+    else:
+        seg_h, seg_w = min(h, page.rowsperstrip or h), w
+    ncols = -(-w // seg_w)
+    box_segments = []
+    for x0, y0, x1, y1 in boxes:
+        box_segments.append([r * ncols + c
+                             for r in range(y0 // seg_h, -(-y1 // seg_h))
+                             for c in range(x0 // seg_w, -(-x1 // seg_w))])
+    indices = sorted(set([i for segments in box_segments for i in segments]))
+    decoded = {}   # segment index -> (row, column, (length, width, samples) array or None)
+    segments = tif.filehandle.read_segments([page.dataoffsets[i] for i in indices],
+                                            [page.databytecounts[i] for i in indices],
+                                            indices=indices)
+    for data, index in segments:
+        segment, position, shape = page.decode(data, index, jpegtables=page.jpegtables)
+        decoded[index] = (position[2], position[3], None if segment is None else segment[0])
+    regions = []
+    for (x0, y0, x1, y1), segments in zip(boxes, box_segments):
+        region = np.zeros((y1 - y0, x1 - x0, page.samplesperpixel), dtype=page.dtype)
+        for index in segments:
+            y, x, segment = decoded[index]
+            if segment is None:
+                continue
+            ya, yb = max(y0, y), min(y1, y + segment.shape[0])
+            xa, xb = max(x0, x), min(x1, x + segment.shape[1])
+            if ya < yb and xa < xb:
+                region[ya - y0:yb - y0, xa - x0:xb - x0] = segment[ya - y:yb - y, xa - x:xb - x]
+        regions.append(region)
+    return regions
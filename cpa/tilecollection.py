@@ -2,11 +2,13 @@
 from .dbconnect import DBConnect
 from .properties import Properties
 from .singleton import Singleton
-from heapq import heappush, heappop
+from contextlib import contextmanager
+from heapq import heappush, heappop, heapify
 from weakref import WeakValueDictionary
 from . import imagetools
 import logging
 import numpy
+import os
 import threading
 import wx
 import javabridge
@@ -29,12 +31,62 @@ houricon = numpy.array([
 [0, 0, 0.4, 0.9, 1, 1, 1, 1, 0.9, 0.4, 0, 0],
 ], dtype=float)
 
+# Default number of tile loader threads (Properties.tile_loader_threads)
+DEFAULT_LOADER_THREADS = max(1, min(4, os.cpu_count() or 1))
+
 def load_lock():
     return TileCollection().load_lock
 
 class List(list):
     pass
 
+class LoadLock(object):
+    '''
+    Pauses tile loading. Any number of TileLoader threads may load tiles at
+    once (see loading), but while some thread holds the lock itself
+    (with load_lock(): ...) no tiles are loaded.
+    '''
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.held = False
+        self.waiting = 0   # threads waiting to take the lock
+        self.loaders = 0   # threads currently loading tiles
+
+    def acquire(self):
+        with self.cv:
+            self.waiting += 1
+            while self.held or self.loaders:
+                self.cv.wait()
+            self.waiting -= 1
+            self.held = True
+
+    def release(self):
+        with self.cv:
+            self.held = False
+            self.cv.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @contextmanager
+    def loading(self):
+        '''Context for loading tiles, which waits while the lock is held or
+        wanted.'''
+        with self.cv:
+            while self.held or self.waiting:
+                self.cv.wait()
+            self.loaders += 1
+        try:
+            yield
+        finally:
+            with self.cv:
+                self.loaders -= 1
+                self.cv.notify_all()
+
 class TileCollection(metaclass=Singleton):
     '''
     Main access point for loading tiles through the TileLoader.
@@ -43,7 +95,7 @@ class TileCollection(metaclass=Singleton):
         self.tileData  = WeakValueDictionary()
         self.loadq     = []
         self.cv        = threading.Condition()
-        self.load_lock = threading.Lock()
+        self.load_lock = LoadLock()
         self.group_priority = 0
         self.load_icon_template = None
         # Gray placeholder for unloaded images
@@ -102,9 +154,31 @@ class TileCollection(metaclass=Singleton):
                     temp[order] = List(self.imagePlaceholder)
                     self.tileData[obKey] = temp[order]
             tiles = [self.tileData[obKey] for obKey in obKeys]
-            self.cv.notify()
+            self.cv.notify_all()
         return tiles
 
+    def _pop_batch(self):
+        '''
+        Pops the first item in the load queue along with the other queued
+        object tiles from the same image, in priority order. Returns a list
+        of (obKey, display_whole_image). Caller must hold self.cv.
+        '''
+        priority, obKey, display_whole_image = heappop(self.loadq)
+        batch = [(priority, obKey, display_whole_image)]
+        if not display_whole_image and not p.process_3D:
+            imKey = obKey[:-1]
+            rest = []
+            for item in self.loadq:
+                if not item[2] and item[1][:-1] == imKey:
+                    batch.append(item)
+                else:
+                    rest.append(item)
+            if len(batch) > 1:
+                heapify(rest)
+                self.loadq[:] = rest
+                batch.sort(key=lambda item: item[0])
+        return [(obKey, display_whole_image) for priority, obKey, display_whole_image in batch]
+
 
 # Event generated by the TileLoader thread.
 EVT_TILE_UPDATED_ID = wx.NewId()
@@ -128,27 +202,42 @@ class TileUpdatedEvent(wx.PyEvent):
         self.data = data
 
 
-class TileLoader(threading.Thread):
+class TileLoader(object):
     '''
-    This thread is owned by the TileCollection singleton and is kept
-    running for the duration of the app execution.  Whenever
-    TileCollection has obKeys in its load queue (loadq), this thread
-    will remove them from the queue and fetch the tile data for
-    them. The tile data is then written back into TileCollection's
-    tileData dict over the existing placeholder. Finally an event is
-    posted to the svn to tell it to refresh the tiles.
+    This pool of TileLoaderThreads is owned by the TileCollection
+    singleton and is kept running for the duration of the app execution.
+    Whenever TileCollection has obKeys in its load queue (loadq), a thread
+    will remove the first of them, along with any other queued obKeys from
+    the same image, and fetch their tile data reading the image only once.
+    The tile data is then written back into TileCollection's tileData dict
+    over the existing placeholder. Finally an event is posted to each
+    window in notify_window to tell it to refresh the tiles.
     '''
-    def __init__(self, tc, notify_window):
-        threading.Thread.__init__(self)
-        self.setName('TileLoader_%s'%(self.getName()))
+    def __init__(self, tc, notify_window, threads=None):
         self.notify_window = []
         if notify_window is not None:
             self.notify_window.append(notify_window)
         self.tile_collection = tc
+        threads = threads or p.tile_loader_threads or DEFAULT_LOADER_THREADS
+        self.threads = [TileLoaderThread(self) for i in range(threads)]
+
+    def abort(self):
+        for thread in self.threads:
+            thread.abort()
+
+
+class TileLoaderThread(threading.Thread):
+    '''One of the threads of a TileLoader.'''
+    def __init__(self, loader):
+        threading.Thread.__init__(self)
+        self.setName('TileLoader_%s'%(self.getName()))
+        self.loader = loader
+        self.tile_collection = loader.tile_collection
         self._want_abort = False
         self.start()
 
     def run(self):
+        tc = self.tile_collection
         if p.force_bioformats:
             logging.debug("Starting javabridge")
             import bioformats
@@ -156,55 +245,55 @@ class TileLoader(threading.Thread):
             javabridge.attach()
         try:
             while 1:
-                self.tile_collection.cv.acquire()
-                # If there are no objects in the queue then wait
-                while not self.tile_collection.loadq:
-                    self.tile_collection.cv.wait()
-
-                if self._want_abort:
-                    self.tile_collection.cv.release()
-                    db = DBConnect()
-                    db.CloseConnection()
-                    logging.info('%s aborted'%self.getName())
-                    return
-
-                data = heappop(self.tile_collection.loadq)
-                obKey = data[1]
-                display_whole_image = data[2] #display whole image instead of object image
-
-                self.tile_collection.cv.release()
-
-                # wait until loading has completed before continuing
-                with self.tile_collection.load_lock:
-                    # Make sure tile hasn't been deleted outside this thread
-                    if not self.tile_collection.tileData.get(obKey, None):
-                        continue
-
-                    # Get the tile
-                    new_data = imagetools.FetchTile(obKey, display_whole_image=display_whole_image)
-                    if new_data is None:
-                        #if fetching fails, leave the tile blank
-                        continue
-
-                    tile_data = self.tile_collection.tileData.get(obKey, None)
-
-                    # Make sure tile hasn't been deleted outside this thread
-                    if tile_data is not None:
-                        # copy each channel
-                        for i in range(len(tile_data)):
-                            tile_data[i] = new_data[i]
-                        for window in self.notify_window:
-                            wx.PostEvent(window, TileUpdatedEvent(obKey))
+                with tc.cv:
+                    # If there are no objects in the queue then wait
+                    while not tc.loadq and not self._want_abort:
+                        tc.cv.wait()
+
+                    if self._want_abort:
+                        db = DBConnect()
+                        db.CloseConnection()
+                        logging.info('%s aborted'%self.getName())
+                        return
+
+                    batch = tc._pop_batch()
+
+                # wait until loading isn't paused before continuing
+                with tc.load_lock.loading():
+                    self.load(batch)
         finally:
             if javabridge.get_env() is not None:
                 javabridge.detach()
 
+    def load(self, batch):
+        tc = self.tile_collection
+        # Skip tiles that have been deleted outside this thread
+        batch = [(obKey, whole) for obKey, whole in batch if tc.tileData.get(obKey, None)]
+        if not batch:
+            return
+
+        # Get the tiles (all from the same image, or a single whole image)
+        display_whole_image = batch[0][1]
+        obKeys = [obKey for obKey, whole in batch]
+        for obKey, new_data in zip(obKeys, imagetools.FetchTiles(obKeys, display_whole_image)):
+            if new_data is None:
+                #if fetching fails, leave the tile blank
+                continue
+
+            tile_data = tc.tileData.get(obKey, None)
+
+            # Make sure tile hasn't been deleted outside this thread
+            if tile_data is not None:
+                # copy each channel
+                for i in range(len(tile_data)):
+                    tile_data[i] = new_data[i]
+                for window in list(self.loader.notify_window):
+                    wx.PostEvent(window, TileUpdatedEvent(obKey))
+
     def abort(self):
         self._want_abort = True
-        self.tile_collection.cv.acquire()
-        heappush(self.tile_collection.loadq, ((0, 0, 0), '<ABORT>'))
-        self.tile_collection.cv.notify()
-        self.tile_collection.cv.release()
+        with self.tile_collection.cv:
+            self.tile_collection.cv.notify_all()
 
 
 
@@ -0,0 +1,296 @@
+'''
+A persistent store of object tiles (the channel crops around objects shown
+by Classifier, SortBins and the image gallery), so tiles cut in an earlier
+session can be shown without reading their images again.
+
+Every tile in a store has the same shape: channels x tile size x tile size
+float32. Tiles are written to fixed-size slots in chunk files of
+CHUNK_SLOTS slots each, which are read through memory maps. An append-only
+index file records the object key, the modification time of the object's
+image files and the slot of each tile. A tile is only used while its
+image's modification time is unchanged; newer crops are written to new
+slots.
+
+Several processes (eg: the GUI and "python -m cpa.tilestore") can write
+to a store at once: a writer holds a lock on LOCK_FILE, catches up with
+the records others have appended, and takes the slot after the last one.
+A record left partly written by a crashed writer is cut off the index.
+
+A LimitStore records the intensity range of each channel of the images
+that have been decoded whole. Tiles carry the range of their image in
+their corners, so tiles cut from a region of an image (see
+imagetools.CropRegions) need it before the image has been read again.
+'''
+import contextlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+CHUNK_SLOTS = 1024
+INDEX_FILE = 'index.bin'
+LOCK_FILE = 'index.lock'
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    '''Holds an exclusive lock on the file at path, which other processes
+    taking the same lock wait for.'''
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)   # released when f is closed
+            yield
+            return
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def image_mtime(filenames):
+    '''
+    Returns the latest modification time of an image's channel files, or 0
+    for files that can't be checked (eg: URLs).
+    '''
+    mtime = 0.0
+    for filename in filenames:
+        try:
+            mtime = max(mtime, os.path.getmtime(filename))
+        except (OSError, TypeError):
+            pass
+    return mtime
+
+
+class TileStore(object):
+    '''
+    Tiles keyed by object key, stored under directory.
+    nchannels, size -- the shape of every tile is (size, size) per channel
+    key_len -- number of columns in an object key
+    '''
+    def __init__(self, directory, nchannels, size, key_len):
+        self.directory = directory
+        self.nchannels = nchannels
+        self.size = size
+        self.slot_shape = (nchannels, size, size)
+        self.slot_bytes = nchannels * size * size * 4
+        self.record = np.dtype([('key', '<i8', (key_len,)), ('mtime', '<f8'), ('slot', '<i8')])
+        self.lock = threading.Lock()
+        self.maps = {}   # chunk number -> read-only memmap of the chunk
+        self.index = {}  # object key -> (mtime, slot)
+        self.nslots = 0
+        self.index_bytes = 0   # size of the index file read so far
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            with self._lock():
+                self._read_index()
+        except OSError as e:
+            logging.warn('Failed to read the tile store "%s": %s'%(directory, e))
+
+    def _lock(self):
+        return file_lock(os.path.join(self.directory, LOCK_FILE))
+
+    def _read_index(self):
+        # Caller must hold the file lock. Reads the records appended since
+        # the last call; record n is the tile in slot n.
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        nbytes = os.path.getsize(path)
+        whole = nbytes - nbytes % self.record.itemsize
+        if whole != nbytes:
+            # a record left partly written by a writer that died; later
+            # records would be misaligned after it
+            logging.info('Dropping a partly written record from the tile store "%s"'%(self.directory))
+            with open(path, 'r+b') as f:
+                f.truncate(whole)
+        if whole <= self.index_bytes:
+            return
+        with open(path, 'rb') as f:
+            f.seek(self.index_bytes)
+            records = np.fromfile(f, dtype=self.record, count=(whole - self.index_bytes) // self.record.itemsize)
+        for key, mtime, slot in zip(map(tuple, records['key'].tolist()),
+                                    records['mtime'].tolist(), records['slot'].tolist()):
+            self.index[key] = (mtime, slot)
+        self.index_bytes = whole
+        self.nslots = whole // self.record.itemsize
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.directory, 'chunk_%05d.bin'%(chunk))
+
+    def _chunk(self, chunk):
+        # Caller must hold self.lock
+        if chunk not in self.maps:
+            self.maps[chunk] = np.memmap(self._chunk_path(chunk), dtype=np.float32, mode='r',
+                                         shape=(CHUNK_SLOTS,) + self.slot_shape)
+        return self.maps[chunk]
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, obKey, mtime):
+        '''
+        Returns the stored tile of an object as a list of channel arrays, or
+        None if there is no tile for the image modification time mtime.
+        '''
+        obKey = tuple(int(k) for k in obKey)
+        with self.lock:
+            entry = self.index.get(obKey, None)
+            if entry is None or entry[0] != mtime:
+                self.misses += 1
+                return None
+            self.hits += 1
+            slot = entry[1]
+            tile = np.array(self._chunk(slot // CHUNK_SLOTS)[slot % CHUNK_SLOTS])
+        return list(tile)
+
+    def put(self, obKey, mtime, tile):
+        '''Stores the tile (list of channel arrays) of an object.'''
+        obKey = tuple(int(k) for k in obKey)
+        data = np.asarray(tile, dtype=np.float32)
+        if data.shape != self.slot_shape:
+            return
+        with self.lock:
+            entry = self.index.get(obKey, None)
+            if entry is not None and entry[0] == mtime:
+                return
+            try:
+                with self._lock():
+                    # another process may have added tiles since
+                    self._read_index()
+                    entry = self.index.get(obKey, None)
+                    if entry is not None and entry[0] == mtime:
+                        return
+                    slot = self.nslots
+                    chunk, offset = slot // CHUNK_SLOTS, slot % CHUNK_SLOTS
+                    path = self._chunk_path(chunk)
+                    if not os.path.exists(path):
+                        with open(path, 'wb') as f:
+                            f.truncate(CHUNK_SLOTS * self.slot_bytes)
+                    with open(path, 'r+b') as f:
+                        f.seek(offset * self.slot_bytes)
+                        f.write(data.tobytes())
+                    record = np.zeros(1, dtype=self.record)
+                    record['key'], record['mtime'], record['slot'] = obKey, mtime, slot
+                    with open(os.path.join(self.directory, INDEX_FILE), 'ab') as f:
+                        f.write(record.tobytes())
+            except OSError as e:
+                logging.warn('Failed to write tile %s to the tile store "%s": %s'%(obKey, self.directory, e))
+                return
+            self.nslots += 1
+            self.index_bytes += self.record.itemsize
+            self.index[obKey] = (mtime, slot)
+
+    def stats(self):
+        '''Returns a dict of hit/miss counters and the store's size.'''
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'tiles': len(self.index),
+                    'slots': self.nslots}
+
+
+class LimitStore(object):
+    '''
+    The (min, max) of each channel of images, keyed by their channel file
+    names, stored as lines of JSON appended to the file at path. A record
+    is only used while the image's modification time is unchanged.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.limits = {}   # tuple of file names -> (mtime, list of (min, max))
+        self._read()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue   # a partly written record
+                self.limits[tuple(record['files'])] = (record['mtime'], [tuple(lim) for lim in record['limits']])
+
+    def get(self, filenames, mtime):
+        '''Returns the recorded limits of an image's channels, or None if
+        there are none for the image modification time mtime.'''
+        with self.lock:
+            entry = self.limits.get(tuple(filenames), None)
+        if entry is None or entry[0] != mtime:
+            return None
+        return entry[1]
+
+    def put(self, filenames, mtime, limits):
+        '''Records the limits (list of (min, max)) of an image's channels.'''
+        key = tuple(filenames)
+        limits = [(float(lo), float(hi)) for lo, hi in limits]
+        with self.lock:
+            if self.limits.get(key, None) == (mtime, limits):
+                return
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps({'files': list(key), 'mtime': mtime, 'limits': limits}) + '\n')
+            except OSError as e:
+                logging.warn('Failed to record the intensity range of "%s": %s'%(key[0], e))
+                return
+            self.limits[key] = (mtime, limits)
+
+
+def precrop(obKeys, progress=None, batch_size=256):
+    '''
+    Cuts the tiles of obKeys into the tile store, reading each image once.
+    progress -- optional callable(done, total); if it returns False the
+                remaining tiles are skipped
+    Returns the number of objects processed.
+    '''
+    from . import imagetools
+    obKeys = sorted(set(tuple(obKey) for obKey in obKeys))
+    for start in range(0, len(obKeys), batch_size):
+        imagetools.FetchTiles(obKeys[start:start + batch_size])
+        done = min(start + batch_size, len(obKeys))
+        if progress is not None and progress(done, len(obKeys)) is False:
+            return done
+    return len(obKeys)
+
+
+def start_precrop(obKeys, progress=None):
+    '''Runs precrop in a background thread, which is returned.'''
+    thread = threading.Thread(target=precrop, args=(obKeys, progress), name='TilePrecrop')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    # python -m cpa.tilestore <properties file> <training set file | number of random objects>
+    import sys
+    from .properties import Properties
+    from .dbconnect import DBConnect
+    from .datamodel import DataModel
+    from .trainingset import TrainingSet
+
+    logging.basicConfig(level=logging.INFO)
+    p = Properties()
+    p.LoadFile(sys.argv[1])
+    p.tile_store = True
+    DBConnect().connect()
+    if sys.argv[2].isdigit():
+        obKeys = DataModel().GetRandomObjects(int(sys.argv[2]))
+    else:
+        obKeys = TrainingSet(p, sys.argv[2], labels_only=True).get_object_keys()
+    precrop(obKeys, progress=lambda done, total: logging.info('Cropped %d of %d objects'%(done, total)))
@@ -206,3 +206,15 @@ def auc(positives, negatives):
         return auc * 1.0 / n
     else:
         return np.nan
+
+def cpa_data_dir(*subdirs):
+    """
+    Return the path of CPA's per-user data directory (~/CPA), or of a
+    subdirectory of it, creating it if necessary.
+    """
+    path = os.getenv('USERPROFILE') or os.getenv('HOMEPATH') or \
+        os.path.expanduser('~')
+    path = os.path.join(path, 'CPA', *subdirs)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
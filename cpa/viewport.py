@@ -0,0 +1,203 @@
+'''
+Tiled rendering of the visible part of a large image, used by ImagePanel
+(and so ImageViewer) instead of one bitmap of the whole image.
+
+The displayed image is split into TILE x TILE pixel tiles. Only the tiles
+in view, plus a border of BORDER tiles around it, are read, merged and
+colorized, by a background thread, from the pyramid level that matches the
+zoom. Each tile is first drawn from a level COARSE_LEVELS coarser, which
+is cheap to read and render, and then replaced by the tile at full
+resolution. Rendered tiles are cached by (level, tile column, tile row,
+scale, display settings). When the view moves, tiles queued for the old
+view that are no longer needed are dropped.
+
+A tile source is an image pyramid (see pyramid.Pyramid) or anything with
+the same shape, nlevels, limits, level_shape and channels members, such
+as ArraySource.
+'''
+import logging
+import threading
+
+import numpy as np
+
+from . import render
+from .imagecache import BitmapCache
+from .pyramid import level_for_scale
+
+TILE = 256
+BORDER = 1
+COARSE_LEVELS = 2
+DEFAULT_CACHE_BYTES = 64 * 2**20
+
+
+class ArraySource(object):
+    '''
+    A tile source for an image already in memory. Level n is every 2**n'th
+    pixel of the image, so coarse levels cost nothing to make.
+    imgs -- list of 2D channel arrays
+    limits -- (min, max) of each channel
+    '''
+    def __init__(self, imgs, limits):
+        self.imgs = imgs
+        self.limits = limits
+        self.shape = imgs[0].shape
+        self.nlevels = 1
+        while max(self.level_shape(self.nlevels - 1)) > TILE:
+            self.nlevels += 1
+
+    def level_shape(self, level):
+        h, w = self.shape
+        for i in range(level):
+            h, w = h // 2, w // 2
+        return h, w
+
+    def channels(self, level, region=None):
+        f = 2**level
+        h, w = self.level_shape(level)
+        x0, y0, x1, y1 = region or (0, 0, w, h)
+        return [im[y0 * f:y1 * f:f, x0 * f:x1 * f:f] for im in self.imgs]
+
+
+def display_shape(shape, scale):
+    '''Returns the (height, width) of an image of shape drawn at scale.'''
+    return int(shape[0] * scale), int(shape[1] * scale)
+
+
+def tiles_in_view(view, shape, border=0):
+    '''
+    Returns the (column, row) of the tiles that overlap the view, plus
+    border tiles around it, nearest the middle of the view first.
+    view -- (x, y, width, height) in displayed pixels
+    shape -- displayed (height, width) of the image
+    '''
+    x, y, w, h = view
+    ncols, nrows = -(-shape[1] // TILE), -(-shape[0] // TILE)
+    c0, r0 = max(0, x // TILE - border), max(0, y // TILE - border)
+    c1 = min(ncols, -(-(x + w) // TILE) + border)
+    r1 = min(nrows, -(-(y + h) // TILE) + border)
+    mx, my = (x + w / 2.) / TILE - 0.5, (y + h / 2.) / TILE - 0.5
+    tiles = [(c, r) for r in range(r0, r1) for c in range(c0, c1)]
+    return sorted(tiles, key=lambda t: (t[0] - mx)**2 + (t[1] - my)**2)
+
+
+def render_tile(source, level, tile, scale, settings):
+    '''
+    Renders one displayed tile of source at scale from a pyramid level.
+    Each displayed pixel shows the level pixel under its centre; level
+    pixels shown by more than one displayed pixel are rendered once.
+    tile -- (column, row)
+    settings -- (chMap, brightness, contrast, blending), see render.render
+    Returns a uint8 (h, w, 3) array, h and w are TILE except at the edges.
+    '''
+    chMap, brightness, contrast, blending = settings
+    h, w = display_shape(source.shape, scale)
+    x0, y0 = tile[0] * TILE, tile[1] * TILE
+    x1, y1 = min(w, x0 + TILE), min(h, y0 + TILE)
+    lh, lw = source.level_shape(level)
+    level_scale = scale * 2**level
+    xs = np.minimum(((np.arange(x0, x1) + 0.5) / level_scale).astype(int), lw - 1)
+    ys = np.minimum(((np.arange(y0, y1) + 0.5) / level_scale).astype(int), lh - 1)
+    xs, xi = np.unique(xs, return_inverse=True)
+    ys, yi = np.unique(ys, return_inverse=True)
+    imgs = source.channels(level, (xs[0], ys[0], xs[-1] + 1, ys[-1] + 1))
+    imgs = [im[np.ix_(ys - ys[0], xs - xs[0])] for im in imgs]
+    rgb = render.render(imgs, list(chMap), source.limits, contrast=contrast,
+                        brightness=brightness, blending=list(blending))
+    return rgb[np.ix_(yi, xi)]
+
+
+class TileRenderer(object):
+    '''
+    Renders the tiles of a source in a background thread.
+    callback -- called from that thread with the key of each tile rendered
+                for the latest view
+    '''
+    def __init__(self, source, callback=None, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.source = source
+        self.callback = callback
+        self.cache = BitmapCache(cache_bytes)
+        self.cv = threading.Condition()
+        self.jobs = []         # tile keys to render for the latest view, next first
+        self.wanted = set()    # every tile key queued for the latest view
+        self.running = None    # tile key being rendered
+        self.closed = False
+        self.thread = None
+
+    def level_for_scale(self, scale):
+        return level_for_scale(scale, self.source.nlevels)
+
+    def tile_rect(self, key):
+        '''Returns the (x, y, width, height) a tile key is drawn at.'''
+        level, col, row, scale, settings = key
+        h, w = display_shape(self.source.shape, scale)
+        x, y = col * TILE, row * TILE
+        return x, y, min(TILE, w - x), min(TILE, h - y)
+
+    def request(self, view, scale, settings):
+        '''
+        Returns what can be drawn of the view now, as a list of
+        (x, y, key, rgb) for each tile that has been rendered at full or
+        coarse resolution, and queues the tiles still missing in place of
+        any queued for an earlier view.
+        view -- (x, y, width, height) in displayed pixels
+        settings -- hashable (chMap, brightness, contrast, blending)
+        '''
+        shape = display_shape(self.source.shape, scale)
+        level = self.level_for_scale(scale)
+        coarse = min(level + COARSE_LEVELS, self.source.nlevels - 1)
+        visible = tiles_in_view(view, shape)
+        nearby = set(tiles_in_view(view, shape, BORDER)) - set(visible)
+        drawn, coarse_jobs, jobs, border_jobs = [], [], [], []
+        for col, row in visible:
+            key = (level, col, row, scale, settings)
+            rgb = self.cache.get(key)
+            if rgb is None:
+                jobs.append(key)
+                if coarse != level:
+                    key = (coarse, col, row, scale, settings)
+                    rgb = self.cache.get(key)
+                    if rgb is None:
+                        coarse_jobs.append(key)
+            if rgb is not None:
+                drawn.append((col * TILE, row * TILE, key, rgb))
+        for col, row in sorted(nearby):
+            key = (level, col, row, scale, settings)
+            if self.cache.get(key) is None:
+                border_jobs.append(key)
+        with self.cv:
+            self.jobs = [key for key in coarse_jobs + jobs + border_jobs if key != self.running]
+            self.wanted = set(coarse_jobs + jobs + border_jobs)
+            if self.jobs and self.thread is None and not self.closed:
+                self.thread = threading.Thread(target=self._run, name='TileRenderer')
+                self.thread.daemon = True
+                self.thread.start()
+            self.cv.notify()
+        return drawn
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while not self.jobs and not self.closed:
+                    self.cv.wait()
+                if self.closed:
+                    return
+                key = self.running = self.jobs.pop(0)
+            level, col, row, scale, settings = key
+            try:
+                rgb = render_tile(self.source, level, (col, row), scale, settings)
+                self.cache.put(key, rgb, rgb.nbytes)
+            except Exception as e:
+                logging.error('Failed to render image tile %s: %s'%(key[:3], e))
+                rgb = None
+            with self.cv:
+                self.running = None
+                current = key in self.wanted
+            if rgb is not None and current and self.callback is not None:
+                self.callback(key)
+
+    def close(self):
+        '''Stops the rendering thread, dropping any queued tiles.'''
+        with self.cv:
+            self.closed = True
+            self.jobs = []
+            self.cv.notify()